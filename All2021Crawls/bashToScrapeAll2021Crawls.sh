@@ -66,7 +66,10 @@ N=$((n/c))
 # Server URL start
 SERVER_URL="https://data.commoncrawl.org/"
 
-for ((i=($k*N); i<(($k+1)*N); i++)); do
+# Download, unzip and extract the segment of line i+1 of wet.paths (i from 0).
+# Returns 1 if the download keeps failing, after adding it to quarantine.txt
+process_segment() {
+  local i=\$1
   warcpathslinenumber=\$((i+1))
   warcpaths="wet.paths"
   FILE_NAME=\$(sed -n "\${warcpathslinenumber}{p;q}" "\$warcpaths")
@@ -74,30 +77,42 @@ for ((i=($k*N); i<(($k+1)*N); i++)); do
   SEGMENT_NUMBER=\$(printf "%05d" "\$i")
   OUTPUT_FILE_NAME="crawldata${crawlDate}segment\${SEGMENT_NUMBER}.wet.gz"
   FILE_NAME_TO_DELETE="crawldata${crawlDate}segment\${SEGMENT_NUMBER}.wet"
-  
+
 #   curl --retry 1000 --retry-delay 1 -o "\${OUTPUT_FILE_NAME}" "\${SERVER_URL}\${FILE_NAME}"
 #   gzip -d "\$OUTPUT_FILE_NAME"
 
 
-  # Infinite loop to ensure the file is downloaded and not empty
-  while [[ ! -s "\${OUTPUT_FILE_NAME}" ]]; do
-    echo "Attempting to download \${OUTPUT_FILE_NAME}..."
-    curl --retry 1000 --retry-delay 1 -o "\${OUTPUT_FILE_NAME}" "\${SERVER_URL}\${FILE_NAME}"
-    sleep 1  # Optional: Add a small delay
-  done
-
-  # Check if the downloaded file is larger than 10MB
-  FILE_SIZE=\$(stat -c %s "\$OUTPUT_FILE_NAME")
-  while [ "\$FILE_SIZE" -le 10485760 ]; do
-    echo "File size is less than 10MB. Waiting 10 seconds..."
-    sleep 10
-    curl "\${SERVER_URL}\${FILE_NAME}" --output "\${OUTPUT_FILE_NAME}"
-    FILE_SIZE=\$(stat -c %s "\$OUTPUT_FILE_NAME")
+  # Download at most MAX_ATTEMPTS times, until the file is a complete gzip file.
+  # A segment that keeps failing (truncated, missing or corrupt) is added to
+  # quarantine.txt and skipped, so it does not hold up the rest of the chunk
+  MAX_ATTEMPTS=5
+  ATTEMPT=0
+  DOWNLOADED=0
+  while [[ \${ATTEMPT} -lt \${MAX_ATTEMPTS} ]]; do
+    ATTEMPT=\$((ATTEMPT+1))
+    echo "Attempting to download \${OUTPUT_FILE_NAME} (attempt \${ATTEMPT} of \${MAX_ATTEMPTS})..."
+    rm -f "\${OUTPUT_FILE_NAME}" "\${FILE_NAME_TO_DELETE}"
+    if curl --fail --retry 5 --retry-delay 10 -o "\${OUTPUT_FILE_NAME}" "\${SERVER_URL}\${FILE_NAME}"; then
+      # gzip exits 1 on an error, and 2 on a warning (e.g. trailing garbage ignored)
+      # after decompressing the segment, which read_wet.py can then process
+      gzip -d "\${OUTPUT_FILE_NAME}" 2>/dev/null
+      if [[ \$? -ne 1 && -f "\${FILE_NAME_TO_DELETE}" ]]; then
+        echo "Successfully downloaded and unzipped \${OUTPUT_FILE_NAME}."
+        DOWNLOADED=1
+        break
+      fi
+    fi
+    echo "Failed to download or unzip \${OUTPUT_FILE_NAME}."
+    if [[ \${ATTEMPT} -lt \${MAX_ATTEMPTS} ]]; then
+      sleep \$((30 * ATTEMPT))  # wait longer after each failure
+    fi
   done
-
-
-  # Attempt to unzip the file
-  gzip -d "\${OUTPUT_FILE_NAME}"
+  if [[ \${DOWNLOADED} -eq 0 ]]; then
+    echo "Quarantining \${FILE_NAME} after \${MAX_ATTEMPTS} attempts."
+    echo "\${FILE_NAME}" >> quarantine.txt
+    rm -f "\${OUTPUT_FILE_NAME}" "\${FILE_NAME_TO_DELETE}"
+    return 1
+  fi
 
 
 
@@ -108,8 +123,39 @@ for ((i=($k*N); i<(($k+1)*N); i++)); do
   # PARQUET_OUTPUT_FILE_NAME="crawldata${crawlDate}segment\${SEGMENT_NUMBER}.parquet"
   # python -c "import pandas as pd; df = pd.read_csv(\"\$PY_OUTPUT_FILE_NAME\"); df.to_parquet(\"\$PARQUET_OUTPUT_FILE_NAME\", engine='pyarrow')"
   # rm "\$PY_OUTPUT_FILE_NAME"
-
-done
+}
+
+# With --retry_quarantined (sbatch bash$k.sh --retry_quarantined), only the
+# segments of quarantine.txt are processed again. It is moved aside first (to
+# quarantine.1.txt, then .2.txt...), so the segments that fail once more end up
+# in a new quarantine.txt
+if [[ "\$1" == "--retry_quarantined" ]]; then
+  if [[ ! -s quarantine.txt ]]; then
+    echo "No quarantined segments to retry."
+    exit 0
+  fi
+  RETRY=1
+  while [[ -e "quarantine.\${RETRY}.txt" ]]; do
+    RETRY=\$((RETRY+1))
+  done
+  RETRIED="quarantine.\${RETRY}.txt"
+  mv quarantine.txt "\${RETRIED}"
+  echo "Retrying the segments of \${RETRIED}"
+  while read -r FILE_NAME <&3; do
+    [[ -z "\${FILE_NAME}" ]] && continue
+    LINE_NUMBER=\$(grep -nxF "\${FILE_NAME}" wet.paths | head -n 1 | cut -d: -f1)
+    if [[ -z "\${LINE_NUMBER}" ]]; then
+      echo "\${FILE_NAME} is not in wet.paths, keeping it in quarantine."
+      echo "\${FILE_NAME}" >> quarantine.txt
+      continue
+    fi
+    process_segment \$((LINE_NUMBER-1))
+  done 3< "\${RETRIED}"
+else
+  for ((i=($k*N); i<(($k+1)*N); i++)); do
+    process_segment "\$i"
+  done
+fi
 
 echo End time is "\$(date)"
 
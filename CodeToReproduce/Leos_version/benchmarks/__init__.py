@@ -0,0 +1 @@
+"""Benchmarks of the extraction pipeline, run from this folder as `python -m benchmarks.<name>`"""
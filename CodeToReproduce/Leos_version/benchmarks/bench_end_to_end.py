@@ -0,0 +1,311 @@
+"""
+Segments/hour, bytes/s, CPU utilisation and peak memory of read_wet.py followed by
+merge_crawls.py, downloading synthetic segments from a local Common Crawl stand-in
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+from datetime import datetime
+from time import perf_counter
+
+from benchmarks.bench_hot_path import git_commit
+from benchmarks.synthetic import generate_lookup, generate_segment
+from local_server import start_server
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def default_workers():
+    """Powers of two up to the number of cpus, and the number of cpus"""
+    cpus = os.cpu_count() or 1
+    workers = [1]
+    while workers[-1] * 2 < cpus:
+        workers.append(workers[-1] * 2)
+    if workers[-1] != cpus:
+        workers.append(cpus)
+    return workers
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="End-to-end benchmark of read_wet.py and merge_crawls.py"
+    )
+    parser.add_argument(
+        "--segments", type=int, default=8, help="synthetic segments to process"
+    )
+    parser.add_argument("--records", type=int, default=2000, help="records per segment")
+    parser.add_argument(
+        "--couk_share", type=float, default=0.1, help="share of .co.uk urls"
+    )
+    parser.add_argument(
+        "--eng_share", type=float, default=0.6, help="share of English records"
+    )
+    parser.add_argument(
+        "--postcode_density",
+        type=float,
+        default=0.5,
+        help="postcodes per 1000 characters of text",
+    )
+    parser.add_argument(
+        "--page_size", type=int, default=5000, help="mean characters per page"
+    )
+    parser.add_argument(
+        "--lookup_size",
+        type=int,
+        default=30000,
+        help="postcodes in the Bristol-like lookup",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=default_workers(),
+        help="worker counts to sweep, by default powers of two up to the number of cpus",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        nargs="+",
+        default=[0, 2],
+        help="prefetch counts to sweep",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=None,
+        help="bytes per second of each download from the local server, unlimited by default",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="json file for the results, by default benchmarks/results/end_to_end_{datetime}.json",
+    )
+    pars_args = parser.parse_args()
+    print("the inputs are:")
+    for arg in vars(pars_args):
+        print(f"{arg} is {getattr(pars_args, arg)}")
+    return pars_args
+
+
+def tree_rss_mb(pid):
+    """Resident set size of pid and all its descendants, in MB (reads /proc)"""
+
+    children = {}
+    rss = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/status", "r") as f_in:
+                status = dict(
+                    line.split(":", 1)
+                    for line in f_in.read().splitlines()
+                    if ":" in line
+                )
+        except OSError:
+            # the process ended meanwhile
+            continue
+        children.setdefault(int(status["PPid"]), []).append(int(entry))
+        rss[int(entry)] = int(status.get("VmRSS", "0 kB").split()[0])
+
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += rss.get(current, 0)
+        stack.extend(children.get(current, []))
+    return total / 1024
+
+
+def run_measured(command, cwd, interval=0.05):
+    """
+    Run command, sampling the memory of its process tree every interval seconds.
+    Returns seconds, cpu seconds of the command and its children, and peak RSS in MB.
+    """
+
+    times_before = os.times()
+    start = perf_counter()
+    process = subprocess.Popen(
+        command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    peak = 0.0
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.is_set():
+            peak = max(peak, tree_rss_mb(process.pid))
+            done.wait(interval)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    _, stderr = process.communicate()
+    done.set()
+    sampler.join()
+    seconds = perf_counter() - start
+    times_after = os.times()
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"{' '.join(command)} failed:\n{stderr.decode('utf-8', 'replace')}"
+        )
+    cpu_seconds = (times_after.children_user - times_before.children_user) + (
+        times_after.children_system - times_before.children_system
+    )
+    return seconds, cpu_seconds, peak
+
+
+def prepare_fixtures(params, workdir):
+    """
+    Write the lookup, and the synthetic segments under crawl-data/ with their
+    wet.paths, as on data.commoncrawl.org. Returns the total bytes of the segments.
+    """
+
+    lookup_postcodes = generate_lookup(
+        os.path.join(workdir, "lookup.csv"), params["lookup_size"], "BS", params["seed"]
+    )
+    segment_dir = "crawl-data/CC-MAIN-2023-50/segments/0000000000000.00/wet/"
+    os.makedirs(os.path.join(workdir, segment_dir))
+    total_bytes = 0
+    with open(os.path.join(workdir, "wet.paths"), "w", encoding="utf-8") as f_out:
+        for segment in range(params["segments"]):
+            path = f"{segment_dir}CC-MAIN-20231201000000-20231201030000-{segment:05d}.warc.wet.gz"
+            generate_segment(
+                os.path.join(workdir, path),
+                seed=params["seed"] + segment,
+                num_records=params["records"],
+                couk_share=params["couk_share"],
+                eng_share=params["eng_share"],
+                postcode_density=params["postcode_density"],
+                page_size=params["page_size"],
+                lookup_postcodes=lookup_postcodes,
+            )
+            total_bytes += os.path.getsize(os.path.join(workdir, path))
+            f_out.write(path + "\n")
+    return total_bytes
+
+
+def run_configuration(workdir, base_url, workers, prefetch, params, total_bytes):
+    """Process every segment with read_wet.py, then merge with merge_crawls.py"""
+
+    output_dir = os.path.join(workdir, f"out_w{workers}_p{prefetch}", "")
+    read_command = [
+        sys.executable,
+        os.path.join(SCRIPT_DIR, "read_wet.py"),
+        "--wet_file",
+        os.path.join(workdir, "wet.paths"),
+        "--outputs_dir",
+        output_dir,
+        "--server",
+        base_url,
+        "--crawl",
+        "202350",
+        "--postcode_list",
+        os.path.join(workdir, "lookup.csv"),
+        "--workers",
+        str(workers),
+        "--prefetch",
+        str(prefetch),
+    ]
+    merge_command = [
+        sys.executable,
+        os.path.join(SCRIPT_DIR, "merge_crawls.py"),
+        "--year",
+        "2023",
+        "--database_path",
+        output_dir,
+        "--output_path",
+        os.path.join(output_dir, "processed", ""),
+    ]
+    read_seconds, read_cpu, read_rss = run_measured(read_command, SCRIPT_DIR)
+    merge_seconds, merge_cpu, merge_rss = run_measured(merge_command, SCRIPT_DIR)
+
+    seconds = read_seconds + merge_seconds
+    cpus = os.cpu_count() or 1
+    return {
+        "workers": workers,
+        "prefetch": prefetch,
+        "segments": params["segments"],
+        "bytes": total_bytes,
+        "seconds": seconds,
+        "read_seconds": read_seconds,
+        "merge_seconds": merge_seconds,
+        "segments_per_hour": params["segments"] * 3600 / seconds,
+        "bytes_per_second": total_bytes / seconds,
+        # share of all the cpus of the machine, 1.0 = every cpu busy for the whole run
+        "cpu_utilisation": (read_cpu + merge_cpu) / (seconds * cpus),
+        "peak_rss_mb": max(read_rss, merge_rss),
+        "read_peak_rss_mb": read_rss,
+        "merge_peak_rss_mb": merge_rss,
+    }
+
+
+def run_benchmarks(params, workers_list, prefetch_list, bandwidth=None):
+    """Run every (workers, prefetch) configuration against the same local server"""
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        total_bytes = prepare_fixtures(params, workdir)
+        server, base_url = start_server(workdir, bandwidth=bandwidth)
+        try:
+            for workers in workers_list:
+                for prefetch in prefetch_list:
+                    result = run_configuration(
+                        workdir, base_url, workers, prefetch, params, total_bytes
+                    )
+                    results.append(result)
+                    print(
+                        f"workers {workers:>3} prefetch {prefetch:>3}"
+                        f"{result['segments_per_hour']:>12.0f} segments/h"
+                        f"{result['bytes_per_second'] / 1e6:>9.2f} MB/s"
+                        f"{result['cpu_utilisation']:>8.1%} cpu"
+                        f"{result['peak_rss_mb']:>9.1f} MB peak RSS"
+                    )
+        finally:
+            server.shutdown()
+            server.server_close()
+    return {
+        "created": datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "cpus": os.cpu_count(),
+        "params": dict(params, bandwidth=bandwidth),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    params = {
+        "segments": args.segments,
+        "records": args.records,
+        "couk_share": args.couk_share,
+        "eng_share": args.eng_share,
+        "postcode_density": args.postcode_density,
+        "page_size": args.page_size,
+        "lookup_size": args.lookup_size,
+        "seed": args.seed,
+    }
+    results = run_benchmarks(params, args.workers, args.prefetch, args.bandwidth)
+
+    best = max(results["results"], key=lambda result: result["segments_per_hour"])
+    print(
+        f"best: {best['workers']} workers, prefetch {best['prefetch']} "
+        f"({best['segments_per_hour']:.0f} segments/h)"
+    )
+
+    output = args.output
+    if output is None:
+        os.makedirs("benchmarks/results", exist_ok=True)
+        output = f"benchmarks/results/end_to_end_{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as f_out:
+        json.dump(results, f_out, indent=2)
+    print(f"Saved results to {output}")
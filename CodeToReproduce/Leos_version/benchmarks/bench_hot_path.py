@@ -0,0 +1,330 @@
+"""Records/sec and peak RSS of the functions on the extraction hot path, on synthetic data"""
+
+import argparse
+import csv
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from time import perf_counter
+
+import pandas as pd
+
+from benchmarks.synthetic import generate_lookup, generate_records, write_segment
+from helper_functions import (
+    Bristol_postcode_finder,
+    UK_postcode_finder,
+    decompress_gzip,
+    extract_website,
+    postcode_finder,
+    postcode_scanner,
+)
+from profiles import FilterProfile
+from read_wet import extract_from_segment, merge_csvs
+
+BENCHMARKS = [
+    "postcode_finder",
+    "postcode_scanner",
+    "Bristol_postcode_finder",
+    "UK_postcode_finder",
+    "extract_website",
+    "extract_from_segment",
+    "merge_csvs",
+]
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(description="Benchmark of the extraction hot path")
+    parser.add_argument(
+        "--benchmarks",
+        type=str,
+        nargs="+",
+        choices=BENCHMARKS,
+        default=BENCHMARKS,
+        help="benchmarks to run",
+    )
+    parser.add_argument("--records", type=int, default=5000, help="records per run")
+    parser.add_argument(
+        "--couk_share", type=float, default=0.1, help="share of .co.uk urls"
+    )
+    parser.add_argument(
+        "--eng_share", type=float, default=0.6, help="share of English records"
+    )
+    parser.add_argument(
+        "--postcode_density",
+        type=float,
+        default=0.5,
+        help="postcodes per 1000 characters of text",
+    )
+    parser.add_argument(
+        "--page_size", type=int, default=5000, help="mean characters per page"
+    )
+    parser.add_argument(
+        "--lookup_size",
+        type=int,
+        default=30000,
+        help="postcodes in the Bristol-like lookup",
+    )
+    parser.add_argument(
+        "--uk_lookup_size",
+        type=int,
+        default=300000,
+        help="postcodes in the UK-like lookup",
+    )
+    parser.add_argument(
+        "--merge_segments",
+        type=int,
+        default=20,
+        help="segment csvs merged by the merge_csvs benchmark",
+    )
+    parser.add_argument(
+        "--mixed_case",
+        action="store_true",
+        help="write some postcodes in lowercase or without space",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="json file for the results, by default benchmarks/results/hot_path_{datetime}.json",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="json file of a previous run to compare with",
+    )
+    pars_args = parser.parse_args()
+    print("the inputs are:")
+    for arg in vars(pars_args):
+        print(f"{arg} is {getattr(pars_args, arg)}")
+    return pars_args
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synthetic_records(params, lookup_postcodes):
+    return list(
+        generate_records(
+            num_records=params["records"],
+            couk_share=params["couk_share"],
+            eng_share=params["eng_share"],
+            postcode_density=params["postcode_density"],
+            page_size=params["page_size"],
+            lookup_postcodes=lookup_postcodes,
+            mixed_case=params["mixed_case"],
+            seed=params["seed"],
+        )
+    )
+
+
+def run_one(name, params, workdir):
+    """Run benchmark name in this (fresh) process, returns its measurements"""
+
+    lookup = pd.read_csv(os.path.join(workdir, "lookup.csv"))
+    records = synthetic_records(params, list(lookup["pcds"]))
+    texts = [text for _, _, text in records]
+    text_bytes = sum(len(text) for text in texts)
+
+    extra = {}
+    if name in ("postcode_finder", "postcode_scanner"):
+        finder = postcode_finder if name == "postcode_finder" else postcode_scanner
+        setup_rss = peak_rss_mb()
+        start = perf_counter()
+        found = [finder(text) for text in texts]
+        seconds = perf_counter() - start
+        count, size = len(texts), text_bytes
+        # postcodes of the lookup found, to compare the recall of the two finders
+        lookup_postcodes = set(lookup["pcds"])
+        extra["lookup_matches"] = sum(
+            len(lookup_postcodes.intersection(postcodes)) for postcodes in found
+        )
+
+    elif name == "Bristol_postcode_finder":
+        setup_rss = peak_rss_mb()
+        start = perf_counter()
+        for text in texts:
+            Bristol_postcode_finder(text, lookup)
+        seconds = perf_counter() - start
+        count, size = len(texts), text_bytes
+
+    elif name == "UK_postcode_finder":
+        uk_lookup = pd.read_csv(os.path.join(workdir, "uk_lookup.csv"))
+        setup_rss = peak_rss_mb()
+        start = perf_counter()
+        for text in texts:
+            UK_postcode_finder(text, uk_lookup)
+        seconds = perf_counter() - start
+        count, size = len(texts), text_bytes
+
+    elif name == "extract_website":
+        uris = [uri for uri, _, _ in records]
+        setup_rss = peak_rss_mb()
+        start = perf_counter()
+        for uri in uris:
+            extract_website(uri)
+        seconds = perf_counter() - start
+        count, size = len(uris), sum(len(uri) for uri in uris)
+
+    elif name == "extract_from_segment":
+        segment = os.path.join(workdir, "segment.wet")
+        # decompress_gzip removes the .gz, so it gets a copy
+        shutil.copyfile(os.path.join(workdir, "segment.warc.wet.gz"), segment + ".gz")
+        decompress_gzip(segment + ".gz", segment)
+        profiles = [FilterProfile(None, lookup["pcds"], postcode_prefix="BS")]
+        setup_rss = peak_rss_mb()
+        start = perf_counter()
+        extract_from_segment(
+            segment, os.path.join(workdir, "segment.csv"), "synthetic", profiles
+        )
+        seconds = perf_counter() - start
+        count, size = len(records), os.path.getsize(segment)
+        os.remove(segment)
+
+    elif name == "merge_csvs":
+        merge_dir = os.path.join(workdir, "merge", "")
+        os.makedirs(merge_dir, exist_ok=True)
+        count = 0
+        for segment in range(params["merge_segments"]):
+            filename = f"{merge_dir}crawldata000000segment{segment:05d}.csv"
+            with open(filename, "w", newline="") as f_out:
+                csv_writer = csv.writer(f_out)
+                for uri, _, text in records:
+                    csv_writer.writerow(
+                        [uri, extract_website(uri), ["BS1 1AA"], "synthetic", text]
+                    )
+                    count += 1
+        size = sum(
+            os.path.getsize(os.path.join(merge_dir, f)) for f in os.listdir(merge_dir)
+        )
+        setup_rss = peak_rss_mb()
+        start = perf_counter()
+        merge_csvs("000000", merge_dir)
+        seconds = perf_counter() - start
+
+    else:
+        raise ValueError(f"Unknown benchmark: {name}")
+
+    return {
+        "records": count,
+        "bytes": size,
+        "seconds": seconds,
+        "records_per_second": count / seconds if seconds else None,
+        "mb_per_second": size / 1e6 / seconds if seconds else None,
+        "setup_peak_rss_mb": setup_rss,
+        "peak_rss_mb": peak_rss_mb(),
+        **extra,
+    }
+
+
+def prepare_fixtures(params, workdir):
+    """Write the lookups and the synthetic segment into workdir"""
+
+    lookup_postcodes = generate_lookup(
+        os.path.join(workdir, "lookup.csv"), params["lookup_size"], "BS", params["seed"]
+    )
+    generate_lookup(
+        os.path.join(workdir, "uk_lookup.csv"),
+        params["uk_lookup_size"],
+        None,
+        params["seed"],
+    )
+    write_segment(
+        os.path.join(workdir, "segment.warc.wet.gz"),
+        synthetic_records(params, lookup_postcodes),
+        "wet",
+        params["seed"],
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names, params):
+    """Run every benchmark in its own process, so peak RSS is its own"""
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        prepare_fixtures(params, workdir)
+        for name in names:
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+                results[name] = executor.submit(run_one, name, params, workdir).result()
+            print(
+                f"{name:<25}{results[name]['records_per_second']:>14.1f} records/s"
+                f"{results[name]['mb_per_second']:>10.2f} MB/s"
+                f"{results[name]['peak_rss_mb']:>10.1f} MB peak RSS"
+                + (
+                    f"{results[name]['lookup_matches']:>8} lookup postcodes found"
+                    if "lookup_matches" in results[name]
+                    else ""
+                )
+            )
+    return {
+        "created": datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "results": results,
+    }
+
+
+def compare(current, previous):
+    """Print the speed of current relative to previous"""
+
+    print(f"compared with {previous['created']} ({previous['git_commit']}):")
+    for name, result in current["results"].items():
+        if name not in previous["results"]:
+            continue
+        before = previous["results"][name]["records_per_second"]
+        after = result["records_per_second"]
+        if before and after:
+            print(f"{name:<25}{after / before:>8.2f}x records/s")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    params = {
+        "records": args.records,
+        "couk_share": args.couk_share,
+        "eng_share": args.eng_share,
+        "postcode_density": args.postcode_density,
+        "page_size": args.page_size,
+        "lookup_size": args.lookup_size,
+        "uk_lookup_size": args.uk_lookup_size,
+        "merge_segments": args.merge_segments,
+        "mixed_case": args.mixed_case,
+        "seed": args.seed,
+    }
+    results = run_benchmarks(args.benchmarks, params)
+
+    if args.compare is not None:
+        with open(args.compare, "r", encoding="utf-8") as f_in:
+            compare(results, json.load(f_in))
+
+    output = args.output
+    if output is None:
+        os.makedirs("benchmarks/results", exist_ok=True)
+        output = f"benchmarks/results/hot_path_{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as f_out:
+        json.dump(results, f_out, indent=2)
+    print(f"Saved results to {output}")
@@ -0,0 +1,197 @@
+"""
+Decompression throughput of WET segments with each inflate backend and thread
+count, against gzip.open and the gzip command
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from datetime import datetime
+from time import perf_counter
+
+from benchmarks.bench_end_to_end import default_workers
+from benchmarks.bench_hot_path import git_commit
+from benchmarks.synthetic import generate_segment
+from helper_functions import decompress_gzip
+from inflate import INFLATE_BACKENDS, decompress_parallel
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the gzip decompression of segments"
+    )
+    parser.add_argument(
+        "--segments",
+        type=str,
+        nargs="+",
+        default=None,
+        help="segments (.warc.wet.gz) to decompress, by default a synthetic one",
+    )
+    parser.add_argument(
+        "--records",
+        type=int,
+        default=20000,
+        help="records of the synthetic segment",
+    )
+    parser.add_argument(
+        "--page_size",
+        type=int,
+        default=7000,
+        help="mean characters per page of the synthetic segment",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        default=default_workers(),
+        help="thread counts to sweep, by default powers of two up to the number of cpus",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per method, the fastest is kept"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="json file for the results, by default benchmarks/results/inflate_{datetime}.json",
+    )
+    return parser.parse_args()
+
+
+def gzip_command(filename_gz, out_filename):
+    """The gzip command, as the bash scripts decompress segments"""
+    with open(out_filename, "wb") as f_out:
+        subprocess.run(["gzip", "-dc", filename_gz], stdout=f_out, check=True)
+    os.remove(filename_gz)
+
+
+def inflate_method(backend, threads):
+    """Decompression of read_wet.py with backend and threads threads"""
+
+    def decompress(filename_gz, out_filename):
+        if threads <= 1:
+            decompress_gzip(
+                filename_gz, out_filename, skip_corrupt=True, backend=backend
+            )
+        else:
+            decompress_parallel(
+                filename_gz, out_filename, threads=threads, backend=backend
+            )
+
+    return decompress
+
+
+def methods(threads):
+    """(name, backend, threads, decompress(filename_gz, out_filename)) to compare"""
+
+    found = [("gzip.open", None, 1, decompress_gzip)]
+    if shutil.which("gzip") is not None:
+        found.append(("gzip -d", None, 1, gzip_command))
+    for name, backend in INFLATE_BACKENDS.items():
+        for num_threads in threads:
+            found.append(
+                (name, name, num_threads, inflate_method(backend, num_threads))
+            )
+    return found
+
+
+def sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f_in:
+        for block in iter(lambda: f_in.read(1024**2), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run_benchmarks(segments, threads, repeat, workdir):
+    """Fastest of repeat runs of every method over every segment"""
+
+    bytes_in = sum(os.path.getsize(segment) for segment in segments)
+    results = []
+    reference = None
+    for name, backend, num_threads, decompress in methods(threads):
+        best = None
+        for _ in range(repeat):
+            seconds = 0.0
+            digests = []
+            bytes_out = 0
+            for segment in segments:
+                # the decompression removes the compressed file, so it gets a copy
+                filename_gz = os.path.join(workdir, "segment.gz")
+                out_filename = os.path.join(workdir, "segment")
+                shutil.copyfile(segment, filename_gz)
+                start = perf_counter()
+                decompress(filename_gz, out_filename)
+                seconds += perf_counter() - start
+                bytes_out += os.path.getsize(out_filename)
+                digests.append(sha256(out_filename))
+                os.remove(out_filename)
+            best = seconds if best is None else min(best, seconds)
+        if reference is None:
+            reference = digests
+        result = {
+            "method": name,
+            "backend": backend,
+            "threads": num_threads,
+            "seconds": best,
+            "mb_in_per_second": bytes_in / best / 1e6,
+            "mb_out_per_second": bytes_out / best / 1e6,
+            "same_output": digests == reference,
+        }
+        results.append(result)
+        print(
+            f"{name:<10}{num_threads:>3} threads{best:>9.3f} s"
+            f"{result['mb_out_per_second']:>9.1f} MB/s out"
+            f"{'' if result['same_output'] else '  DIFFERENT OUTPUT'}"
+        )
+    baseline = results[0]["seconds"]
+    for result in results:
+        result["speedup"] = baseline / result["seconds"]
+    return {
+        "bytes_in": bytes_in,
+        "bytes_out": bytes_out,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        segments = args.segments
+        if segments is None:
+            segments = [os.path.join(workdir, "synthetic.warc.wet.gz")]
+            generate_segment(
+                segments[0],
+                num_records=args.records,
+                page_size=args.page_size,
+                seed=args.seed,
+            )
+        results = run_benchmarks(segments, args.threads, args.repeat, workdir)
+    results.update(
+        {
+            "created": datetime.now().isoformat(),
+            "git_commit": git_commit(),
+            "cpus": os.cpu_count(),
+            "segments": args.segments or "synthetic",
+            "params": {
+                "records": args.records,
+                "page_size": args.page_size,
+                "repeat": args.repeat,
+                "seed": args.seed,
+            },
+        }
+    )
+    output = args.output
+    if output is None:
+        os.makedirs("benchmarks/results", exist_ok=True)
+        output = f"benchmarks/results/inflate_{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as f_out:
+        json.dump(results, f_out, indent=2)
+    print(f"Saved results to {output}")
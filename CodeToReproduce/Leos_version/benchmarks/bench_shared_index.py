@@ -0,0 +1,219 @@
+"""
+Memory of worker processes holding the postcode lookup as a frozenset or as a
+PostcodeIndex, as the number of workers grows (Linux, reads /proc/self/smaps_rollup)
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import tempfile
+
+from datetime import datetime
+
+from benchmarks.bench_end_to_end import default_workers
+from benchmarks.bench_hot_path import git_commit
+from benchmarks.synthetic import random_postcode
+from postcode_index import PostcodeIndex
+
+# lookup held as, and how workers get it: inherited by fork, or pickled to them
+# like the initargs of a process pool
+MODES = [
+    ("frozenset", "fork"),
+    ("frozenset", "pickled"),
+    ("index", "fork"),
+    ("index_file", "pickled"),
+]
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="Per-worker memory of the postcode lookup, frozenset against PostcodeIndex"
+    )
+    parser.add_argument(
+        "--lookup_size",
+        type=int,
+        default=1000000,
+        help="postcodes in the lookup (about 2.6 million in the UK lookup)",
+    )
+    parser.add_argument(
+        "--lookups",
+        type=int,
+        default=200000,
+        help="postcodes looked up by each worker, half of them in the lookup",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=default_workers(),
+        help="worker counts to sweep, by default powers of two up to the number of cpus",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="json file for the results, by default benchmarks/results/shared_index_{datetime}.json",
+    )
+    return parser.parse_args()
+
+
+def lookup_postcodes(size, seed):
+    """size distinct postcodes, the same for the same seed"""
+    rng = random.Random(seed)
+    postcodes = set()
+    while len(postcodes) < size:
+        postcodes.add(random_postcode(rng))
+    return sorted(postcodes)
+
+
+def memory_mb():
+    """Rss, Pss and private (clean and dirty) memory of this process in MB"""
+    values = {}
+    with open("/proc/self/smaps_rollup", "r") as f_in:
+        for line in f_in:
+            key, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                values[key] = int(value.split()[0])
+    return {
+        "rss_mb": values["Rss"] / 1024,
+        "pss_mb": values["Pss"] / 1024,
+        "private_mb": (values["Private_Clean"] + values["Private_Dirty"]) / 1024,
+    }
+
+
+def worker(postcodes, pickled, hits, params, index, barrier, connection):
+    """
+    Look up postcodes as extraction would, with a full garbage collection as happens
+    during a run, then report the memory of the worker once every worker is done
+    """
+
+    if pickled is not None:
+        postcodes = pickle.loads(pickled)
+    # new string objects, the lookup's own are never touched from here
+    rng = random.Random(params["seed"] + 1 + index)
+    probes = hits.split("\n") + [
+        random_postcode(rng) for _ in range(params["lookups"] // 2)
+    ]
+    before = memory_mb()
+
+    found = sum(probe in postcodes for probe in probes)
+    gc.collect()
+
+    # measured while every worker is alive, so shared pages are split between all
+    barrier.wait()
+    after = memory_mb()
+    connection.send({"before": before, "after": after, "found": found})
+    barrier.wait()
+
+
+def run_mode(holder, start, hits, num_workers, params):
+    """
+    Memory of num_workers workers getting holder by start ("fork" or "pickled"),
+    each looking up the postcodes of hits (one per line) and as many others
+    """
+
+    context = multiprocessing.get_context("fork")
+    pickled = pickle.dumps(holder) if start == "pickled" else None
+    inherited = holder if start == "fork" else None
+    barrier = context.Barrier(num_workers + 1)
+    connections = []
+    processes = []
+    for index in range(num_workers):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(
+            target=worker,
+            args=(inherited, pickled, hits, params, index, barrier, sender),
+        )
+        process.start()
+        connections.append(receiver)
+        processes.append(process)
+    barrier.wait()
+    parent = memory_mb()
+    reports = [connection.recv() for connection in connections]
+    barrier.wait()
+    for process in processes:
+        process.join()
+
+    return {
+        "workers": num_workers,
+        "found": reports[0]["found"],
+        "worker_rss_mb": sum(r["after"]["rss_mb"] for r in reports) / num_workers,
+        "worker_private_mb": sum(r["after"]["private_mb"] for r in reports)
+        / num_workers,
+        # private memory the lookups and the collection cost each worker
+        "worker_copied_mb": sum(
+            r["after"]["private_mb"] - r["before"]["private_mb"] for r in reports
+        )
+        / num_workers,
+        "parent_rss_mb": parent["rss_mb"],
+        # memory of the parent and its workers together
+        "total_pss_mb": parent["pss_mb"] + sum(r["after"]["pss_mb"] for r in reports),
+    }
+
+
+def run_benchmarks(params, workers):
+    """Every mode of MODES for every worker count"""
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for kind, start in MODES:
+            # only the holder is left in the parent, as in read_wet.py
+            postcodes = lookup_postcodes(params["lookup_size"], params["seed"])
+            hits = "\n".join(
+                random.Random(params["seed"]).sample(postcodes, params["lookups"] // 2)
+            )
+            if kind == "frozenset":
+                holder = frozenset(postcodes)
+            elif kind == "index":
+                holder = PostcodeIndex.from_postcodes(postcodes)
+            else:
+                holder = PostcodeIndex.build(
+                    postcodes, os.path.join(workdir, "lookup.pci")
+                )
+            del postcodes
+            gc.collect()
+            for num_workers in workers:
+                result = run_mode(holder, start, hits, num_workers, params)
+                result.update({"lookup": kind, "start": start})
+                results.append(result)
+                print(
+                    f"{kind:<11}{start:<8}{num_workers:>4} workers"
+                    f"{result['worker_rss_mb']:>9.1f} MB RSS"
+                    f"{result['worker_private_mb']:>9.1f} MB private"
+                    f"{result['worker_copied_mb']:>9.1f} MB copied per worker"
+                    f"{result['total_pss_mb']:>10.1f} MB in total"
+                )
+            del holder
+            gc.collect()
+    return {
+        "created": datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "cpus": os.cpu_count(),
+        "params": params,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    params = {
+        "lookup_size": args.lookup_size,
+        "lookups": args.lookups,
+        "seed": args.seed,
+    }
+    results = run_benchmarks(params, args.workers)
+
+    output = args.output
+    if output is None:
+        os.makedirs("benchmarks/results", exist_ok=True)
+        output = f"benchmarks/results/shared_index_{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as f_out:
+        json.dump(results, f_out, indent=2)
+    print(f"Saved results to {output}")
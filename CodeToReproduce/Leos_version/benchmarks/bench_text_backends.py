@@ -0,0 +1,171 @@
+"""Throughput and postcode recall of the warc text backends, against the WET plain text of the same pages"""
+
+import argparse
+import json
+import os
+
+from datetime import datetime
+from time import perf_counter
+
+import pandas as pd
+
+from warcio.archiveiterator import ArchiveIterator
+
+from helper_functions import postcode_finder
+from read_wet import TEXT_BACKENDS, is_html
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(description="Benchmark of the text backends")
+    parser.add_argument(
+        "--warc",
+        type=str,
+        nargs="+",
+        required=True,
+        help="WARC files (.warc.gz) with the html of the pages",
+    )
+    parser.add_argument(
+        "--wet",
+        type=str,
+        nargs="+",
+        required=True,
+        help="WET files (.warc.wet.gz) of the same crawl and segments",
+    )
+    parser.add_argument(
+        "--postcode_list",
+        type=str,
+        default=None,
+        help="File with postcodes list. If given, only postcodes of the list count",
+    )
+    parser.add_argument(
+        "--max_records",
+        type=int,
+        default=5000,
+        help="maximum number of pages to compare",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="json file for the results, by default benchmarks/results/text_backends_{datetime}.json",
+    )
+    pars_args = parser.parse_args()
+    print("the inputs are:")
+    for arg in vars(pars_args):
+        print(f"{arg} is {getattr(pars_args, arg)}")
+    return pars_args
+
+
+def read_wet_texts(wet_files):
+    """Dictionary uri -> plain text of the conversion records of wet_files"""
+
+    texts = {}
+    for wet_file in wet_files:
+        with open(wet_file, "rb") as stream:
+            for record in ArchiveIterator(stream):
+                if record.rec_type == "conversion":
+                    uri = record.rec_headers.get_header("WARC-Target-URI")
+                    texts[uri] = (
+                        record.content_stream().read().decode("utf-8", "ignore")
+                    )
+    return texts
+
+
+def read_html_pages(warc_files, uris, max_records):
+    """List of (uri, html bytes) of the html response records whose uri is in uris"""
+
+    pages = []
+    for warc_file in warc_files:
+        with open(warc_file, "rb") as stream:
+            for record in ArchiveIterator(stream):
+                if record.rec_type != "response" or not is_html(record):
+                    continue
+                uri = record.rec_headers.get_header("WARC-Target-URI")
+                if uri in uris:
+                    pages.append((uri, record.content_stream().read()))
+                    if len(pages) >= max_records:
+                        return pages
+    return pages
+
+
+def find_postcodes(text, postcodes=None):
+    found = set(postcode_finder(text))
+    if postcodes is not None:
+        found &= postcodes
+    return found
+
+
+def run_benchmark(warc_files, wet_files, postcodes=None, max_records=5000):
+    """Results per backend, with the WET plain text postcodes as reference"""
+
+    wet_texts = read_wet_texts(wet_files)
+    pages = read_html_pages(warc_files, wet_texts, max_records)
+    if not pages:
+        raise ValueError("No html page of the warc files is in the wet files")
+    html_bytes = sum(len(html) for _, html in pages)
+    reference = {uri: find_postcodes(wet_texts[uri], postcodes) for uri, _ in pages}
+    expected = sum(len(reference[uri]) for uri, _ in pages)
+
+    results = {
+        "records": len(pages),
+        "html_bytes": html_bytes,
+        "wet_postcodes": expected,
+        "backends": {},
+    }
+    for name, backend in TEXT_BACKENDS.items():
+        start = perf_counter()
+        texts = [backend(html) for _, html in pages]
+        seconds = perf_counter() - start
+
+        recalled = 0
+        extra = 0
+        for (uri, _), text in zip(pages, texts):
+            found = find_postcodes(text, postcodes)
+            recalled += len(found & reference[uri])
+            extra += len(found - reference[uri])
+        results["backends"][name] = {
+            "seconds": seconds,
+            "records_per_second": len(pages) / seconds if seconds else None,
+            "mb_per_second": html_bytes / 1e6 / seconds if seconds else None,
+            "text_bytes": sum(len(text) for text in texts),
+            "postcodes_recalled": recalled,
+            "recall": recalled / expected if expected else None,
+            "postcodes_not_in_wet": extra,
+        }
+    return results
+
+
+def print_results(results):
+    print(
+        f"{results['records']} pages, {results['html_bytes'] / 1e6:.1f} MB of html, "
+        f"{results['wet_postcodes']} postcodes in the WET text"
+    )
+    print(f"{'backend':<12}{'records/s':>12}{'MB/s':>10}{'recall':>10}{'extra':>10}")
+    for name, backend in results["backends"].items():
+        recall = backend["recall"]
+        print(
+            f"{name:<12}{backend['records_per_second'] or 0:>12.1f}"
+            f"{backend['mb_per_second'] or 0:>10.2f}"
+            f"{recall if recall is not None else float('nan'):>10.1%}"
+            f"{backend['postcodes_not_in_wet']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    postcodes = None
+    if args.postcode_list is not None:
+        postcodes = set(pd.read_csv(args.postcode_list, usecols=["pcds"])["pcds"])
+
+    results = run_benchmark(args.warc, args.wet, postcodes, args.max_records)
+    print_results(results)
+
+    output = args.output
+    if output is None:
+        os.makedirs("benchmarks/results", exist_ok=True)
+        output = f"benchmarks/results/text_backends_{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as f_out:
+        json.dump(results, f_out, indent=2)
+    print(f"Saved results to {output}")
@@ -0,0 +1,225 @@
+"""Deterministic synthetic WET/WARC segments and postcode lookups for benchmarks"""
+
+import argparse
+import csv
+import io
+import random
+import string
+import uuid
+
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+
+WORDS = (
+    "the of and to in is for on with at by from our your we you are this that "
+    "home about contact services company limited ltd shop delivery opening hours "
+    "street road lane avenue bristol london city centre office email phone call "
+    "free quote book online today new best local family business since years team"
+).split()
+
+LANGUAGES = ["eng", "fra", "deu", "spa", "ita", "nld"]
+INWARD_LETTERS = "ABDEFGHJLNPQRSTUWXYZ"
+WARC_DATE = "2023-12-01T00:00:00Z"
+
+
+def random_postcode(rng, area=None):
+    """Postcode of the form postcode_finder matches, e.g. BS8 1TH"""
+    if area is None:
+        area = "".join(
+            rng.choice(string.ascii_uppercase) for _ in range(rng.randint(1, 2))
+        )
+    district = str(rng.randint(1, 99))
+    inward = str(rng.randint(0, 9)) + "".join(
+        rng.choice(INWARD_LETTERS) for _ in range(2)
+    )
+    return f"{area}{district} {inward}"
+
+
+def generate_lookup(filename, num_postcodes=10000, area="BS", seed=0):
+    """Write a postcode lookup csv with a pcds column, and return its postcodes"""
+
+    rng = random.Random(seed)
+    postcodes = set()
+    while len(postcodes) < num_postcodes:
+        postcodes.add(random_postcode(rng, area))
+    postcodes = sorted(postcodes)
+    with open(filename, "w", newline="") as f_out:
+        csv_writer = csv.writer(f_out)
+        csv_writer.writerow(["pcds"])
+        for postcode in postcodes:
+            csv_writer.writerow([postcode])
+    return postcodes
+
+
+def vary_postcode(rng, postcode):
+    """Postcode as people write it: lowercase, no space, or unchanged"""
+    variant = rng.random()
+    if variant < 0.2:
+        return postcode.lower()
+    if variant < 0.35:
+        return postcode.replace(" ", "")
+    return postcode
+
+
+def generate_text(rng, page_size, postcode_density, lookup_postcodes, mixed_case):
+    """
+    About page_size characters of words, with postcode_density postcodes per
+    1000 characters, half of them from lookup_postcodes
+    """
+
+    words = []
+    size = 0
+    expected_postcodes = page_size * postcode_density / 1000
+    postcode_probability = expected_postcodes / max(page_size / 6, 1)
+    while size < page_size:
+        if rng.random() < postcode_probability:
+            if lookup_postcodes and rng.random() < 0.5:
+                word = rng.choice(lookup_postcodes)
+            else:
+                word = random_postcode(rng)
+            if mixed_case:
+                word = vary_postcode(rng, word)
+        else:
+            word = rng.choice(WORDS)
+            if mixed_case and rng.random() < 0.1:
+                word = word.upper()
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+
+def generate_records(
+    num_records=1000,
+    couk_share=0.1,
+    eng_share=0.6,
+    postcode_density=0.5,
+    page_size=5000,
+    lookup_postcodes=None,
+    mixed_case=False,
+    seed=0,
+):
+    """Iterate over (uri, language, text) of synthetic pages"""
+
+    rng = random.Random(seed)
+    lookup_postcodes = list(lookup_postcodes or [])
+    num_domains = max(num_records // 10, 1)
+    for i in range(num_records):
+        domain = rng.randrange(num_domains)
+        if rng.random() < couk_share:
+            host = f"www.example{domain}.co.uk"
+        else:
+            host = (
+                f"www.example{domain}.{rng.choice(['com', 'org', 'net', 'de', 'fr'])}"
+            )
+        path = "" if rng.random() < 0.2 else f"page{i}.html"
+        language = "eng" if rng.random() < eng_share else rng.choice(LANGUAGES[1:])
+        size = max(int(rng.expovariate(1 / page_size)), 50)
+        text = generate_text(rng, size, postcode_density, lookup_postcodes, mixed_case)
+        yield f"https://{host}/{path}", language, text
+
+
+def write_segment(filename, records, fmt="wet", seed=0):
+    """
+    Write (uri, language, text) records as a gzipped WET segment (conversion
+    records) or WARC segment (html response records). Record ids and dates are
+    fixed, so the same records always give the same bytes.
+    """
+
+    rng = random.Random(seed)
+    num_records = 0
+    with open(filename, "wb") as f_out:
+        writer = WARCWriter(f_out, gzip=True)
+        for uri, language, text in records:
+            headers = {
+                "WARC-Record-ID": f"<urn:uuid:{uuid.UUID(int=rng.getrandbits(128))}>",
+                "WARC-Date": WARC_DATE,
+            }
+            if fmt == "wet":
+                headers["WARC-Identified-Content-Language"] = language
+                headers["Content-Type"] = "text/plain"
+                record = writer.create_warc_record(
+                    uri,
+                    "conversion",
+                    payload=io.BytesIO(text.encode("utf-8")),
+                    warc_headers_dict=headers,
+                )
+            else:
+                html = f"<html><head><title>{uri}</title></head><body><p>{text}</p></body></html>"
+                http_headers = StatusAndHeaders(
+                    "200 OK",
+                    [("Content-Type", "text/html; charset=utf-8")],
+                    protocol="HTTP/1.1",
+                )
+                record = writer.create_warc_record(
+                    uri,
+                    "response",
+                    payload=io.BytesIO(html.encode("utf-8")),
+                    http_headers=http_headers,
+                    warc_headers_dict=headers,
+                )
+            writer.write_record(record)
+            num_records += 1
+    return num_records
+
+
+def generate_segment(filename, fmt="wet", seed=0, **kwargs):
+    """Write one synthetic segment, kwargs as in generate_records"""
+    return write_segment(filename, generate_records(seed=seed, **kwargs), fmt, seed)
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic WET or WARC segment"
+    )
+    parser.add_argument("--output", type=str, required=True, help="segment filename")
+    parser.add_argument("--format", type=str, choices=["wet", "warc"], default="wet")
+    parser.add_argument("--records", type=int, default=1000, help="number of records")
+    parser.add_argument(
+        "--couk_share", type=float, default=0.1, help="share of .co.uk urls"
+    )
+    parser.add_argument(
+        "--eng_share", type=float, default=0.6, help="share of English records"
+    )
+    parser.add_argument(
+        "--postcode_density",
+        type=float,
+        default=0.5,
+        help="postcodes per 1000 characters of text",
+    )
+    parser.add_argument(
+        "--page_size", type=int, default=5000, help="mean characters per page"
+    )
+    parser.add_argument(
+        "--lookup",
+        type=str,
+        default=None,
+        help="also write a postcode lookup csv here, half of the postcodes in the text come from it",
+    )
+    parser.add_argument(
+        "--mixed_case",
+        action="store_true",
+        help="write some postcodes in lowercase or without space",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    lookup_postcodes = None
+    if args.lookup is not None:
+        lookup_postcodes = generate_lookup(args.lookup, seed=args.seed)
+    num_records = generate_segment(
+        args.output,
+        fmt=args.format,
+        seed=args.seed,
+        num_records=args.records,
+        couk_share=args.couk_share,
+        eng_share=args.eng_share,
+        postcode_density=args.postcode_density,
+        page_size=args.page_size,
+        lookup_postcodes=lookup_postcodes,
+        mixed_case=args.mixed_case,
+    )
+    print(f"Wrote {num_records} records to {args.output}")
@@ -0,0 +1,88 @@
+"""
+Stopping a run cleanly on SIGTERM or SIGUSR1 (e.g. at a SLURM time limit), with
+checkpoints to resume a segment at the record where it stopped
+"""
+
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import threading
+
+from datetime import datetime
+
+# SLURM sends SIGTERM at the time limit, and the signal of --signal (e.g. USR1)
+# the given number of seconds before it
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGUSR1)
+
+# set in every process once a stop signal arrived, inherited by forked workers
+_stop = threading.Event()
+
+
+def stop_requested():
+    return _stop.is_set()
+
+
+def request_stop(signum=None, frame=None):
+    """Signal handler: stop at the next record, and tell the worker processes"""
+    _stop.set()
+    if signum is not None:
+        for child in multiprocessing.active_children():
+            try:
+                os.kill(child.pid, signum)
+            except ProcessLookupError:
+                pass
+
+
+def install_stop_handlers():
+    """Handle STOP_SIGNALS with request_stop (from the main thread)"""
+    for signum in STOP_SIGNALS:
+        signal.signal(signum, request_stop)
+
+
+def checkpoint_path(csv_name):
+    return csv_name.replace(".csv", ".checkpoint")
+
+
+def write_checkpoint(csv_name, checkpoint):
+    """Save the checkpoint (a dict) of the segment of csv_name"""
+
+    checkpoint = dict(checkpoint, stopped=datetime.now().isoformat())
+    path = checkpoint_path(csv_name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f_out:
+        json.dump(checkpoint, f_out)
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(csv_name):
+    """The checkpoint of the segment of csv_name, or None if it was not stopped"""
+    try:
+        with open(checkpoint_path(csv_name), "r", encoding="utf-8") as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return None
+
+
+def remove_checkpoint(csv_name):
+    try:
+        os.remove(checkpoint_path(csv_name))
+    except FileNotFoundError:
+        pass
+
+
+def requeue_job(logger):
+    """Put the SLURM job of this process back in the queue. Returns whether it was"""
+
+    job_id = os.environ.get("SLURM_JOB_ID")
+    if job_id is None:
+        logger.warning("Not requeued: not running in a SLURM job")
+        return False
+    try:
+        subprocess.run(["scontrol", "requeue", job_id], check=True)
+    except (OSError, subprocess.CalledProcessError) as error:
+        logger.error(f"Could not requeue SLURM job {job_id}: {error}")
+        return False
+    logger.info(f"Requeued SLURM job {job_id}")
+    return True
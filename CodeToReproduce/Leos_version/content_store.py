@@ -0,0 +1,64 @@
+"""Content-addressed store for page bodies, so metadata csvs only carry a hash"""
+
+import gzip
+import hashlib
+import os
+import tempfile
+
+
+class ContentStore:
+    """Hash-keyed store of gzip-compressed page bodies.
+
+    Each body is written once to ``{root}/{hash[:2]}/{hash}.gz``. Storing an
+    identical body again, from another url or a later crawl, only returns the
+    existing hash, so duplicated pages cost one file.
+    """
+
+    def __init__(self, root, compresslevel=6):
+        self.root = root
+        self.compresslevel = compresslevel
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def hash_text(text):
+        """sha256 of the utf-8 encoded text"""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def path(self, content_hash):
+        """Path of the blob holding content_hash"""
+        return os.path.join(self.root, content_hash[:2], f"{content_hash}.gz")
+
+    def __contains__(self, content_hash):
+        return os.path.exists(self.path(content_hash))
+
+    def put(self, text):
+        """Store text if it is not already there and return its hash"""
+
+        content_hash = self.hash_text(text)
+        blob_path = self.path(content_hash)
+        if os.path.exists(blob_path):
+            return content_hash
+
+        blob_dir = os.path.dirname(blob_path)
+        os.makedirs(blob_dir, exist_ok=True)
+        # write to a temporary file and rename, so concurrent chunks writing
+        # the same body never leave a half-written blob behind
+        fd, tmp_path = tempfile.mkstemp(dir=blob_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw:
+                with gzip.GzipFile(
+                    fileobj=raw, mode="wb", compresslevel=self.compresslevel, mtime=0
+                ) as f_out:
+                    f_out.write(text.encode("utf-8"))
+            os.replace(tmp_path, blob_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return content_hash
+
+    def get(self, content_hash):
+        """Read back the text stored under content_hash"""
+
+        with gzip.open(self.path(content_hash), "rb") as f_in:
+            return f_in.read().decode("utf-8")
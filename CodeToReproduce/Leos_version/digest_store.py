@@ -0,0 +1,211 @@
+"""Persistent store of WARC-Block-Digests already processed in previous crawls"""
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import math
+import os
+
+from tqdm import tqdm
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, saved as a json header line plus the bit array"""
+
+    def __init__(self, capacity, error_rate=1e-6, num_bits=None, num_hashes=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        if num_bits is None:
+            num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        if num_hashes is None:
+            num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing: k positions from the two halves of one blake2b digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    def save(self, filename):
+        header = {
+            "capacity": self.capacity,
+            "error_rate": self.error_rate,
+            "num_bits": self.num_bits,
+            "num_hashes": self.num_hashes,
+            "count": self.count,
+        }
+        with open(filename, "wb") as f_out:
+            f_out.write(json.dumps(header).encode("utf-8") + b"\n")
+            f_out.write(self.bits)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as f_in:
+            header = json.loads(f_in.readline())
+            bloom = cls(
+                header["capacity"],
+                header["error_rate"],
+                num_bits=header["num_bits"],
+                num_hashes=header["num_hashes"],
+            )
+            bloom.bits = bytearray(f_in.read())
+        bloom.count = header["count"]
+        return bloom
+
+
+class DigestStore:
+    """
+    Results of previous runs keyed by WARC-Block-Digest.
+
+    Digests of pages without postcodes (the vast majority) go in a Bloom filter,
+    digests of pages with postcodes are kept exactly with their postcodes and
+    content hash. A Bloom false positive (probability error_rate) makes a new
+    page look unchanged and without postcodes.
+
+    Results depend on the postcode lookup, so keep one store per geography.
+    """
+
+    def __init__(self, bloom, matches=None):
+        self.bloom = bloom
+        self.matches = matches if matches is not None else {}
+
+    @classmethod
+    def empty(cls, capacity, error_rate=1e-6):
+        return cls(BloomFilter(capacity, error_rate))
+
+    @classmethod
+    def load(cls, store_dir):
+        bloom = BloomFilter.load(os.path.join(store_dir, "seen.bloom"))
+        matches = {}
+        with open(os.path.join(store_dir, "matches.csv"), "r", newline="") as f_in:
+            for digest, postcodes, content_hash in csv.reader(f_in):
+                matches[digest] = (postcodes.split(";"), content_hash or None)
+        return cls(bloom, matches)
+
+    def save(self, store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        self.bloom.save(os.path.join(store_dir, "seen.bloom"))
+        with open(os.path.join(store_dir, "matches.csv"), "w", newline="") as f_out:
+            csv_writer = csv.writer(f_out)
+            for digest, (postcodes, content_hash) in self.matches.items():
+                csv_writer.writerow([digest, ";".join(postcodes), content_hash or ""])
+
+    def add(self, digest, postcodes, content_hash=None):
+        """Record the result of one record"""
+        if postcodes:
+            self.matches[digest] = (list(postcodes), content_hash)
+        else:
+            self.bloom.add(digest)
+
+    def get(self, digest):
+        """
+        (postcodes, content_hash) from a previous run, postcodes being None if
+        the page had none, or None if the digest has not been seen
+        """
+        if not digest:
+            return None
+        match = self.matches.get(digest)
+        if match is not None:
+            return match
+        if digest in self.bloom:
+            return (None, None)
+        return None
+
+
+def read_digests_file(filename):
+    """Iterate over (digest, postcodes, content_hash) rows of a segment .digests sidecar"""
+
+    with open(filename, "r", newline="") as f_in:
+        for digest, postcodes, content_hash in csv.reader(f_in):
+            yield digest, postcodes.split(";") if postcodes else None, content_hash
+
+
+def build_digest_store(digests_pattern, store_dir, capacity=None, error_rate=1e-6):
+    """Add the .digests sidecars matching digests_pattern to the store in store_dir"""
+
+    digests_files = sorted(glob.glob(digests_pattern))
+    if not digests_files:
+        raise FileNotFoundError(f"No files matched pattern: {digests_pattern}")
+
+    if os.path.exists(os.path.join(store_dir, "seen.bloom")):
+        store = DigestStore.load(store_dir)
+    else:
+        if capacity is None:
+            # room for this run and as many records again from later crawls
+            capacity = 2 * sum(1 for f in digests_files for _ in open(f, "rb"))
+        store = DigestStore.empty(max(capacity, 1), error_rate)
+
+    for digests_file in tqdm(digests_files):
+        for digest, postcodes, content_hash in read_digests_file(digests_file):
+            store.add(digest, postcodes, content_hash or None)
+    if store.bloom.count > store.bloom.capacity:
+        print(
+            f"warning: {store.bloom.count} digests in a Bloom filter sized for "
+            f"{store.bloom.capacity}, false positive rate is above {error_rate}"
+        )
+    store.save(store_dir)
+    return store
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="Build or extend a digest store from the .digests files of previous runs"
+    )
+    parser.add_argument(
+        "--digests",
+        type=str,
+        default="outputs/*.digests",
+        help="glob pattern of the .digests files written by read_wet.py",
+    )
+    parser.add_argument(
+        "--store_dir",
+        type=str,
+        default="digest_store/",
+        help="directory of the digest store",
+    )
+    parser.add_argument(
+        "--capacity",
+        type=int,
+        default=None,
+        help="number of digests the Bloom filter is sized for, only used when creating the store",
+    )
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        default=1e-6,
+        help="Bloom filter false positive rate, only used when creating the store",
+    )
+    pars_args = parser.parse_args()
+    print("the inputs are:")
+    for arg in vars(pars_args):
+        print(f"{arg} is {getattr(pars_args, arg)}")
+    return pars_args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    store = build_digest_store(
+        args.digests, args.store_dir, args.capacity, args.error_rate
+    )
+    print(
+        f"{store.bloom.count} digests without postcodes, {len(store.matches)} with postcodes"
+    )
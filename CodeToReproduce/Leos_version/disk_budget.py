@@ -0,0 +1,171 @@
+"""Scratch space budget shared by the jobs of a node, so several crawls can run at once"""
+
+import fcntl
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+
+def default_ledger_path():
+    """Ledger of the node's disk budget, next to the rate limiter state"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, f"cc_filtering_disk_{os.getuid()}.json")
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class DiskBudget:
+    """
+    Bytes of scratch space taken by the segments in flight (downloaded or
+    decompressed and not yet removed) of every job sharing the ledger file path,
+    kept under max_bytes together. reserve(key, num_bytes) waits until num_bytes fit
+    in the budget and the filesystem of directory would keep min_free_bytes free
+    once every reservation is written, and release(key) gives them back once the
+    segment files are removed.
+    The ledger maps "host:pid:key" to [bytes reserved, bytes already written] and is
+    changed under flock; entries of processes of this host that died are dropped, so
+    a killed job frees its budget.
+    A reservation larger than the whole budget is admitted once nothing else is
+    reserved, instead of waiting forever.
+    Reservations start at an estimate of the bytes a segment takes, corrected by
+    fit(key, bytes_in) once its download size is known, with the ratio of disk
+    space to download size observed on the previous segments (see observe).
+    """
+
+    def __init__(
+        self,
+        max_bytes,
+        path=None,
+        directory=".",
+        min_free_bytes=0,
+        initial_estimate=400 * 1024**2,
+        initial_ratio=4.0,
+        poll_seconds=5.0,
+    ):
+        self.max_bytes = max_bytes
+        self.path = path or default_ledger_path()
+        self.directory = directory
+        self.min_free_bytes = min_free_bytes
+        self.poll_seconds = poll_seconds
+        self.prefix = f"{socket.gethostname()}:{os.getpid()}:"
+        self._estimate = initial_estimate
+        self._ratio = initial_ratio
+        self._observed = 0
+        self._lock = threading.Lock()
+
+    def _update(self, change):
+        """Apply change(ledger) -> result to the shared ledger, locked"""
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            with os.fdopen(os.dup(fd), "r+", encoding="utf-8") as f:
+                try:
+                    ledger = json.load(f)
+                except ValueError:
+                    ledger = {}
+                host = socket.gethostname()
+                for entry in list(ledger):
+                    entry_host, pid, _ = entry.split(":", 2)
+                    if entry_host == host and not pid_alive(int(pid)):
+                        del ledger[entry]
+                    elif isinstance(ledger[entry], int):
+                        # bytes only, from a ledger of an earlier version
+                        ledger[entry] = [ledger[entry], 0]
+                result = change(ledger)
+                f.seek(0)
+                f.truncate()
+                json.dump(ledger, f)
+            return result
+        finally:
+            os.close(fd)
+
+    def reserve(self, key, num_bytes=None, on_disk=False):
+        """
+        Wait until num_bytes (by default the estimate) are admitted. Returns seconds
+        waited. With on_disk, the bytes are already written (e.g. a segment resumed
+        from a checkpoint), so only the budget is checked, not the free space.
+        """
+
+        if num_bytes is None:
+            num_bytes = self.estimate()
+
+        def admit(ledger):
+            in_use = sum(reserved for reserved, _ in ledger.values())
+            # the free space does not show the reserved bytes still to be written
+            outstanding = sum(
+                max(reserved - written, 0) for reserved, written in ledger.values()
+            )
+            free = shutil.disk_usage(self.directory).free - outstanding
+            fits = in_use + num_bytes <= self.max_bytes or not ledger
+            if fits and (on_disk or free - num_bytes >= self.min_free_bytes):
+                ledger[self.prefix + key] = [num_bytes, num_bytes if on_disk else 0]
+                return True
+            return False
+
+        waited = 0.0
+        while not self._update(admit):
+            time.sleep(self.poll_seconds)
+            waited += self.poll_seconds
+        return waited
+
+    def resize(self, key, num_bytes, written=0):
+        """
+        Change the bytes held by key, e.g. once the download size is known, of which
+        written are on disk already
+        """
+
+        def change(ledger):
+            if self.prefix + key in ledger:
+                ledger[self.prefix + key] = [num_bytes, written]
+
+        self._update(change)
+
+    def release(self, key):
+        self._update(lambda ledger: ledger.pop(self.prefix + key, None))
+
+    def in_use(self):
+        """Bytes reserved by every job"""
+        return self._update(
+            lambda ledger: sum(reserved for reserved, _ in ledger.values())
+        )
+
+    def estimate(self):
+        """Bytes reserved for a segment whose download size is not known yet"""
+        with self._lock:
+            return self._estimate
+
+    def fit(self, key, bytes_in):
+        """
+        Resize the reservation of key to what a download of bytes_in should take,
+        the downloaded bytes being written
+        """
+        with self._lock:
+            num_bytes = int(bytes_in * self._ratio)
+        self.resize(key, num_bytes, written=bytes_in)
+
+    def observe(self, bytes_in, bytes_on_disk):
+        """
+        Learn from a processed segment: bytes_in downloaded, bytes_on_disk at most
+        on disk at once (e.g. the compressed and decompressed files)
+        """
+
+        if not bytes_in:
+            return
+        with self._lock:
+            self._observed += 1
+            # running means, over every segment seen
+            self._ratio += (bytes_on_disk / bytes_in - self._ratio) / self._observed
+            self._estimate += (bytes_on_disk - self._estimate) / self._observed
@@ -0,0 +1,53 @@
+"""How the segments of a run are extracted, set once for every segment"""
+
+
+class ExtractOptions:
+    """
+    Settings of the extraction of every segment of a run (see
+    read_wet.process_segment and read_wet.extract_from_segment):
+    - content_store (a ContentStore): texts go there, the csvs get their hash,
+    - aggregate_domains: one row per domain instead of one per page,
+    - digest_store (a DigestStore): results of records seen in earlier crawls are reused,
+    - record_index: an index of the records accepted by the headers is written,
+    - text_backend (one of read_wet.TEXT_BACKENDS): segments are WARC files, their
+      html turned into text with it,
+    - slow_record_seconds: slower records are logged,
+    - profile_fraction of the segments are profiled, sampling every profile_interval s,
+    - max_text_bytes and window_size bound the memory used per record,
+    - tolerant_postcodes: postcodes in any case and spacing are found as well,
+    - split: record ranges of a segment extracted on as many processes,
+    - inflate_threads and inflate_backend (one of inflate.INFLATE_BACKENDS):
+      how segments are decompressed.
+    """
+
+    def __init__(
+        self,
+        content_store=None,
+        aggregate_domains=False,
+        digest_store=None,
+        record_index=False,
+        text_backend=None,
+        slow_record_seconds=None,
+        profile_fraction=0.0,
+        profile_interval=0.005,
+        max_text_bytes=None,
+        window_size=1024 * 1024,
+        tolerant_postcodes=False,
+        split=1,
+        inflate_threads=1,
+        inflate_backend="zlib",
+    ):
+        self.content_store = content_store
+        self.aggregate_domains = aggregate_domains
+        self.digest_store = digest_store
+        self.record_index = record_index
+        self.text_backend = text_backend
+        self.slow_record_seconds = slow_record_seconds
+        self.profile_fraction = profile_fraction
+        self.profile_interval = profile_interval
+        self.max_text_bytes = max_text_bytes
+        self.window_size = window_size
+        self.tolerant_postcodes = tolerant_postcodes
+        self.split = split
+        self.inflate_threads = inflate_threads
+        self.inflate_backend = inflate_backend
@@ -0,0 +1,368 @@
+"""Composable record filters, reordered while running so cheap and selective ones go first"""
+
+import math
+
+from time import perf_counter
+
+from helper_functions import (
+    postcode_finder,
+    postcode_finder_windows,
+    postcode_matches,
+    postcode_scanner,
+    tolerant_postcode_matches,
+)
+from postcode_index import PostcodeIndex
+
+
+class RecordContext:
+    """
+    One WET (or WARC) record as seen by the filters. The text, its lowercase version and
+    the postcode candidates are computed on first use and shared by every
+    filter and profile. load_time accumulates the time spent computing them,
+    so it is not charged to whichever filter happened to need them first.
+    read_time is the part of it spent reading and decoding the body.
+    With max_text_bytes, memory per record is bounded: the text is the start of
+    the body, and postcode candidates of a longer WET body are found by scanning
+    the rest in windows. Keywords and stored text only see the start of the body.
+    """
+
+    def __init__(
+        self,
+        record,
+        digest_store=None,
+        text_backend=None,
+        max_text_bytes=None,
+        window_size=1024 * 1024,
+        tolerant_postcodes=False,
+    ):
+        self.record = record
+        headers = record.rec_headers
+        self.uri = headers.get_header("WARC-Target-URI")
+        self.language = headers.get_header("WARC-Identified-Content-Language")
+        # warc response records carry no identified language, only wet records do
+        self.language_known = (
+            record.rec_type == "conversion" or self.language is not None
+        )
+        self.digest = headers.get_header("WARC-Block-Digest")
+        self.content_length = int(headers.get_header("Content-Length") or 0)
+        self.digest_store = digest_store
+        # function html bytes -> text, for warc response records
+        self.text_backend = text_backend
+        # only the first max_text_bytes of the body become the text, the rest
+        # is only scanned for postcodes, window_size bytes at a time
+        self.max_text_bytes = max_text_bytes
+        self.window_size = window_size
+        # the body continues past the text
+        self.truncated = False
+        # candidates from postcode_scanner (any case and spacing) instead of postcode_finder
+        self.tolerant_postcodes = tolerant_postcodes
+        # True once a profile accepted the headers and needs the content
+        self.reached_content = False
+        # (postcodes, content_hash) from a previous crawl with the same text
+        self.known = None
+        self.load_time = 0.0
+        self.read_time = 0.0
+        self._text = None
+        self._lower_text = None
+        self._candidates = None
+        self._stream = None
+        self._body_start = None
+
+    def enter_content_stage(self):
+        if self.reached_content:
+            return
+        self.reached_content = True
+        if self.digest_store is not None:
+            self.known = self.digest_store.get(self.digest)
+
+    @property
+    def text(self):
+        if self._text is None:
+            start = perf_counter()
+            self._stream = self.record.content_stream()
+            if self.max_text_bytes is None:
+                body = self._stream.read()
+            else:
+                body = self._stream.read(self.max_text_bytes)
+                self.truncated = len(body) == self.max_text_bytes
+                if self.truncated:
+                    self._body_start = body
+            if self.text_backend is None:
+                self._text = body.decode("utf-8", "ignore")
+            else:
+                self._text = self.text_backend(body)
+            elapsed = perf_counter() - start
+            self.load_time += elapsed
+            self.read_time += elapsed
+        return self._text
+
+    @property
+    def lower_text(self):
+        if self._lower_text is None:
+            text = self.text
+            start = perf_counter()
+            self._lower_text = text.lower()
+            self.load_time += perf_counter() - start
+        return self._lower_text
+
+    @property
+    def candidates(self):
+        """Postcode-shaped strings of the text"""
+        if self._candidates is None:
+            text = self.text
+            start = perf_counter()
+            if self.truncated and self.text_backend is None:
+                # html of a WARC record cannot be scanned piecewise, it is cut instead
+                self._candidates = postcode_finder_windows(
+                    self._body_windows(),
+                    matches=(
+                        tolerant_postcode_matches
+                        if self.tolerant_postcodes
+                        else postcode_matches
+                    ),
+                )
+            elif self.tolerant_postcodes:
+                self._candidates = postcode_scanner(text)
+            else:
+                self._candidates = postcode_finder(text)
+            self.load_time += perf_counter() - start
+        return self._candidates
+
+    def _body_windows(self):
+        """The start of the body, then the rest of it window_size bytes at a time"""
+        yield self._body_start
+        self._body_start = None
+        while True:
+            window = self._stream.read(self.window_size)
+            if not window:
+                return
+            yield window
+
+    @property
+    def num_candidates(self):
+        """Number of postcode candidates, None if no filter needed them"""
+        if self._candidates is None:
+            return None
+        return len(self._candidates)
+
+
+class Predicate:
+    """
+    A record filter. test returns a falsy value to reject the record.
+    Predicates with needs_text read the record body, the others only its headers.
+    """
+
+    name = "predicate"
+    needs_text = False
+
+    def __init__(self):
+        self.records_in = 0
+        self.records_out = 0
+        self.seconds = 0.0
+
+    def test(self, ctx):
+        raise NotImplementedError
+
+    @property
+    def pass_rate(self):
+        return self.records_out / self.records_in if self.records_in else 1.0
+
+    @property
+    def cost(self):
+        """Mean seconds per record"""
+        return self.seconds / self.records_in if self.records_in else 0.0
+
+    def rank(self):
+        """
+        Expected cost of rejecting a record (cost / fraction rejected). Running
+        independent filters by increasing rank minimises the expected total cost.
+        """
+        rejected = 1.0 - self.pass_rate
+        return self.cost / rejected if rejected > 0 else math.inf
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r})"
+
+
+class UrlContains(Predicate):
+    """Url contains rule, e.g. ".co.uk/" """
+
+    name = "url"
+
+    def __init__(self, rule):
+        super().__init__()
+        self.rule = rule
+
+    def test(self, ctx):
+        return self.rule in ctx.uri
+
+
+class LanguageIs(Predicate):
+    """
+    Identified content language is language, e.g. "eng". Records with no way to
+    know the language (warc response records) are let through.
+    """
+
+    name = "language"
+
+    def __init__(self, language):
+        super().__init__()
+        self.language = language
+
+    def test(self, ctx):
+        return ctx.language == self.language or not ctx.language_known
+
+
+class ContentLength(Predicate):
+    """Content-Length header (bytes of text) between min_length and max_length"""
+
+    name = "content_length"
+
+    def __init__(self, min_length=None, max_length=None):
+        super().__init__()
+        self.min_length = min_length
+        self.max_length = max_length
+
+    def test(self, ctx):
+        if self.min_length is not None and ctx.content_length < self.min_length:
+            return False
+        if self.max_length is not None and ctx.content_length > self.max_length:
+            return False
+        return True
+
+
+class Keywords(Predicate):
+    """Lowercase text contains at least one of keywords"""
+
+    name = "keywords"
+    needs_text = True
+
+    def __init__(self, keywords):
+        super().__init__()
+        self.keywords = [keyword.lower() for keyword in keywords]
+
+    def test(self, ctx):
+        text = ctx.lower_text
+        return any(keyword in text for keyword in self.keywords)
+
+
+class PostcodeGeography(Predicate):
+    """
+    Postcodes of the text that are in postcodes (and start with prefix), None if none.
+    postcodes can be a PostcodeIndex, used as is, or any iterable, made a frozenset.
+    """
+
+    name = "postcodes"
+    needs_text = True
+
+    def __init__(self, postcodes, prefix=None):
+        super().__init__()
+        self.postcodes = (
+            postcodes if isinstance(postcodes, PostcodeIndex) else frozenset(postcodes)
+        )
+        self.prefix = prefix
+
+    def test(self, ctx):
+        matches = [
+            postcode
+            for postcode in ctx.candidates
+            if (self.prefix is None or postcode.startswith(self.prefix))
+            and postcode in self.postcodes
+        ]
+        if matches:
+            return matches
+
+
+class FilterPipeline:
+    """
+    Runs predicates in order until one rejects the record, counting records in
+    and out and time spent per predicate. Every reorder_every records the
+    predicates are sorted by rank, header predicates always before text
+    predicates, as the first text predicate pays for reading the body.
+    run returns the value of the postcodes predicate (True if there is none),
+    or None if the record is rejected. headers_passed tells whether the last
+    record run passed the header predicates.
+    """
+
+    def __init__(self, predicates, reorder_every=1000):
+        self.header_predicates = [p for p in predicates if not p.needs_text]
+        self.text_predicates = [p for p in predicates if p.needs_text]
+        self.reorder_every = reorder_every
+        self.records = 0
+        self.headers_passed = False
+
+    @property
+    def predicates(self):
+        return self.header_predicates + self.text_predicates
+
+    def _evaluate(self, predicate, ctx):
+        load_time = ctx.load_time
+        start = perf_counter()
+        value = predicate.test(ctx)
+        # time spent reading the body or finding candidates is shared, not the predicate's
+        predicate.seconds += perf_counter() - start - (ctx.load_time - load_time)
+        return value
+
+    def run(self, ctx):
+        self.records += 1
+        if self.reorder_every and self.records % self.reorder_every == 0:
+            self.reorder()
+
+        self.headers_passed = False
+        for predicate in self.header_predicates:
+            predicate.records_in += 1
+            if not self._evaluate(predicate, ctx):
+                return None
+            predicate.records_out += 1
+        self.headers_passed = True
+
+        ctx.enter_content_stage()
+        result = True
+        for predicate in self.text_predicates:
+            predicate.records_in += 1
+            if ctx.known is not None:
+                # same text as in a previous crawl: its postcodes decide every text predicate
+                value = ctx.known[0]
+            else:
+                value = self._evaluate(predicate, ctx)
+            if not value:
+                return None
+            predicate.records_out += 1
+            if isinstance(predicate, PostcodeGeography):
+                result = value
+        return result
+
+    def reorder(self):
+        self.header_predicates.sort(key=Predicate.rank)
+        self.text_predicates.sort(key=Predicate.rank)
+
+    def summary(self):
+        """One line per predicate, in the current order"""
+        return [
+            f"{p.name}: {p.records_in} in, {p.records_out} out "
+            f"({p.pass_rate:.1%} pass), {p.cost * 1e6:.1f} us/record"
+            for p in self.predicates
+        ]
+
+    def counts(self):
+        """Dictionary predicate name -> [records in, records out, seconds]"""
+        return {
+            p.name: [p.records_in, p.records_out, p.seconds] for p in self.predicates
+        }
+
+    def add_counts(self, counts):
+        """Add counts of the same pipeline run elsewhere (e.g. in a worker process)"""
+        for p in self.predicates:
+            if p.name in counts:
+                records_in, records_out, seconds = counts[p.name]
+                p.records_in += records_in
+                p.records_out += records_out
+                p.seconds += seconds
+
+
+def subtract_counts(after, before):
+    """Counts of FilterPipeline.counts() between two calls"""
+    return {
+        name: [a - b for a, b in zip(values, before.get(name, [0, 0, 0.0]))]
+        for name, values in after.items()
+    }
@@ -0,0 +1,240 @@
+"""Seekable zstd container of page texts, with a dictionary trained per crawl and an index of the frames"""
+
+import argparse
+import csv
+import hashlib
+import os
+import random
+import struct
+import sys
+
+import zstandard
+
+# index entry: sha256 digest of the text, offset and length of its frame
+INDEX_ENTRY = struct.Struct(">32sQI")
+
+
+class FrameStore:
+    """
+    Page texts of one crawl in {root}/{name}.zst, one zstd frame per distinct text,
+    compressed with the dictionary {name}.dict trained on a sample of the texts.
+    {name}.idx lists the (sha256 digest, offset, length) of every frame sorted by
+    digest, so a page is read with a binary search of the index, one seek and the
+    decompression of its frame alone. Record ids are the sha256 of the text, the
+    same as ContentStore hashes.
+    """
+
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+        self._decompressor = None
+
+    def path(self, extension):
+        return os.path.join(self.root, f"{self.name}.{extension}")
+
+    @staticmethod
+    def hash_text(text):
+        """sha256 of the utf-8 encoded text"""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _find(self, record_id):
+        """(offset, length) of the frame of record_id, None if it is not stored"""
+
+        digest = bytes.fromhex(record_id)
+        with open(self.path("idx"), "rb") as index:
+            low, high = 0, os.fstat(index.fileno()).st_size // INDEX_ENTRY.size
+            while low < high:
+                middle = (low + high) // 2
+                index.seek(middle * INDEX_ENTRY.size)
+                entry_digest, offset, length = INDEX_ENTRY.unpack(
+                    index.read(INDEX_ENTRY.size)
+                )
+                if entry_digest == digest:
+                    return offset, length
+                if entry_digest < digest:
+                    low = middle + 1
+                else:
+                    high = middle
+        return None
+
+    def __contains__(self, record_id):
+        return self._find(record_id) is not None
+
+    def get(self, record_id):
+        """Text stored under record_id"""
+
+        location = self._find(record_id)
+        if location is None:
+            raise KeyError(record_id)
+        offset, length = location
+        if self._decompressor is None:
+            with open(self.path("dict"), "rb") as f_in:
+                dictionary_data = f_in.read()
+            # an empty dictionary file: the frames were written without dictionary
+            dictionary = (
+                zstandard.ZstdCompressionDict(dictionary_data)
+                if dictionary_data
+                else None
+            )
+            self._decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+        with open(self.path("zst"), "rb") as container:
+            container.seek(offset)
+            frame = container.read(length)
+        return self._decompressor.decompress(frame).decode("utf-8")
+
+    def write(self, texts, dictionary, level=9):
+        """
+        Write the container and index of texts (an iterable), compressed with
+        dictionary (see train_dictionary, None for no dictionary). Yields the record
+        id of every text.
+        """
+
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.path("dict"), "wb") as f_out:
+            if dictionary is not None:
+                f_out.write(dictionary.as_bytes())
+        compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+        entries = {}
+        with open(self.path("zst"), "wb") as container:
+            for text in texts:
+                data = text.encode("utf-8")
+                digest = hashlib.sha256(data).digest()
+                if digest not in entries:
+                    frame = compressor.compress(data)
+                    entries[digest] = (container.tell(), len(frame))
+                    container.write(frame)
+                yield digest.hex()
+        with open(self.path("idx"), "wb") as index:
+            for digest in sorted(entries):
+                index.write(INDEX_ENTRY.pack(digest, *entries[digest]))
+        self._decompressor = None
+
+
+def train_dictionary(
+    texts, dict_size=112640, num_samples=10000, sample_bytes=65536, seed=0
+):
+    """
+    zstd dictionary trained on up to num_samples texts drawn uniformly from texts
+    (reservoir sampling, so texts can be any iterable), each cut to sample_bytes.
+    None if there is not enough text to train one.
+    """
+
+    rng = random.Random(seed)
+    samples = []
+    for i, text in enumerate(texts):
+        sample = text.encode("utf-8")[:sample_bytes]
+        if len(samples) < num_samples:
+            samples.append(sample)
+        else:
+            j = rng.randrange(i + 1)
+            if j < num_samples:
+                samples[j] = sample
+    try:
+        return zstandard.train_dictionary(dict_size, samples)
+    except zstandard.ZstdError:
+        # too few or too small samples to train on, the frames go without dictionary
+        return None
+
+
+def read_column(csv_filename, column):
+    """Values of column in csv_filename, one row at a time"""
+    with open(csv_filename, "r", newline="", encoding="utf-8") as f_in:
+        csv_reader = csv.reader(f_in)
+        position = next(csv_reader).index(column)
+        for row in csv_reader:
+            yield row[position]
+
+
+def pack_csv(
+    csv_filename, root, name, content_column="content", level=9, dict_size=112640
+):
+    """
+    Move the page texts of csv_filename (e.g. a df{crawl}.csv) into the FrameStore
+    root/name, and replace them in the csv with their record id, in a content_hash
+    column. Returns the FrameStore.
+    """
+
+    csv.field_size_limit(sys.maxsize)
+    dictionary = train_dictionary(read_column(csv_filename, content_column), dict_size)
+    store = FrameStore(root, name)
+    record_ids = store.write(
+        read_column(csv_filename, content_column), dictionary, level
+    )
+
+    tmp_filename = csv_filename + ".tmp"
+    with open(csv_filename, "r", newline="", encoding="utf-8") as f_in, open(
+        tmp_filename, "w", newline="", encoding="utf-8"
+    ) as f_out:
+        csv_reader = csv.reader(f_in)
+        csv_writer = csv.writer(f_out)
+        header = next(csv_reader)
+        position = header.index(content_column)
+        header[position] = "content_hash"
+        csv_writer.writerow(header)
+        for row, record_id in zip(csv_reader, record_ids):
+            row[position] = record_id
+            csv_writer.writerow(row)
+        # let the generator finish, which writes the index
+        for _ in record_ids:
+            pass
+    os.replace(tmp_filename, csv_filename)
+    return store
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="Pack the page texts of a merged csv into a seekable zstd container, or read one page back"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack = subparsers.add_parser(
+        "pack", help="move the texts of a csv into a container"
+    )
+    pack.add_argument(
+        "--csv", type=str, required=True, help="merged csv, e.g. df202350.csv"
+    )
+    pack.add_argument(
+        "--root", type=str, default="frames/", help="directory of the containers"
+    )
+    pack.add_argument(
+        "--name",
+        type=str,
+        required=True,
+        help="name of the container, e.g. the crawl 202350",
+    )
+    pack.add_argument("--content_column", type=str, default="content")
+    pack.add_argument("--level", type=int, default=9, help="zstd compression level")
+    pack.add_argument(
+        "--dict_size", type=int, default=112640, help="dictionary size in bytes"
+    )
+    get = subparsers.add_parser("get", help="print the text of a record id")
+    get.add_argument(
+        "--root", type=str, default="frames/", help="directory of the containers"
+    )
+    get.add_argument("--name", type=str, required=True, help="name of the container")
+    get.add_argument("record_id", type=str, help="content_hash of the page")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "pack":
+        csv_size = os.path.getsize(args.csv)
+        store = pack_csv(
+            args.csv,
+            args.root,
+            args.name,
+            args.content_column,
+            args.level,
+            args.dict_size,
+        )
+        packed_size = sum(
+            os.path.getsize(store.path(extension))
+            for extension in ["zst", "idx", "dict"]
+        )
+        print(
+            f"Packed {csv_size} bytes of csv into {packed_size} bytes of container "
+            f"and {os.path.getsize(args.csv)} bytes of csv"
+        )
+    else:
+        print(FrameStore(args.root, args.name).get(args.record_id))
@@ -1,9 +1,27 @@
 """Script with helper functions for wet downloader routines"""
 
+import codecs
 import gzip
 import os
 import re
 import shutil
+import zlib
+
+from urllib.parse import urlsplit
+
+POSTCODE_PATTERN = re.compile(r"\b[A-Z]{1,2}[0-9][A-Z0-9]? [0-9][ABD-HJLNP-UW-Z]{2}\b")
+# postcodes in any case with zero to two spaces (or non-breaking spaces), from the
+# digit of the outward code: digits are rare in text, so the regex skips most of it
+# without trying a match, and the letters before the digit are checked in python
+TOLERANT_POSTCODE_PATTERN = re.compile(
+    r"([0-9][A-Za-z0-9]?)[ \xa0]{0,2}([0-9][ABD-HJLNP-UW-Zabd-hjlnp-uw-z]{2})(?!\w)"
+)
+# longest postcode either pattern matches, e.g. "AB12  3DE"
+POSTCODE_MAX_LENGTH = 9
+# gzip magic number and deflate method, the start of every gzip member
+GZIP_MAGIC = b"\x1f\x8b\x08"
+# small reads, as the rest of a read is copied at the end of every member
+GZIP_CHUNK_SIZE = 64 * 1024
 
 
 def Bristol_postcode_finder(text, BristolPostcodeLookup):
@@ -22,6 +40,20 @@ def Bristol_postcode_finder(text, BristolPostcodeLookup):
         return matches
 
 
+def UK_postcode_finder(text, UK_PostcodeLookup):
+    """Finder of UK postcodes"""
+
+    postcodes = postcode_finder(text)
+    # Filter postcodes to only include those found in UK_PostcodeLookup['pcds']
+    matches = [
+        postcode
+        for postcode in postcodes
+        if postcode in UK_PostcodeLookup["pcds"].values
+    ]
+    if matches:
+        return matches
+
+
 def count_lines(filepath):
     """function to count the lines of wet paths in a wet.paths file"""
 
@@ -38,22 +70,144 @@ def count_lines(filepath):
 
 
 def construct_output_filename(wet_path, crawl):
-    """function to extract segment from wet path and create an output filename"""
-    match = re.search(r"(\d{5})(?=\.warc\.wet\.gz)", wet_path)
+    """function to extract segment from wet (or warc) path and create an output filename"""
+    match = re.search(r"(\d{5})\.warc(\.wet)?\.gz", wet_path)
     if match:
         segment = match.group(1)
-        return f"crawldata{crawl}segment{segment}.wet"
+        extension = "wet" if match.group(2) else "warc"
+        return f"crawldata{crawl}segment{segment}.{extension}"
     else:
         return None
 
 
-def decompress_gzip(filename_gz, out_filename):
-    """function to decompress the gz file"""
+def decompress_gzip(filename_gz, out_filename, skip_corrupt=False, backend=zlib):
+    """
+    function to decompress the gz file.
+    With skip_corrupt, a damaged gzip member (one record in WET and WARC files) is
+    left out and decompression goes on from the next member header, and a truncated
+    last member is dropped, inflating with backend (see inflate.INFLATE_BACKENDS).
+    Returns the number of members left out.
+    """
+
+    if not skip_corrupt:
+        with gzip.open(filename_gz, "rb") as f_in:
+            with open(out_filename, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        os.remove(filename_gz)
+        return 0
 
-    with gzip.open(filename_gz, "rb") as f_in:
-        with open(out_filename, "wb") as f_out:
-            shutil.copyfileobj(f_in, f_out)
+    with open(filename_gz, "rb") as f_in, open(out_filename, "wb") as f_out:
+        skipped = inflate_gzip_members(f_in, f_out, backend=backend)
     os.remove(filename_gz)
+    return skipped
+
+
+def inflate_gzip_members(f_in, f_out, start=0, end=None, backend=zlib):
+    """
+    Decompress the gzip members of f_in from offset start (a member header) to end
+    (by default the end of the file) to f_out, leaving out damaged members and a
+    truncated last member (see decompress_gzip). backend is zlib or a module with
+    its interface (decompressobj and error). Returns the number left out.
+    """
+
+    def read():
+        if end is None:
+            return f_in.read(GZIP_CHUNK_SIZE)
+        return f_in.read(max(min(GZIP_CHUNK_SIZE, end - f_in.tell()), 0))
+
+    skipped = 0
+    f_in.seek(start)
+    # compressed offset of the start of data, and where the current member
+    # starts in the compressed and the decompressed file
+    position = member_in = start
+    member_out = f_out.tell()
+    decompressor = backend.decompressobj(31)
+    data = read()
+    while data:
+        try:
+            f_out.write(decompressor.decompress(data))
+        except backend.error:
+            skipped += 1
+            f_out.seek(member_out)
+            f_out.truncate()
+            position = find_gzip_member(f_in, member_in + 1)
+            if position is not None and end is not None and position >= end:
+                position = None
+            member_in = position
+            decompressor = backend.decompressobj(31)
+            data = read() if position is not None else b""
+            continue
+        if decompressor.eof:
+            unused = decompressor.unused_data
+            position += len(data) - len(unused)
+            member_in = position
+            member_out = f_out.tell()
+            decompressor = backend.decompressobj(31)
+            data = unused or read()
+        else:
+            position += len(data)
+            data = read()
+    if position is not None and position > member_in:
+        # the file (or range) ended inside a member
+        skipped += 1
+        f_out.seek(member_out)
+        f_out.truncate()
+    return skipped
+
+
+def find_gzip_member(f_in, start):
+    """Offset of the first gzip member header of f_in from start, or None"""
+
+    f_in.seek(start)
+    offset = start
+    tail = b""
+    while True:
+        block = f_in.read(GZIP_CHUNK_SIZE)
+        if not block:
+            return None
+        data = tail + block
+        found = data.find(GZIP_MAGIC)
+        if found >= 0:
+            f_in.seek(offset - len(tail) + found)
+            return offset - len(tail) + found
+        # a header may start in the last bytes of the block
+        tail = data[-(len(GZIP_MAGIC) - 1) :]
+        offset += len(block)
+
+
+def is_gzip_member(f_in, offset, prefix=b"WARC/"):
+    """Whether a gzip member starting with prefix (a WARC record) starts at offset"""
+
+    f_in.seek(offset)
+    try:
+        head = zlib.decompressobj(31).decompress(
+            f_in.read(GZIP_CHUNK_SIZE), len(prefix)
+        )
+    except zlib.error:
+        return False
+    return head == prefix
+
+
+def split_gzip_members(filename_gz, parts):
+    """
+    Split a multi-member gzip file (a WET or WARC segment, one member per record)
+    into at most parts (start, end) byte ranges of about the same size, starting on
+    member headers, so each range can be decompressed and read on its own
+    """
+
+    size = os.path.getsize(filename_gz)
+    starts = [0]
+    with open(filename_gz, "rb") as f_in:
+        for part in range(1, parts):
+            offset = max(size * part // parts, starts[-1] + 1)
+            offset = find_gzip_member(f_in, offset)
+            # the magic bytes also occur inside compressed data
+            while offset is not None and not is_gzip_member(f_in, offset):
+                offset = find_gzip_member(f_in, offset + 1)
+            if offset is None:
+                break
+            starts.append(offset)
+    return list(zip(starts, starts[1:] + [size]))
 
 
 def extract_website(url):
@@ -64,11 +218,90 @@ def extract_website(url):
     return website
 
 
+def is_landing_page(url, url_rule=".co.uk/"):
+    """
+    Whether url is the landing page of a website of url_rule: nothing after the rule
+    when it ends the host (e.g. nothing after .co.uk/), an empty path otherwise
+    """
+
+    if url_rule.endswith("/"):
+        return url.endswith(url_rule)
+    parts = urlsplit(url)
+    return parts.path in ("", "/") and not parts.query
+
+
 def postcode_finder(text):
     """UK postcode finder (AB12C 3DE)"""
 
-    postcodes = re.findall(
-        r"\b[A-Z]{1,2}[0-9][A-Z0-9]? [0-9][ABD-HJLNP-UW-Z]{2}\b", text
-    )
+    postcodes = POSTCODE_PATTERN.findall(text)
     # https://stackoverflow.com/questions/378157/python-regular-expression-postcode-search
     return list(set(postcodes))
+
+
+def _is_ascii_letter(char):
+    return "a" <= char <= "z" or "A" <= char <= "Z"
+
+
+def postcode_matches(text):
+    """(start, end, postcode) of the matches of postcode_finder"""
+    for match in POSTCODE_PATTERN.finditer(text):
+        yield match.start(), match.end(), match.group()
+
+
+def tolerant_postcode_matches(text):
+    """(start, end, postcode in pcds form) of the matches of postcode_scanner"""
+    for match in TOLERANT_POSTCODE_PATTERN.finditer(text):
+        digit = match.start()
+        start = digit - 1
+        if start < 0 or not _is_ascii_letter(text[start]):
+            continue
+        if start > 0 and _is_ascii_letter(text[start - 1]):
+            start -= 1
+        # the letters start a word, as \b in POSTCODE_PATTERN
+        if start > 0 and (text[start - 1].isalnum() or text[start - 1] == "_"):
+            continue
+        outward = text[start:digit] + match.group(1)
+        yield start, match.end(), f"{outward.upper()} {match.group(2).upper()}"
+
+
+def postcode_scanner(text):
+    """
+    UK postcode finder tolerant to case and spacing: "bs1 1aa", "BS11AA" and
+    "Bs1  1aA" are all found, as "BS1 1AA" (the pcds form of the lookups), in
+    a single pass over the text. Finds everything postcode_finder finds.
+    """
+
+    return list({postcode for _, _, postcode in tolerant_postcode_matches(text)})
+
+
+def postcode_finder_windows(
+    chunks, overlap=POSTCODE_MAX_LENGTH + 1, matches=postcode_matches
+):
+    """
+    postcode_finder over utf-8 bytes given as an iterable of chunks, e.g. a record
+    body read in fixed-size windows, so the whole text is never in memory
+    (postcode_scanner with matches=tolerant_postcode_matches).
+    The last overlap characters of each window are scanned again with the next one,
+    so postcodes across a window boundary are found (overlap must be longer than
+    a postcode). A match touching either edge of a window is only kept when the
+    character past that edge is known, so the cut is not taken for a word boundary.
+    """
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    postcodes = set()
+    carry = ""
+    # position of text in the whole text, a match at its start is cut unless it is 0
+    text_start = 0
+    chunks = iter(chunks)
+    chunk = next(chunks, None)
+    while chunk is not None:
+        next_chunk = next(chunks, None)
+        last = next_chunk is None
+        text = carry + decoder.decode(chunk, final=last)
+        for start, end, postcode in matches(text):
+            if (start > 0 or text_start == 0) and (end < len(text) or last):
+                postcodes.add(postcode)
+        carry = text[-overlap:]
+        text_start += len(text) - len(carry)
+        chunk = next_chunk
+    return list(postcodes)
@@ -0,0 +1,434 @@
+"""
+Downloads over pooled keep-alive connections, within a rate limit shared by every
+process of the node, backing off on 503, 429 and Retry-After
+"""
+
+import argparse
+import fcntl
+import http.client
+import os
+import random
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+# statuses worth retrying, the server is overloaded or briefly unavailable
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# errors of a pooled connection the server closed while it was idle
+STALE_ERRORS = (BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+
+def default_limiter_path():
+    """State file of the node's rate limiter, in memory (/dev/shm) where possible"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, f"cc_filtering_rate_{os.getuid()}")
+
+
+def node_limiter(path=None, bytes_per_second=None, requests_per_second=None):
+    """
+    The NodeRateLimiter of the node, or None without any limit, so downloads take
+    no lock on its state file (a Retry-After then only pauses the process)
+    """
+    if bytes_per_second is None and requests_per_second is None:
+        return None
+    return NodeRateLimiter(path, bytes_per_second, requests_per_second)
+
+
+class NodeRateLimiter:
+    """
+    Token buckets of bytes_per_second and requests_per_second (None for no limit)
+    shared by every process of the node, each holding burst_seconds of tokens at
+    most. The state lives in the small file path, read and updated under flock, and
+    also holds the time until which the server asked to wait (Retry-After), so one
+    503 pauses every worker of the node instead of each finding out on its own.
+    """
+
+    # byte tokens, request tokens, time of the last refill, time the node may resume
+    STATE = struct.Struct("dddd")
+
+    def __init__(
+        self,
+        path=None,
+        bytes_per_second=None,
+        requests_per_second=None,
+        burst_seconds=1.0,
+    ):
+        self.path = path or default_limiter_path()
+        self.bytes_per_second = bytes_per_second
+        self.requests_per_second = requests_per_second
+        self.burst_seconds = burst_seconds
+
+    def _update(self, change):
+        """Apply change(state, now) -> (state, result) to the shared state, locked"""
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, self.STATE.size, 0)
+            now = time.time()
+            if len(data) == self.STATE.size:
+                state = list(self.STATE.unpack(data))
+            else:
+                state = [0.0, 0.0, now, 0.0]
+            state, result = change(state, now)
+            os.pwrite(fd, self.STATE.pack(*state), 0)
+            return result
+        finally:
+            os.close(fd)
+
+    def _refill(self, state, now):
+        byte_tokens, request_tokens, last, blocked_until = state
+        elapsed = max(now - last, 0.0)
+        if self.bytes_per_second:
+            byte_tokens = min(
+                byte_tokens + elapsed * self.bytes_per_second,
+                self.burst_seconds * self.bytes_per_second,
+            )
+        if self.requests_per_second:
+            request_tokens = min(
+                request_tokens + elapsed * self.requests_per_second,
+                max(self.burst_seconds * self.requests_per_second, 1.0),
+            )
+        return [byte_tokens, request_tokens, now, blocked_until]
+
+    def acquire(self, num_bytes=0, requests=0):
+        """
+        Wait until the node may send requests and receive num_bytes. Tokens may go
+        negative, so a chunk larger than the burst still passes, and the next
+        caller waits for the debt. Returns the seconds waited.
+        """
+
+        def take(state, now):
+            state = self._refill(state, now)
+            byte_tokens, request_tokens, last, blocked_until = state
+            wait = max(blocked_until - now, 0.0)
+            if self.bytes_per_second and byte_tokens < 0:
+                wait = max(wait, -byte_tokens / self.bytes_per_second)
+            if self.requests_per_second and requests and request_tokens < 0:
+                wait = max(wait, -request_tokens / self.requests_per_second)
+            if wait == 0:
+                if self.bytes_per_second:
+                    byte_tokens -= num_bytes
+                if self.requests_per_second:
+                    request_tokens -= requests
+            return [byte_tokens, request_tokens, last, blocked_until], wait
+
+        if not (self.bytes_per_second or self.requests_per_second or requests):
+            return 0.0
+        waited = 0.0
+        while True:
+            wait = self._update(take)
+            if wait == 0:
+                return waited
+            # another process may have paid the debt meanwhile, look again soon
+            wait = min(wait, 1.0)
+            time.sleep(wait)
+            waited += wait
+
+    def block_until(self, resume_time):
+        """Hold every request of the node until resume_time (unix seconds)"""
+
+        def block(state, now):
+            state[3] = max(state[3], resume_time)
+            return state, None
+
+        self._update(block)
+
+
+def retry_after_seconds(value):
+    """Seconds to wait from a Retry-After header (seconds or an HTTP date), or None"""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def content_range_start(value):
+    """First byte of a Content-Range header (bytes start-end/size), or None"""
+    if value is None:
+        return None
+    match = re.match(r"bytes\s+(\d+)-\d+/(\d+|\*)", value.strip())
+    return int(match.group(1)) if match else None
+
+
+class RetryableResponse(Exception):
+    """A response with a status of RETRY_STATUSES, and its Retry-After in seconds"""
+
+    def __init__(self, status, retry_after):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class HttpClient:
+    """
+    Downloads through keep-alive connections, at most max_connections per host kept
+    open for reuse by the threads of the process. Responses of RETRY_STATUSES and
+    connection errors are retried up to retries times, after the Retry-After of the
+    response (which then pauses the whole node, see NodeRateLimiter) or after an
+    exponential backoff with jitter, and an interrupted download resumes with a
+    Range request, or starts again if the server answers another range. A pooled
+    connection the server closed while idle is replaced by a new one once, without
+    counting a retry. With a limiter, every request and every chunk read goes through
+    it. URLs other than http(s), e.g. file://, are read with urllib.
+    Downloads, bytes, seconds, retries and seconds spent throttled are counted per
+    thread, a thread being one download worker (see worker_stats).
+    """
+
+    def __init__(
+        self,
+        limiter=None,
+        max_connections=8,
+        timeout=60.0,
+        retries=8,
+        backoff=1.0,
+        max_backoff=300.0,
+        chunk_size=1024 * 1024,
+    ):
+        self.limiter = limiter
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.chunk_size = chunk_size
+        self._idle = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _connection(self, scheme, netloc, reuse=True):
+        """A connection to netloc, and whether it was reused from the pool"""
+        if reuse:
+            with self._lock:
+                idle = self._idle.get((scheme, netloc))
+                if idle:
+                    return idle.pop(), True
+        connection_class = (
+            http.client.HTTPSConnection
+            if scheme == "https"
+            else http.client.HTTPConnection
+        )
+        return connection_class(netloc, timeout=self.timeout), False
+
+    def _release(self, scheme, netloc, connection, response):
+        """Keep connection for the next request, unless the server closes it"""
+        if response.will_close:
+            connection.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_connections:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle = {}
+
+    def _record(self, **values):
+        name = threading.current_thread().name
+        with self._lock:
+            stats = self._stats.setdefault(
+                name,
+                {
+                    "downloads": 0,
+                    "bytes": 0,
+                    "seconds": 0.0,
+                    "retries": 0,
+                    "throttled_seconds": 0.0,
+                },
+            )
+            for key, value in values.items():
+                stats[key] += value
+
+    def worker_stats(self):
+        """Per thread: downloads, bytes, seconds, retries, throttled seconds, bytes/s"""
+        with self._lock:
+            return {
+                name: dict(
+                    stats, bandwidth=stats["bytes"] / max(stats["seconds"], 1e-9)
+                )
+                for name, stats in self._stats.items()
+            }
+
+    def _throttle(self, num_bytes=0, requests=0):
+        if self.limiter is None:
+            return 0.0
+        return self.limiter.acquire(num_bytes=num_bytes, requests=requests)
+
+    def _backoff(self, attempt, error):
+        """Seconds to wait before attempt (1 for the first retry)"""
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            delay = min(retry_after, self.max_backoff)
+            if self.limiter is not None:
+                self.limiter.block_until(time.time() + delay)
+            return delay
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * random.uniform(0.5, 1.5)
+
+    def download(self, url, filename):
+        """
+        Download url to filename. Returns the bytes, seconds, retries and seconds
+        spent throttled or backing off of this download.
+        """
+
+        start = time.monotonic()
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            with urlopen(url) as response, open(filename, "wb") as f_out:
+                shutil.copyfileobj(response, f_out)
+            size = os.path.getsize(filename)
+            metrics = {
+                "bytes": size,
+                "seconds": time.monotonic() - start,
+                "retries": 0,
+                "throttled_seconds": 0.0,
+            }
+            self._record(downloads=1, **metrics)
+            return metrics
+
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        written = 0
+        retries = 0
+        throttled = 0.0
+        reuse = True
+        with open(filename, "wb") as f_out:
+            while True:
+                throttled += self._throttle(requests=1)
+                connection, reused = self._connection(parts.scheme, parts.netloc, reuse)
+                reuse = True
+                response = None
+                try:
+                    headers = {"Range": f"bytes={written}-"} if written else {}
+                    connection.request("GET", path, headers=headers)
+                    response = connection.getresponse()
+                    resumed_at = content_range_start(
+                        response.headers.get("Content-Range")
+                    )
+                    if (
+                        written
+                        and response.status in (206, 416)
+                        and resumed_at != written
+                    ):
+                        # not the rest of what was written (a 416 has no start),
+                        # e.g. the file changed meanwhile
+                        connection.close()
+                        f_out.seek(0)
+                        f_out.truncate()
+                        written = 0
+                        continue
+                    if response.status in RETRY_STATUSES:
+                        response.read()
+                        self._release(parts.scheme, parts.netloc, connection, response)
+                        raise RetryableResponse(
+                            response.status,
+                            retry_after_seconds(response.headers.get("Retry-After")),
+                        )
+                    if response.status == 200 and written:
+                        # the server ignored the range, start again
+                        f_out.seek(0)
+                        f_out.truncate()
+                        written = 0
+                    elif response.status not in (200, 206):
+                        body = response.read()
+                        connection.close()
+                        raise HTTPError(
+                            url, response.status, body[:200], response.headers, None
+                        )
+                    while True:
+                        chunk = response.read(self.chunk_size)
+                        if not chunk:
+                            break
+                        f_out.write(chunk)
+                        written += len(chunk)
+                        throttled += self._throttle(num_bytes=len(chunk))
+                    if response.length:
+                        # read(amt) ends quietly when the server closes early
+                        raise http.client.IncompleteRead(b"", response.length)
+                    self._release(parts.scheme, parts.netloc, connection, response)
+                    break
+                except HTTPError:
+                    raise
+                except (RetryableResponse, OSError, http.client.HTTPException) as error:
+                    if not isinstance(error, RetryableResponse):
+                        connection.close()
+                    if reused and response is None and isinstance(error, STALE_ERRORS):
+                        # closed by the server while idle, not a failed attempt
+                        reuse = False
+                        continue
+                    retries += 1
+                    if retries > self.retries:
+                        raise
+                    delay = self._backoff(retries, error)
+                    time.sleep(delay)
+                    throttled += delay
+
+        metrics = {
+            "bytes": written,
+            "seconds": time.monotonic() - start,
+            "retries": retries,
+            "throttled_seconds": throttled,
+        }
+        self._record(downloads=1, **metrics)
+        return metrics
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="Download a file within the rate limit of the node, e.g. in place of curl in bash scripts"
+    )
+    parser.add_argument("url", type=str)
+    parser.add_argument("output", type=str)
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=None,
+        help="bytes per second for the whole node, unlimited by default",
+    )
+    parser.add_argument(
+        "--requests_per_second",
+        type=float,
+        default=None,
+        help="requests per second for the whole node, unlimited by default",
+    )
+    parser.add_argument(
+        "--limiter_file",
+        type=str,
+        default=None,
+        help="state file shared by the processes of the node, by default in /dev/shm",
+    )
+    parser.add_argument("--retries", type=int, default=8)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    client = HttpClient(
+        node_limiter(args.limiter_file, args.bandwidth, args.requests_per_second),
+        retries=args.retries,
+    )
+    metrics = client.download(args.url, args.output)
+    print(
+        f"{metrics['bytes']} bytes in {metrics['seconds']:.1f} s, "
+        f"{metrics['retries']} retries, {metrics['throttled_seconds']:.1f} s throttled"
+    )
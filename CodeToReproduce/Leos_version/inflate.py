@@ -0,0 +1,76 @@
+"""
+Decompression of multi-member gzip segments (one member per record) on a thread
+pool, with pluggable inflate backends
+"""
+
+import io
+import os
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from helper_functions import inflate_gzip_members, split_gzip_members
+
+# inflate backends: zlib or a module with its interface (decompressobj and error).
+# isal (python-isal) and zlib-ng are optional, and used only when installed
+INFLATE_BACKENDS = {"zlib": zlib}
+try:
+    from isal import isal_zlib
+except ImportError:
+    pass
+else:
+    INFLATE_BACKENDS["isal"] = isal_zlib
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    pass
+else:
+    INFLATE_BACKENDS["zlib-ng"] = zlib_ng
+
+# compressed bytes of a range, inflated in memory by one thread: up to twice as
+# many ranges as threads are held decompressed (about 4 times larger for WET text)
+RANGE_BYTES = 4 * 1024**2
+
+
+def decompress_parallel(
+    filename_gz, out_filename, threads=4, backend=zlib, range_bytes=RANGE_BYTES
+):
+    """
+    Decompress a multi-member gzip file (a WET or WARC segment) to out_filename,
+    leaving out damaged members as decompress_gzip(skip_corrupt=True) does, then
+    remove it. The file is split at member headers into ranges of about range_bytes
+    (see split_gzip_members), inflated with backend (a module of INFLATE_BACKENDS) by
+    threads threads, as the backends release the GIL while inflating, and written in
+    order. Returns the number of members left out.
+    """
+
+    ranges = split_gzip_members(
+        filename_gz, max(os.path.getsize(filename_gz) // range_bytes, 1)
+    )
+
+    def inflate(byte_range):
+        start, end = byte_range
+        inflated = io.BytesIO()
+        with open(filename_gz, "rb") as f_in:
+            skipped = inflate_gzip_members(f_in, inflated, start, end, backend)
+        return inflated.getbuffer(), skipped
+
+    skipped = 0
+    with ThreadPoolExecutor(threads, thread_name_prefix="inflate") as executor:
+        with open(out_filename, "wb") as f_out:
+            # ranges in flight, at most two per thread, so memory stays bounded
+            # when the disk is slower than the threads
+            pending = deque()
+            for byte_range in ranges:
+                pending.append(executor.submit(inflate, byte_range))
+                if len(pending) >= 2 * threads:
+                    data, range_skipped = pending.popleft().result()
+                    f_out.write(data)
+                    skipped += range_skipped
+            while pending:
+                data, range_skipped = pending.popleft().result()
+                f_out.write(data)
+                skipped += range_skipped
+    os.remove(filename_gz)
+    return skipped
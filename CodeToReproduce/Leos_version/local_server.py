@@ -0,0 +1,182 @@
+"""Local stand-in for data.commoncrawl.org: a static file server that answers Range requests"""
+
+import argparse
+import os
+import re
+import shutil
+import threading
+import time
+
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    SimpleHTTPRequestHandler with support for a single `Range: bytes=` range and
+    keep-alive connections. With unavailable_every, every unavailable_every-th
+    request is answered 503 with a Retry-After of retry_after seconds.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def send_head(self):
+        self.range_length = None
+        if self.server.unavailable_every:
+            with self.server.stats_lock:
+                self.server.received += 1
+                unavailable = self.server.received % self.server.unavailable_every == 0
+            if unavailable:
+                self.send_response(HTTPStatus.SERVICE_UNAVAILABLE)
+                self.send_header("Retry-After", str(self.server.retry_after))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+        range_header = self.headers.get("Range")
+        if range_header is None:
+            return super().send_head()
+
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+        size = os.path.getsize(path)
+        if match is None or match.groups() == ("", ""):
+            self.send_error(HTTPStatus.BAD_REQUEST, "Unsupported range")
+            return None
+        start, end = match.groups()
+        if start == "":
+            # suffix range: the last `end` bytes
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+        if start >= size or start > end:
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", f"bytes */{size}")
+            # without a body length the client cannot tell where the next response starts
+            self.send_header("Content-Length", "0")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            return None
+
+        f_in = open(path, "rb")
+        f_in.seek(start)
+        self.range_length = end - start + 1
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(self.range_length))
+        self.end_headers()
+        return f_in
+
+    def copyfile(self, source, outputfile):
+        if self.range_length is None:
+            sent = os.fstat(source.fileno()).st_size - source.tell()
+        else:
+            sent = self.range_length
+        if self.range_length is None and not self.server.bandwidth:
+            shutil.copyfileobj(source, outputfile)
+        else:
+            start = time.monotonic()
+            written = 0
+            while written < sent:
+                buf = source.read(min(64 * 1024, sent - written))
+                if not buf:
+                    break
+                outputfile.write(buf)
+                written += len(buf)
+                if self.server.bandwidth:
+                    # sleep until the response is no faster than bandwidth
+                    delay = written / self.server.bandwidth - (time.monotonic() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+        with self.server.stats_lock:
+            self.server.bytes_sent += sent
+            self.server.requests += 1
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def start_server(
+    directory,
+    port=0,
+    verbose=False,
+    bandwidth=None,
+    unavailable_every=None,
+    retry_after=1,
+):
+    """
+    Serve directory on localhost from a background thread, each response at up to
+    bandwidth bytes per second (unlimited if None) to mimic a remote server, and
+    every unavailable_every-th request answered 503 (see RangeRequestHandler).
+    Returns the server, whose bytes_sent and requests count what was served,
+    and its base url (ending with "/", like the --server argument of read_wet.py)
+    """
+
+    handler = partial(RangeRequestHandler, directory=directory)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.verbose = verbose
+    server.bandwidth = bandwidth
+    server.unavailable_every = unavailable_every
+    server.retry_after = retry_after
+    server.received = 0
+    server.stats_lock = threading.Lock()
+    server.bytes_sent = 0
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="Serve a directory of segments over HTTP with Range support"
+    )
+    parser.add_argument("--directory", type=str, default=".", help="directory to serve")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=None,
+        help="bytes per second of each response, unlimited by default",
+    )
+    parser.add_argument(
+        "--unavailable_every",
+        type=int,
+        default=None,
+        help="answer every n-th request with a 503, to test clients",
+    )
+    parser.add_argument(
+        "--retry_after",
+        type=int,
+        default=1,
+        help="Retry-After seconds of the 503 responses",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server, base_url = start_server(
+        args.directory,
+        args.port,
+        verbose=True,
+        bandwidth=args.bandwidth,
+        unavailable_every=args.unavailable_every,
+        retry_after=args.retry_after,
+    )
+    print(f"serving {args.directory} at {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"served {server.requests} requests, {server.bytes_sent} bytes")
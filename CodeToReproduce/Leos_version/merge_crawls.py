@@ -45,7 +45,7 @@ def clean_and_count_pcs(pcs_str):
     """Clean and count postcodes"""
 
     pcs_list = pcs_str.split(",")
-    pcs_unique = sorted(set([s.strip() for s in pcs_list.split(",")]))
+    pcs_unique = sorted(set([s.strip() for s in pcs_list]))
     pcs_cleaned = ",".join(pcs_unique)
     return pcs_cleaned, len(pcs_unique)
 
@@ -54,7 +54,7 @@ def process_chunk(chunk):
     chunk.columns = ["url", "parent_url", "postcodes", "cc_url", "content"]
 
     # Collapse pcs by domain
-    chunk["postcodes"] = chunk.groupby("domain")["postcodes"].transform(
+    chunk["postcodes"] = chunk.groupby("parent_url")["postcodes"].transform(
         lambda x: ",".join(x.astype(str))
     )
 
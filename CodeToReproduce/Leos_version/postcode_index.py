@@ -0,0 +1,121 @@
+"""
+Postcode lookup in a flat hash table in shared memory or a read-only mapped file,
+so forked workers share one copy instead of each holding (and, through refcount
+writes, slowly copying) a set of Python strings
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+# magic, width of a slot in bytes, number of slots (a power of two), postcodes
+HEADER = struct.Struct(">4sIQQ")
+MAGIC = b"PCI1"
+
+
+class PostcodeIndex:
+    """
+    Set of postcodes supporting `in` and len(). Postcodes are ascii, padded with
+    NUL bytes to the width of the longest one, in an open addressing table
+    (crc32, linear probing) at most half full, so a lookup reads one or two slots.
+    The table lives in a mmap: anonymous shared memory (inherited by forked
+    processes without copying) from from_postcodes, or a read-only file shared by
+    every process mapping it, page cache included, from build and open.
+    """
+
+    def __init__(self, buffer, path=None):
+        self._map = buffer
+        self.path = path
+        magic, self.width, slots, self.count = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Not a postcode index: {path}")
+        self.mask = slots - 1
+        self._empty = bytes(self.width)
+
+    @staticmethod
+    def _table(postcodes):
+        """Header and slots of the table of postcodes, as bytes"""
+
+        keys = sorted(
+            {p.encode("ascii") for p in postcodes if isinstance(p, str) and p}
+        )
+        width = max((len(key) for key in keys), default=1)
+        slots = 1
+        while slots < 2 * len(keys):
+            slots *= 2
+        mask = slots - 1
+        table = bytearray(HEADER.size + slots * width)
+        HEADER.pack_into(table, 0, MAGIC, width, slots, len(keys))
+        for key in keys:
+            key = key.ljust(width, b"\0")
+            slot = zlib.crc32(key) & mask
+            # keys are not empty, so a slot is free when its first byte is NUL
+            while table[HEADER.size + slot * width]:
+                slot = (slot + 1) & mask
+            offset = HEADER.size + slot * width
+            table[offset : offset + width] = key
+        return table
+
+    @classmethod
+    def from_postcodes(cls, postcodes):
+        """Index of postcodes in anonymous shared memory"""
+        table = cls._table(postcodes)
+        buffer = mmap.mmap(-1, len(table))
+        buffer.write(table)
+        return cls(buffer)
+
+    @classmethod
+    def build(cls, postcodes, path):
+        """Write the index of postcodes to path, and open it"""
+        # several jobs may build the same index at once
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(tmp_path, "wb") as f_out:
+            f_out.write(cls._table(postcodes))
+        os.replace(tmp_path, path)
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path):
+        """Map the index written at path, read-only"""
+        with open(path, "rb") as f_in:
+            return cls(mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ), path)
+
+    def __contains__(self, postcode):
+        try:
+            key = postcode.encode("ascii")
+        except (AttributeError, UnicodeEncodeError):
+            return False
+        width = self.width
+        if not key or len(key) > width:
+            return False
+        key = key.ljust(width, b"\0")
+        slot = zlib.crc32(key) & self.mask
+        while True:
+            offset = HEADER.size + slot * width
+            entry = self._map[offset : offset + width]
+            if entry == key:
+                return True
+            if entry == self._empty:
+                return False
+            slot = (slot + 1) & self.mask
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        width = self.width
+        for offset in range(HEADER.size, len(self._map), width):
+            entry = self._map[offset : offset + width]
+            if entry != self._empty:
+                yield entry.rstrip(b"\0").decode("ascii")
+
+    def __reduce__(self):
+        # a file is mapped again by the receiving process, shared memory is copied
+        if self.path is not None:
+            return PostcodeIndex.open, (self.path,)
+        return PostcodeIndex.from_postcodes, (list(self),)
+
+    def __repr__(self):
+        return f"PostcodeIndex({self.count} postcodes)"
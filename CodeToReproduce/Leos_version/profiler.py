@@ -0,0 +1,60 @@
+"""Sampling profiler writing folded stacks, the input format of flamegraph.pl and speedscope"""
+
+import os
+import signal
+import zlib
+
+from collections import Counter
+
+
+class StackSampler:
+    """
+    Samples the stack of the main thread every interval seconds of cpu time
+    (SIGPROF), counting identical stacks. Unix only, and only from the main thread,
+    where signal handlers run.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._previous_handler = None
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def write_folded(self, filename):
+        """One line per stack, "outermost;...;innermost count", e.g. for flamegraph.pl"""
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, "w", encoding="utf-8") as f_out:
+            for stack, count in self.stacks.most_common():
+                f_out.write(f"{stack} {count}\n")
+
+
+def should_profile(segment, fraction):
+    """
+    Whether segment is among the profiled fraction of segments. Decided from its
+    name, so the same segments are profiled when a run is repeated or resumed.
+    """
+    return zlib.crc32(segment.encode("utf-8")) / 2**32 < fraction
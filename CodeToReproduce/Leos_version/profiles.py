@@ -0,0 +1,128 @@
+"""Filter profiles, so that one pass over a segment can serve several studies"""
+
+import json
+import os
+
+import pandas as pd
+
+from filters import (
+    ContentLength,
+    FilterPipeline,
+    Keywords,
+    LanguageIs,
+    PostcodeGeography,
+    UrlContains,
+)
+from helper_functions import is_landing_page
+from postcode_index import PostcodeIndex
+
+
+class FilterProfile:
+    """
+    Records kept by one study: urls containing url_rule, in the given language
+    (any language if None), with a Content-Length between min_length and
+    max_length and at least one of keywords (if given), and with at least one
+    postcode of the lookup starting with postcode_prefix (if given).
+    The checks run as a FilterPipeline, reordered every reorder_every records.
+    Outputs of a named profile go to a sub-directory of the outputs directory
+    with its name, outputs of an unnamed profile go to the outputs directory.
+    """
+
+    def __init__(
+        self,
+        name,
+        postcodes,
+        url_rule=".co.uk/",
+        language="eng",
+        postcode_prefix=None,
+        min_length=None,
+        max_length=None,
+        keywords=None,
+        reorder_every=1000,
+    ):
+        self.name = name
+        self.url_rule = url_rule
+        predicates = [UrlContains(url_rule)]
+        if language is not None:
+            predicates.append(LanguageIs(language))
+        if min_length is not None or max_length is not None:
+            predicates.append(ContentLength(min_length, max_length))
+        if keywords:
+            predicates.append(Keywords(keywords))
+        predicates.append(PostcodeGeography(postcodes, postcode_prefix))
+        self.pipeline = FilterPipeline(predicates, reorder_every=reorder_every)
+
+    @classmethod
+    def from_csv(cls, name, postcode_list, index_path=None, **kwargs):
+        """
+        Profile with the postcodes in the pcds column of postcode_list, held in a
+        PostcodeIndex shared by forked workers. With index_path, the index is a file
+        there, built if missing or older than postcode_list and reused otherwise,
+        which also shares it between jobs on the same node.
+        """
+
+        if (
+            index_path is not None
+            and os.path.exists(index_path)
+            and os.path.getmtime(index_path) >= os.path.getmtime(postcode_list)
+        ):
+            return cls(name, PostcodeIndex.open(index_path), **kwargs)
+        lookup = pd.read_csv(postcode_list, usecols=["pcds"])
+        if index_path is not None:
+            postcodes = PostcodeIndex.build(lookup["pcds"], index_path)
+        else:
+            postcodes = PostcodeIndex.from_postcodes(lookup["pcds"])
+        return cls(name, postcodes, **kwargs)
+
+    def __repr__(self):
+        return f"FilterProfile({self.name!r}, {self.pipeline.predicates})"
+
+    def match(self, ctx):
+        """Postcodes of the record if the profile keeps it, None otherwise"""
+        return self.pipeline.run(ctx)
+
+    def passed_headers(self):
+        """Whether the record last matched passed the url, language and length checks"""
+        return self.pipeline.headers_passed
+
+    def is_landing_page(self, uri):
+        """Whether uri is the landing page of a website of url_rule"""
+        return is_landing_page(uri, self.url_rule)
+
+    def output_dir(self, output_dir):
+        """Outputs directory of this profile"""
+        if self.name is None:
+            return output_dir
+        return os.path.join(output_dir, self.name, "")
+
+    def csv_path(self, csv_filename):
+        """Path of the segment csv of this profile"""
+        if self.name is None:
+            return csv_filename
+        directory, basename = os.path.split(csv_filename)
+        return os.path.join(directory, self.name, basename)
+
+
+def load_profiles(filename):
+    """
+    Profiles from a json list such as
+    [{"name": "bristol", "postcode_list": "BristolPostcodeLookup.csv", "postcode_prefix": "BS"},
+     {"name": "uk", "postcode_list": "UK_PostcodeLookup.csv", "url_rule": ".co.uk/", "language": "eng"}]
+    Other keys are passed to FilterProfile (min_length, max_length, keywords, reorder_every),
+    or to from_csv (index_path).
+    """
+
+    with open(filename, "r", encoding="utf-8") as f_in:
+        specs = json.load(f_in)
+
+    names = [spec["name"] for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Profile names should be unique: {names}")
+
+    profiles = []
+    for spec in specs:
+        spec = dict(spec)
+        name = spec.pop("name")
+        postcode_list = spec.pop("postcode_list")
+        profiles.append(FilterProfile.from_csv(name, postcode_list, **spec))
+    return profiles
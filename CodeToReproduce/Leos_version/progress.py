@@ -0,0 +1,371 @@
+"""
+Progress of every chunk of every crawl: completion, throughput, ETA, and stalled or
+slow chunks, printed or served as a small status page
+"""
+
+import argparse
+import html
+import json
+import os
+import re
+import statistics
+import threading
+
+from datetime import datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from helper_functions import count_lines
+
+SEGMENT_CSV = re.compile(r"crawldata\d+segment\d{5}\.csv")
+CHUNK_FOLDER = re.compile(r"folder\d+")
+# directories that never contain chunk outputs, not worth walking into
+SKIPPED_DIRS = {"logs", "flamegraphs", "processed", "__pycache__"}
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="Report the progress of the chunks of one or several crawls"
+    )
+    parser.add_argument(
+        "--roots",
+        type=str,
+        nargs="+",
+        default=["."],
+        help="directories searched for chunks (crawl directories with folderK chunks, or outputs directories)",
+    )
+    parser.add_argument(
+        "--max_depth", type=int, default=3, help="how deep chunks are searched for"
+    )
+    parser.add_argument(
+        "--segments_per_chunk",
+        type=int,
+        default=None,
+        help="segments of each chunk, when it cannot be found from the wet.paths or progress.json of the chunk",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=20,
+        help="throughput of a chunk is measured over its last window segments",
+    )
+    parser.add_argument(
+        "--stall_minutes",
+        type=float,
+        default=60,
+        help="a chunk unfinished with no segment done for this long is stalled",
+    )
+    parser.add_argument(
+        "--slow_factor",
+        type=float,
+        default=0.5,
+        help="a chunk slower than this times the median throughput of the running chunks is slow",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print the report as json instead"
+    )
+    parser.add_argument(
+        "--serve",
+        type=int,
+        default=None,
+        help="serve the report as a status page on this port instead of printing it",
+    )
+    parser.add_argument(
+        "--refresh",
+        type=float,
+        default=60,
+        help="seconds a served report is reused before the chunks are scanned again",
+    )
+    return parser.parse_args()
+
+
+def find_chunks(roots, max_depth=3):
+    """
+    Directories with segment outputs: folderK directories of the bash scripts, and
+    outputs directories of read_wet.py (with a metrics.jsonl or segment csvs)
+    """
+
+    chunks = []
+    for root in roots:
+        root = os.path.normpath(root)
+        base_depth = root.count(os.sep)
+        for directory, subdirs, files in os.walk(root):
+            if directory.count(os.sep) - base_depth >= max_depth:
+                subdirs.clear()
+            subdirs[:] = sorted(d for d in subdirs if d not in SKIPPED_DIRS)
+            if (
+                CHUNK_FOLDER.fullmatch(os.path.basename(directory))
+                or "metrics.jsonl" in files
+                or any(SEGMENT_CSV.fullmatch(f) for f in files)
+            ):
+                chunks.append(directory)
+                # profile sub-directories belong to the chunk
+                subdirs.clear()
+    return chunks
+
+
+def completion_times(chunk):
+    """
+    Sorted completion times (unix seconds) of the segments of chunk, and the bytes
+    downloaded if known. Read from metrics.jsonl, or from the segment csvs' mtimes.
+    metrics.jsonl is appended to by every run on the chunk, so a segment done again
+    (e.g. retried from the quarantine, or resumed) counts once, at its last time.
+    """
+
+    metrics_filename = os.path.join(chunk, "metrics.jsonl")
+    if os.path.exists(metrics_filename):
+        # segment -> (completion time, bytes downloaded)
+        segments = {}
+        with open(metrics_filename, "r", encoding="utf-8") as f_in:
+            for line in f_in:
+                try:
+                    metrics = json.loads(line)
+                except json.JSONDecodeError:
+                    # line being written
+                    continue
+                segments[metrics["segment"]] = (
+                    datetime.fromisoformat(metrics["finished"]).timestamp(),
+                    metrics.get("bytes_in", 0),
+                )
+        times = sorted(finished for finished, _ in segments.values())
+        return times, sum(bytes_in for _, bytes_in in segments.values())
+
+    times = []
+    with os.scandir(chunk) as entries:
+        for entry in entries:
+            if SEGMENT_CSV.fullmatch(entry.name):
+                times.append(entry.stat().st_mtime)
+    return sorted(times), None
+
+
+def expected_segments(chunk, segments_per_chunk=None):
+    """
+    Segments chunk should process: from the progress.json written by read_wet.py
+    (every distinct segment of the runs on the chunk), or the wet.paths shared by
+    the folderK chunks of a crawl, split evenly
+    """
+
+    progress_filename = os.path.join(chunk, "progress.json")
+    if os.path.exists(progress_filename):
+        with open(progress_filename, "r", encoding="utf-8") as f_in:
+            return json.load(f_in)["segments"]
+    if segments_per_chunk is not None:
+        return segments_per_chunk
+    wet_paths = os.path.join(chunk, "wet.paths")
+    if os.path.exists(wet_paths):
+        if CHUNK_FOLDER.fullmatch(os.path.basename(chunk)):
+            parent = os.path.dirname(chunk) or "."
+            folders = [d for d in os.listdir(parent) if CHUNK_FOLDER.fullmatch(d)]
+            return count_lines(wet_paths) // len(folders)
+        return count_lines(wet_paths)
+    return None
+
+
+def is_merged(chunk):
+    """Whether chunk has a merged csv, at its top level or in a profile directory"""
+
+    directories = [chunk] + [
+        entry.path
+        for entry in os.scandir(chunk)
+        if entry.is_dir() and entry.name not in SKIPPED_DIRS
+    ]
+    return any(
+        f.startswith("df") and f.endswith(".csv")
+        for directory in directories
+        for f in os.listdir(directory)
+    )
+
+
+def chunk_progress(chunk, now, segments_per_chunk=None, window=20):
+    """Completion, throughput and ETA of one chunk"""
+
+    times, bytes_in = completion_times(chunk)
+    total = expected_segments(chunk, segments_per_chunk)
+    done = len(times)
+    merged = is_merged(chunk)
+    finished = merged or (total is not None and done >= total)
+
+    # segments/hour over the last window segments, up to now, so a chunk that
+    # stopped sees its throughput fall
+    rate = None
+    if times and not finished:
+        recent = times[-window:]
+        span = now - recent[0]
+        if span > 0:
+            rate = len(recent) * 3600 / span
+    eta_hours = None
+    if rate and total is not None:
+        eta_hours = max(total - done, 0) / rate
+    return {
+        "chunk": chunk,
+        "done": done,
+        "total": total,
+        "completion": done / total if total else None,
+        "finished": finished,
+        "segments_per_hour": rate,
+        "bytes_in": bytes_in,
+        "eta_hours": eta_hours,
+        "last_segment": (
+            datetime.fromtimestamp(times[-1]).isoformat() if times else None
+        ),
+        "idle_minutes": (now - times[-1]) / 60 if times else None,
+    }
+
+
+def build_report(
+    roots,
+    max_depth=3,
+    segments_per_chunk=None,
+    window=20,
+    stall_minutes=60,
+    slow_factor=0.5,
+):
+    """Progress of every chunk under roots, with the status of each chunk and totals"""
+
+    now = datetime.now().timestamp()
+    chunks = [
+        chunk_progress(chunk, now, segments_per_chunk, window)
+        for chunk in find_chunks(roots, max_depth)
+    ]
+
+    rates = [c["segments_per_hour"] for c in chunks if c["segments_per_hour"]]
+    median_rate = statistics.median(rates) if rates else None
+    for chunk in chunks:
+        if chunk["finished"]:
+            chunk["status"] = "finished"
+        elif chunk["done"] == 0:
+            chunk["status"] = "not started"
+        elif chunk["idle_minutes"] > stall_minutes:
+            chunk["status"] = "stalled"
+        elif (
+            median_rate
+            and chunk["segments_per_hour"]
+            and chunk["segments_per_hour"] < slow_factor * median_rate
+        ):
+            chunk["status"] = "slow"
+        else:
+            chunk["status"] = "running"
+
+    done = sum(c["done"] for c in chunks)
+    totals = [c["total"] for c in chunks]
+    total = sum(totals) if None not in totals else None
+    etas = [c["eta_hours"] for c in chunks if not c["finished"]]
+    return {
+        "created": datetime.fromtimestamp(now).isoformat(),
+        "done": done,
+        "total": total,
+        "completion": done / total if total else None,
+        "segments_per_hour": sum(rates),
+        # chunks run in parallel, so everything is done when the last one is
+        "eta_hours": max(etas) if etas and None not in etas else None,
+        "stalled": [c["chunk"] for c in chunks if c["status"] == "stalled"],
+        "slow": [c["chunk"] for c in chunks if c["status"] == "slow"],
+        "chunks": chunks,
+    }
+
+
+def _format(value, spec, missing="-"):
+    return missing if value is None else format(value, spec)
+
+
+def format_report(report):
+    """Plain text table of a report"""
+
+    lines = [
+        f"{'chunk':<40}{'done':>14}{'%':>8}{'seg/h':>9}{'ETA (h)':>9}  status",
+    ]
+    for c in report["chunks"]:
+        lines.append(
+            f"{c['chunk']:<40}{c['done']:>7}/{_format(c['total'], 'd'):<6}"
+            f"{_format(c['completion'], '.1%'):>8}"
+            f"{_format(c['segments_per_hour'], '.1f'):>9}"
+            f"{_format(c['eta_hours'], '.1f'):>9}  {c['status']}"
+        )
+    lines.append(
+        f"{'total':<40}{report['done']:>7}/{_format(report['total'], 'd'):<6}"
+        f"{_format(report['completion'], '.1%'):>8}"
+        f"{report['segments_per_hour']:>9.1f}"
+        f"{_format(report['eta_hours'], '.1f'):>9}"
+    )
+    if report["stalled"]:
+        lines.append(f"stalled: {', '.join(report['stalled'])}")
+    if report["slow"]:
+        lines.append(f"slow: {', '.join(report['slow'])}")
+    return "\n".join(lines)
+
+
+def format_page(report, refresh=60):
+    """Status page of a report, reloaded by the browser every refresh seconds"""
+    return (
+        f"<html><head><meta http-equiv='refresh' content='{max(int(refresh), 1)}'>"
+        "<title>CC-filtering progress</title></head><body>"
+        f"<p>{report['created']}</p><pre>{html.escape(format_report(report))}</pre>"
+        "</body></html>"
+    )
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Serves the report as text at / and as json at /status.json"""
+
+    def do_GET(self):
+        report = self.server.report()
+        if self.path == "/status.json":
+            body = json.dumps(report, indent=2).encode("utf-8")
+            content_type = "application/json"
+        elif self.path == "/":
+            body = format_page(report, self.server.refresh).encode("utf-8")
+            content_type = "text/html; charset=utf-8"
+        else:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, refresh, **report_kwargs):
+    """Serve the status page, scanning the chunks again at most every refresh seconds"""
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), StatusHandler)
+    lock = threading.Lock()
+    cached = {}
+
+    def report():
+        with lock:
+            now = datetime.now().timestamp()
+            if "report" not in cached or now - cached["time"] > refresh:
+                cached["report"] = build_report(**report_kwargs)
+                cached["time"] = now
+            return cached["report"]
+
+    server.report = report
+    server.refresh = refresh
+    print(f"serving progress at http://127.0.0.1:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report_kwargs = {
+        "roots": args.roots,
+        "max_depth": args.max_depth,
+        "segments_per_chunk": args.segments_per_chunk,
+        "window": args.window,
+        "stall_minutes": args.stall_minutes,
+        "slow_factor": args.slow_factor,
+    }
+    if args.serve is not None:
+        serve(args.serve, args.refresh, **report_kwargs)
+    elif args.json:
+        print(json.dumps(build_report(**report_kwargs), indent=2))
+    else:
+        print(format_report(build_report(**report_kwargs)))
@@ -0,0 +1,82 @@
+"""Segments that failed: removing what they left behind, and setting them aside"""
+
+import glob
+import json
+import os
+
+from datetime import datetime
+
+from checkpoint import checkpoint_path
+
+# segments that failed every attempt, in the outputs directory
+QUARANTINE_FILENAME = "quarantine.jsonl"
+
+
+def discard_segment(segment, profiles):
+    """Remove the files a failed segment left behind, so it is done again from scratch"""
+
+    output_filename, csv_name = segment[:2]
+    leftovers = [
+        output_filename,
+        output_filename + ".gz",
+        csv_name.replace(".csv", ".digests"),
+        csv_name.replace(".csv", ".index"),
+        checkpoint_path(csv_name),
+    ] + [profile.csv_path(csv_name) for profile in profiles]
+    # and the files of the parts of a split segment
+    leftovers += [
+        part
+        for filename in leftovers
+        for part in glob.glob(glob.escape(filename) + ".part*")
+    ]
+    for filename in leftovers:
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+def quarantine_segment(output_dir, wet_path, attempts, message):
+    """Add a segment that kept failing to the quarantine file of output_dir"""
+
+    with open(
+        os.path.join(output_dir, QUARANTINE_FILENAME), "a", encoding="utf-8"
+    ) as f_out:
+        entry = {
+            "segment": wet_path,
+            "attempts": attempts,
+            "error": message.strip().splitlines()[-1],
+            "traceback": message,
+            "quarantined": datetime.now().isoformat(),
+        }
+        f_out.write(json.dumps(entry) + "\n")
+
+
+def quarantined_wet_paths(output_dir):
+    """
+    Write the segments of the quarantine file of output_dir to a wet.paths file,
+    quarantine.paths, and return its name (None if nothing is quarantined). The
+    quarantine file is renamed with the time, so segments failing again start a
+    new one.
+    """
+
+    quarantine_filename = os.path.join(output_dir, QUARANTINE_FILENAME)
+    if not os.path.exists(quarantine_filename):
+        return None
+    wet_paths = []
+    with open(quarantine_filename, "r", encoding="utf-8") as f_in:
+        for line in f_in:
+            if line.strip():
+                wet_path = json.loads(line)["segment"]
+                if wet_path not in wet_paths:
+                    wet_paths.append(wet_path)
+    if not wet_paths:
+        return None
+    wet_paths_filename = os.path.join(output_dir, "quarantine.paths")
+    with open(wet_paths_filename, "w", encoding="utf-8") as f_out:
+        f_out.writelines(f"{wet_path}\n" for wet_path in wet_paths)
+    os.replace(
+        quarantine_filename,
+        os.path.join(output_dir, f"quarantine.{datetime.now():%Y%m%d_%H%M%S}.jsonl"),
+    )
+    return wet_paths_filename
@@ -3,26 +3,63 @@
 import argparse
 import csv
 import glob
+import json
 import logging
+import multiprocessing
 import os
+import shutil
+import traceback
+import zlib
 
-import pandas as pd
-
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from datetime import datetime
-from urllib.request import urlretrieve
 from resiliparse.extract.html2text import extract_plain_text
 from resiliparse.parse.html import HTMLTree
 from resiliparse.parse.encoding import detect_encoding
 from tqdm import tqdm
 from warcio.archiveiterator import ArchiveIterator
+from warcio.exceptions import ArchiveLoadFailed
 
+from checkpoint import (
+    checkpoint_path,
+    install_stop_handlers,
+    read_checkpoint,
+    remove_checkpoint,
+    requeue_job,
+    stop_requested,
+    write_checkpoint,
+)
+from content_store import ContentStore
+from digest_store import DigestStore
+from disk_budget import DiskBudget
+from extract_options import ExtractOptions
+from filters import RecordContext, subtract_counts
+from frame_store import pack_csv
+from http_client import HttpClient, node_limiter
+from inflate import INFLATE_BACKENDS, decompress_parallel
 from helper_functions import (
-    Bristol_postcode_finder,
     count_lines,
     construct_output_filename,
     decompress_gzip,
     extract_website,
+    inflate_gzip_members,
+    split_gzip_members,
 )
+from profiler import StackSampler, should_profile
+from profiles import FilterProfile, load_profiles
+from quarantine import (
+    QUARANTINE_FILENAME,
+    discard_segment,
+    quarantine_segment,
+    quarantined_wet_paths,
+)
+from segment_cache import SegmentCache
+from segment_downloads import download_segment
+from segment_files import QueuedSegmentFiles, SegmentFiles
+from staged import ConcurrencyController, run_staged
+from telemetry import MetricsWriter, StageTimer, peak_rss_mb
 
 logger = logging.getLogger(__name__)
 
@@ -66,6 +103,255 @@ def parse_args():
         default="BristolPostcodeLookup.csv",
         help="File with postcodes list",
     )
+    parser.add_argument(
+        "--postcode_prefix",
+        type=str,
+        default="BS",
+        help="Only keep postcodes of the postcode list starting with this prefix (empty string for any)",
+    )
+    parser.add_argument(
+        "--postcode_index",
+        type=str,
+        default=None,
+        help="File of the postcode index of --postcode_list, built if missing or older than the list and mapped read-only, so jobs on one node share it",
+    )
+    parser.add_argument(
+        "--profiles",
+        type=str,
+        default=None,
+        help="json file with a list of filter profiles (see profiles.py). Every record is checked against all of them in one pass, and each writes to its own sub-directory. Replaces --postcode_list and --postcode_prefix",
+    )
+    parser.add_argument(
+        "--content_store",
+        type=str,
+        default=None,
+        help="Directory of the content-addressed text store. If given, csvs hold a content hash instead of the page text",
+    )
+    parser.add_argument(
+        "--digest_store",
+        type=str,
+        default=None,
+        help="Directory of the digest store (see digest_store.py). Records already in it are not matched again, and a .digests file is written per segment",
+    )
+    parser.add_argument(
+        "--record_index",
+        action="store_true",
+        help="Read the compressed segments directly and write a .index file per segment with the offsets of the .co.uk/eng records (see refilter.py)",
+    )
+    parser.add_argument(
+        "--input_format",
+        type=str,
+        choices=["wet", "warc"],
+        default="wet",
+        help="wet reads the plain text of WET files. warc reads the html of WARC files (wet_file then lists .warc.gz paths) and extracts the text with --text_backend",
+    )
+    parser.add_argument(
+        "--text_backend",
+        type=str,
+        choices=sorted(TEXT_BACKENDS),
+        default="html2text",
+        help="text extraction from html for --input_format warc",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes extracting segments in parallel",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="Number of segments downloaded ahead of the workers",
+    )
+    parser.add_argument(
+        "--split_segments",
+        type=int,
+        default=1,
+        help="Split each segment into this many record ranges extracted on as many processes, one segment at a time (not with --workers or --prefetch); when stopped, each part is checkpointed and resumed",
+    )
+    parser.add_argument(
+        "--inflate_threads",
+        type=int,
+        default=1,
+        help="Threads decompressing each segment, in ranges of gzip members",
+    )
+    parser.add_argument(
+        "--inflate_backend",
+        type=str,
+        choices=sorted(INFLATE_BACKENDS),
+        default="zlib",
+        help="Inflate implementation decompressing the segments (isal and zlib-ng when installed)",
+    )
+    parser.add_argument(
+        "--download_threads",
+        type=int,
+        default=2,
+        help="Number of threads downloading segments, with --workers or --prefetch",
+    )
+    parser.add_argument(
+        "--write_queue",
+        type=int,
+        default=64,
+        help="Batches of rows waiting for the writer before the workers are held back",
+    )
+    parser.add_argument(
+        "--segment_cache",
+        type=str,
+        default=None,
+        help="Directory of a segment cache shared by runs and jobs: segments are taken from it when there, and added to it when downloaded",
+    )
+    parser.add_argument(
+        "--segment_cache_gb",
+        type=float,
+        default=500,
+        help="Size cap of the segment cache in GB, least recently used segments are removed above it",
+    )
+    parser.add_argument(
+        "--segment_cache_verify",
+        type=str,
+        choices=["sha256", "size"],
+        default="sha256",
+        help="Check of a cached segment before use: its sha256 and size, or its size only",
+    )
+    parser.add_argument(
+        "--node_bandwidth",
+        type=float,
+        default=None,
+        help="Bytes per second of downloads for all the jobs of the node together, unlimited by default",
+    )
+    parser.add_argument(
+        "--node_requests_per_second",
+        type=float,
+        default=None,
+        help="Requests per second to the server for all the jobs of the node together, unlimited by default",
+    )
+    parser.add_argument(
+        "--rate_limiter_file",
+        type=str,
+        default=None,
+        help="State file of the node's rate limit, the same for every job of the node (by default in /dev/shm)",
+    )
+    parser.add_argument(
+        "--download_retries",
+        type=int,
+        default=8,
+        help="Retries of a download after a 503, 429 or connection error",
+    )
+    parser.add_argument(
+        "--disk_budget_gb",
+        type=float,
+        default=None,
+        help="GB of downloaded and decompressed segments on disk at once for all the jobs of the node together, unlimited by default",
+    )
+    parser.add_argument(
+        "--disk_budget_file",
+        type=str,
+        default=None,
+        help="Ledger of the node's disk budget, the same for every job of the node (by default in /dev/shm)",
+    )
+    parser.add_argument(
+        "--min_free_gb",
+        type=float,
+        default=0,
+        help="GB left free on the outputs filesystem, with --disk_budget_gb",
+    )
+    parser.add_argument(
+        "--segment_attempts",
+        type=int,
+        default=3,
+        help="Attempts at a segment that fails to download or extract before it is quarantined (see --retry_quarantined)",
+    )
+    parser.add_argument(
+        "--retry_quarantined",
+        action="store_true",
+        help="Process only the segments quarantined in the outputs directory by earlier runs, adding their rows to the merged csvs",
+    )
+    parser.add_argument(
+        "--requeue",
+        action="store_true",
+        help="When stopped by SIGTERM or SIGUSR1, put the SLURM job back in the queue to resume",
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="Adjust the download threads and workers while running, starting from --download_threads and --workers",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=None,
+        help="Most workers with --autotune, by default the available CPUs",
+    )
+    parser.add_argument(
+        "--max_download_threads",
+        type=int,
+        default=8,
+        help="Most download threads (connections to the server) with --autotune",
+    )
+    parser.add_argument(
+        "--max_memory_mb",
+        type=float,
+        default=None,
+        help="Workers are removed above this resident memory with --autotune",
+    )
+    parser.add_argument(
+        "--autotune_interval",
+        type=float,
+        default=60,
+        help="Seconds between two adjustments with --autotune",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile a fraction of the segments, writing folded stacks (for flamegraph.pl or speedscope) to flamegraphs/",
+    )
+    parser.add_argument(
+        "--profile_fraction",
+        type=float,
+        default=0.1,
+        help="Fraction of the segments profiled with --profile",
+    )
+    parser.add_argument(
+        "--profile_interval",
+        type=float,
+        default=0.005,
+        help="Seconds of cpu time between two stack samples with --profile",
+    )
+    parser.add_argument(
+        "--slow_record_seconds",
+        type=float,
+        default=1.0,
+        help="Log records taking longer than this to match and write (0 to disable)",
+    )
+    parser.add_argument(
+        "--max_text_bytes",
+        type=int,
+        default=None,
+        help="Keep at most this many bytes of each record body as text, scanning the rest for postcodes in windows (no limit by default)",
+    )
+    parser.add_argument(
+        "--window_size",
+        type=int,
+        default=1024 * 1024,
+        help="Bytes per window when scanning the rest of a body longer than --max_text_bytes",
+    )
+    parser.add_argument(
+        "--tolerant_postcodes",
+        action="store_true",
+        help="Also find postcodes written in lowercase or with no or two spaces (e.g. bs1 1aa, BS11AA), as their pcds form",
+    )
+    parser.add_argument(
+        "--pack_content",
+        type=str,
+        default=None,
+        help="Directory where the texts of the merged csvs are packed into seekable zstd containers (see frame_store.py)",
+    )
+    parser.add_argument(
+        "--aggregate_domains",
+        action="store_true",
+        help="Write one row per domain (parent_url) and segment, with the union of its postcodes and only the landing-page text",
+    )
     pars_args = parser.parse_args()
     print("the inputs are:")
     for arg in vars(pars_args):
@@ -74,87 +360,405 @@ def parse_args():
 
 
 def get_text_original(raw_bytes):
+    """Raw html decoded as utf-8, tags and all"""
     return raw_bytes.decode("utf-8", "ignore")
 
 
 def get_text_tree(raw_bytes):
+    """Text of the html body, including scripts and styles"""
     enc = detect_encoding(raw_bytes)
     try:
         tree = HTMLTree.parse_from_bytes(raw_bytes, encoding=enc)
-        text = tree.body()
+        text = tree.body.text if tree.body is not None else ""
     except Exception:
         text = ""
     return text
 
 
 def get_text_html2text(raw_bytes):
-    text = extract_plain_text(
-        raw_bytes,
-        list_bullets=False,
-    )
+    """Main text of the html with resiliparse's extract_plain_text"""
+    enc = detect_encoding(raw_bytes)
+    try:
+        tree = HTMLTree.parse_from_bytes(raw_bytes, encoding=enc)
+        text = extract_plain_text(
+            tree,
+            list_bullets=False,
+        )
+    except Exception:
+        text = ""
     return text
 
 
+# text extraction backends for --input_format warc
+TEXT_BACKENDS = {
+    "original": get_text_original,
+    "tree": get_text_tree,
+    "html2text": get_text_html2text,
+}
+
+# errors of a damaged or truncated segment, after which its records cannot be read
+READ_ERRORS = (ArchiveLoadFailed, zlib.error, EOFError)
+
+
 def extract_from_segment(
-    output_filename, csv_filename, url_crawl, BristolPostcodeLookup
+    output_filename,
+    csv_filename,
+    url_crawl,
+    profiles,
+    options=None,
+    digests_filename=None,
+    index_filename=None,
+    segment_path=None,
+    timer=None,
+    files=None,
+    resume=None,
+    should_stop=None,
+    domains_out=None,
 ):
-    """Function to extract text and postcode of websites and write it in the csv file"""
+    """
+    Function to extract text and postcode of websites and write it in the csv file.
+    The settings below (text_backend, content_store, aggregate_domains, digest_store,
+    slow_record_seconds, max_text_bytes, window_size and tolerant_postcodes) are
+    those of options (an ExtractOptions, by default the defaults).
+    By default the segment is a WET file and the text of its conversion records is used.
+    If text_backend (one of TEXT_BACKENDS) is given, the segment is a WARC file, and the
+    text is extracted from the html of its response records with that backend.
+    Each record is checked against every profile in one pass, and each profile
+    writes its matches to its own csv (see FilterProfile.csv_path).
+    If a content_store is given, the text goes to the store and the csv gets its hash.
+    If aggregate_domains is True, pages are grouped by parent_url and one row is
+    written per domain, with the union of its postcodes and only the landing-page text.
+    If a digest_store is given, records whose WARC-Block-Digest it knows reuse the
+    earlier result instead of being matched again. If digests_filename is given, the
+    result of every record is written there to build the digest store of later runs.
+    Both need a single profile, as results depend on the postcode lookup.
+    If index_filename is given, output_filename must be the compressed segment, and the
+    (segment_path, offset, length, uri, language, digest) of every record whose headers
+    are accepted by a profile is written there, so refilter.py can fetch those records alone with range requests.
+    Returns a Counter with the number of records seen, records of the right type, records
+    matched by at least one profile, and records checked and found in the digest store.
+    Per-filter counts are kept by each profile's pipeline.
+    Time is charged to the parse, match and write stages of timer (a StageTimer), if given.
+    Records taking more than slow_record_seconds to match and write are logged.
+    With max_text_bytes, only the start of each body is kept as text and the rest is
+    scanned for postcodes in windows of window_size bytes (see RecordContext).
+    With tolerant_postcodes, postcodes in any case and spacing are found as well.
+    Rows go to files (a SegmentFiles or QueuedSegmentFiles), by default SegmentFiles
+    of csv_filename, digests_filename and index_filename.
+    A record that fails to decode or match is logged, counted as records_failed and
+    skipped. If the segment cannot be read further (READ_ERRORS), the records read
+    so far are kept, and read_errors is counted.
+    Once should_stop() is true, extraction stops before the next record and the
+    offset of that record, the stats and the domains so far are saved as the
+    checkpoint of csv_filename (see checkpoint.py), and stopped is counted. With
+    resume (such a checkpoint), extraction goes on from its offset, adding to the
+    rows already written.
+    With domains_out (a list), the domains of each profile are added to it instead
+    of being written, e.g. for a part of a segment (see extract_segment_parts).
+    """
+
+    if options is None:
+        options = ExtractOptions()
+    content_store = options.content_store
+    aggregate_domains = options.aggregate_domains
+    digest_store = options.digest_store
+    text_backend = options.text_backend
+    slow_record_seconds = options.slow_record_seconds
+    max_text_bytes = options.max_text_bytes
+    window_size = options.window_size
+    tolerant_postcodes = options.tolerant_postcodes
 
-    with open(csv_filename, "w", newline="") as output_csv:
-        csv_writer = csv.writer(output_csv)
+    if (digest_store is not None or digests_filename is not None) and len(profiles) > 1:
+        raise ValueError("The digest store can only be used with a single profile")
+
+    if timer is None:
+        timer = StageTimer()
+    stats = Counter()
+    # per profile: parent_url -> [landing page uri, landing page text, set of postcodes]
+    domains = [{} for _ in profiles]
+    if resume is not None:
+        stats.update(resume["stats"])
+        domains = domains_from_json(resume["domains"])
+    # offset of the first record not extracted, when stopped
+    stopped_at = None
+
+    if files is None:
+        files = SegmentFiles(
+            [profile.csv_path(csv_filename) for profile in profiles],
+            digests_filename,
+            index_filename,
+            append=resume is not None,
+        )
+
+    with ExitStack() as stack:
+        stack.enter_context(files)
+        # index row waiting for its length, known once the iterator reaches the next record
+        pending_index = None
+
+        def write_index_row(end_offset):
+            segment, offset, uri, language, digest = pending_index
+            files.write(
+                "index", [segment, offset, end_offset - offset, uri, language, digest]
+            )
 
         # open the file, naming the reader "stream"
-        with open(output_filename, "rb") as stream:
-            # loop over each record within "stream" using the ArchiveIterator from warcio
-            for record in ArchiveIterator(stream):
+        stream = stack.enter_context(open(output_filename, "rb"))
+        if resume is not None:
+            # a record boundary, where warcio can start reading (offsets stay those
+            # of the whole file)
+            stream.seek(resume["offset"])
+        iterator = ArchiveIterator(stream)
+        # loop over each record within "stream" using the ArchiveIterator from warcio
+        timer.restart()
+        try:
+            for record in iterator:
+                # reading the headers (and skipping the previous body)
+                timer.lap("parse")
+                record_start = timer.last
+                if pending_index is not None:
+                    write_index_row(iterator.offset)
+                    pending_index = None
+                if should_stop is not None and should_stop():
+                    stopped_at = iterator.offset
+                    break
+                stats["records_seen"] += 1
                 # Check if the current record has the type "response" - conversion as wet file
-                if record.rec_type == "conversion":
-                    # lookup the uri (web address) of the record
-                    uri = record.rec_headers.get_header("WARC-Target-URI")
-                    language = record.rec_headers.get_header(
-                        "WARC-Identified-Content-Language"
+                if text_backend is None:
+                    if record.rec_type != "conversion":
+                        continue
+                elif record.rec_type != "response" or not is_html(record):
+                    continue
+                stats["records"] += 1
+
+                # every profile runs its filters (by default ".co.uk/" in the url, English,
+                # and postcodes of its lookup) sharing the decoded text and postcode candidates
+                try:
+                    ctx = RecordContext(
+                        record,
+                        digest_store=digest_store,
+                        text_backend=text_backend,
+                        max_text_bytes=max_text_bytes,
+                        window_size=window_size,
+                        tolerant_postcodes=tolerant_postcodes,
+                    )
+                    results = [profile.match(ctx) for profile in profiles]
+                except READ_ERRORS:
+                    raise
+                except Exception as error:
+                    # a record that cannot be decoded or matched is skipped alone
+                    stats["records_failed"] += 1
+                    logger.warning(
+                        f"Skipped a record of {url_crawl} that failed: "
+                        f"{record.rec_headers.get_header('WARC-Target-URI')}: {error!r}"
                     )
+                    continue
+                timer.lap("match")
+                # reading and decoding the body happened while matching
+                timer.move(ctx.read_time, "match", "parse")
+                if not ctx.reached_content:
+                    warn_if_slow(
+                        ctx, timer.last - record_start, slow_record_seconds, url_crawl
+                    )
+                    continue
+                if any(postcodes is not None for postcodes in results):
+                    stats["records_matched"] += 1
+
+                uri = ctx.uri
+                website = extract_website(uri)
+                if index_filename is not None:
+                    pending_index = [
+                        segment_path,
+                        iterator.offset,
+                        uri,
+                        ctx.language,
+                        ctx.digest,
+                    ]
+                if digest_store is not None:
+                    stats["digest_lookups"] += 1
+                if ctx.known is not None:
+                    # same text as in a previous crawl, its result was reused
+                    stats["digest_hits"] += 1
+                    content_hash = ctx.known[1]
+                else:
+                    content_hash = None
+
+                for i, postcodes in enumerate(results):
+                    if aggregate_domains:
+                        # only records of the profile's own url, language and
+                        # length, matched or not, make its domains
+                        if not profiles[i].passed_headers():
+                            continue
+                        domain = domains[i].setdefault(website, [None, None, set()])
+                        if postcodes is not None:
+                            domain[2].update(postcodes)
+                        if domain[0] is None and profiles[i].is_landing_page(uri):
+                            domain[0] = uri
+                            domain[1] = ctx.lower_text
+
+                    elif (
+                        postcodes is not None
+                    ):  # Check if there are postcodes of the profile
+                        if content_store is not None:
+                            if (
+                                content_hash is None
+                                or content_hash not in content_store
+                            ):
+                                content_hash = content_store.put(ctx.lower_text)
+                            content = content_hash
+                        else:
+                            content = ctx.lower_text
+                        files.write(
+                            i, [uri, website, postcodes, url_crawl, content]
+                        )  ##cclocation
+
+                if digests_filename is not None and ctx.digest:
+                    files.write(
+                        "digests",
+                        [ctx.digest, ";".join(results[0] or []), content_hash or ""],
+                    )
+                timer.lap("write")
+                warn_if_slow(
+                    ctx, timer.last - record_start, slow_record_seconds, url_crawl
+                )
+
+        except READ_ERRORS as error:
+            # the rest of the segment cannot be read, its records read so far are kept
+            stats["read_errors"] += 1
+            pending_index = None
+            logger.warning(
+                f"Stopped reading {url_crawl} after {stats['records_seen']} records: "
+                f"{type(error).__name__}: {str(error)[:200]}"
+            )
 
-                    # check if the web address contains ".co.uk/" and the language is English
-                    if (".co.uk/" in uri) & (language == "eng"):
-                        website = extract_website(uri)
-                        text = record.content_stream().read().decode("utf-8", "ignore")
-                        postcodes = Bristol_postcode_finder(
-                            text, BristolPostcodeLookup
-                        )  # do postcode search for Bristol postcodes
-                        text = text.lower()  # all into lowercase
+        timer.lap("parse")
+        if pending_index is not None:
+            write_index_row(iterator.offset)
 
-                        if (
-                            postcodes is not None
-                        ):  # Check if there are Bristol postcodes
-                            csv_writer.writerow(
-                                [uri, website, postcodes, url_crawl, text]
-                            )  ##cclocation
+        if domains_out is not None:
+            domains_out.extend(domains)
+        elif stopped_at is None:
+            write_domain_rows(files, domains, url_crawl, content_store)
+    timer.lap("write")
+
+    if stopped_at is not None:
+        # written once the rows before it are
+        write_checkpoint(
+            csv_filename,
+            {
+                "segment": segment_path,
+                "offset": stopped_at,
+                "stats": stats,
+                "domains": domains_to_json(domains),
+            },
+        )
+        stats["stopped"] += 1
+    return stats
+
+
+def domains_to_json(domains):
+    """Domains of every profile as json for a checkpoint, postcodes as sorted lists"""
+    return [
+        {
+            website: [uri, text, sorted(postcodes)]
+            for website, (uri, text, postcodes) in profile_domains.items()
+        }
+        for profile_domains in domains
+    ]
+
+
+def domains_from_json(domains):
+    """Domains of every profile from a checkpoint (see domains_to_json)"""
+    return [
+        {
+            website: [uri, text, set(postcodes)]
+            for website, (uri, text, postcodes) in profile_domains.items()
+        }
+        for profile_domains in domains
+    ]
+
+
+def write_domain_rows(files, domains, url_crawl, content_store=None):
+    """
+    One row per domain with postcodes, once the whole segment is read. Domains
+    whose landing page is in another segment get an empty url and content, so
+    their postcodes can still be collapsed by parent_url when merging crawls
+    """
+
+    for i, profile_domains in enumerate(domains):
+        for website, (uri, text, postcodes) in profile_domains.items():
+            if not postcodes:
+                continue
+            uri = uri or ""
+            text = text or ""
+            if content_store is not None and text:
+                text = content_store.put(text)
+            files.write(i, [uri, website, sorted(postcodes), url_crawl, text])
+
+
+def merge_domains(domains, part_domains):
+    """
+    Add the domains of the next part of a segment to those of the parts before it:
+    postcodes are joined, and the first landing page is kept
+    """
+
+    for profile_domains, profile_part in zip(domains, part_domains):
+        for website, (uri, text, postcodes) in profile_part.items():
+            domain = profile_domains.setdefault(website, [None, None, set()])
+            domain[2].update(postcodes)
+            if domain[0] is None and uri is not None:
+                domain[0] = uri
+                domain[1] = text
+
+
+def warn_if_slow(ctx, seconds, threshold, url_crawl):
+    """Log the record of ctx if it took more than threshold seconds"""
+    if threshold is not None and seconds > threshold:
+        logger.warning(
+            f"Slow record ({seconds:.3f}s) in {url_crawl}: {ctx.uri}, "
+            f"{ctx.content_length} bytes, {ctx.num_candidates} postcode candidates"
+        )
 
 
-def merge_csvs(crawl, output_dir):
-    """function to merge all the csvs from the different segments"""
+def is_html(record):
+    """Whether the http payload of a warc response record is html"""
+    if record.http_headers is None:
+        return False
+    content_type = record.http_headers.get_header("Content-Type") or ""
+    return "html" in content_type.lower()
+
+
+def merge_csvs(crawl, output_dir, content_column="content", append=False):
+    """
+    function to merge all the csvs from the different segments.
+    With append, they are added to the end of an existing merged csv.
+    """
 
     csv_pattern = f"{output_dir}crawldata{crawl}segment*.csv"
     csv_files = sorted(glob.glob(csv_pattern))
     if not csv_files:
+        if append:
+            logger.info(f"No segment csvs to add to the merged csv of {output_dir}")
+            return
         raise FileNotFoundError(f"No files matched pattern: {csv_pattern}")
 
     output_name = os.path.join(output_dir, f"df{crawl}.csv")
+    append = append and os.path.exists(output_name)
 
     logger.info(f"Merging {len(csv_files)} files...")
 
-    with open(output_name, mode="w", newline="") as output_csv_file:
-        output_csv_writer = csv.writer(output_csv_file)
-        output_csv_writer.writerow(
-            ["url", "parent_url", "postcodes", "cc_url", "content"]
-        )
+    with open(output_name, mode="a" if append else "w", newline="") as output_csv_file:
+        if not append:
+            output_csv_writer = csv.writer(output_csv_file)
+            output_csv_writer.writerow(
+                ["url", "parent_url", "postcodes", "cc_url", content_column]
+            )
+            output_csv_file.flush()
         for file in csv_files:
-            with open(file, "r") as csv_file:
-                csv_reader = csv.reader(csv_file)
-                # Iterate over each row in the CSV file and write it to the output CSV
-                for row in csv_reader:
-                    output_csv_writer.writerow(row)
+            # segment csvs come from the same csv writer, so they are copied as they
+            # are, in blocks, instead of being parsed: rows with huge texts would
+            # break csv.reader's field size limit
+            with open(file, "r", newline="") as csv_file:
+                shutil.copyfileobj(csv_file, output_csv_file)
     logger.info(f"Saved merged csv to {output_name}")
 
     logger.info("Deleting segment csvs")
@@ -162,17 +766,568 @@ def merge_csvs(crawl, output_dir):
         os.remove(file)
 
 
+def resumable(output_filename, checkpoint):
+    """
+    Whether a segment can be resumed from its checkpoint, i.e. the file the
+    checkpoint goes on from is still there: the compressed segment for a split one
+    (see extract_segment_parts), else the decompressed segment
+    """
+    if checkpoint is None:
+        return False
+    if "parts" in checkpoint:
+        return os.path.exists(output_filename + ".gz")
+    return os.path.exists(output_filename)
+
+
+def process_segment(
+    output_filename,
+    csv_name,
+    url_crawl,
+    wet_path,
+    profiles,
+    options=None,
+    row_queue=None,
+):
+    """
+    Decompress and extract a downloaded segment, then remove it, with the settings
+    of options (an ExtractOptions, see extract_from_segment).
+    Returns the extraction stats, and metrics with the seconds of each stage, the
+    bytes decompressed and written, and the peak RSS of the process so far.
+    Damaged gzip members (records) are left out of the decompressed segment and
+    counted as members_skipped. The segment is inflated with inflate_backend (one of
+    inflate.INFLATE_BACKENDS), by inflate_threads threads (see
+    inflate.decompress_parallel).
+    When a stop is requested (see checkpoint.py), extraction stops at the next
+    record, the segment is kept on disk with a checkpoint, and metrics has stopped.
+    A segment with a checkpoint and its file still there is resumed from it (see
+    resumable).
+    With a row_queue, rows are sent there for a staged.SegmentWriter instead of being
+    written, and bytes_out is left to the writer.
+    With split above 1 (and no row_queue nor record_index), the segment is split into
+    that many record ranges, decompressed and extracted on as many processes (see
+    extract_segment_parts); the stage seconds are then those of every process.
+    A profile_fraction of the segments are profiled with a StackSampler, their
+    folded stacks written to flamegraphs/ in the outputs directory.
+    """
+
+    if options is None:
+        options = ExtractOptions()
+    record_index = options.record_index
+    split = options.split
+    inflate_threads = options.inflate_threads
+    inflate_backend = options.inflate_backend
+    sampler = None
+    if options.profile_fraction and should_profile(wet_path, options.profile_fraction):
+        sampler = StackSampler(options.profile_interval)
+        sampler.start()
+
+    try:
+        timer = StageTimer()
+        members_skipped = 0
+        # record ranges of the compressed segment, when it is split
+        ranges = None
+        resume = read_checkpoint(csv_name)
+        if resumable(output_filename, resume) and "parts" in resume:
+            # split by an earlier run, which left the compressed segment and the
+            # files of the parts it did not finish
+            ranges = [(part["start"], part["end"]) for part in resume["parts"]]
+            logger.info(
+                f"Resuming {url_crawl}, {sum(p['done'] for p in resume['parts'])} "
+                f"of {len(ranges)} parts done"
+            )
+        elif resumable(output_filename, resume):
+            # stopped by an earlier run, which left the segment ready to extract
+            logger.info(f"Resuming {url_crawl} at offset {resume['offset']}")
+        elif stop_requested():
+            # not started yet, it is downloaded again by the next run
+            return Counter(stopped=1), {"stopped": True}
+        elif split > 1 and row_queue is None and not record_index:
+            resume = None
+            ranges = split_gzip_members(output_filename + ".gz", split)
+        elif record_index:
+            resume = None
+            # offsets in the index are offsets in the compressed segment,
+            # so it is read directly instead of being decompressed first
+            os.replace(output_filename + ".gz", output_filename)
+        else:
+            resume = None
+            # Decompress, leaving out damaged records
+            if inflate_threads > 1:
+                members_skipped = decompress_parallel(
+                    output_filename + ".gz",
+                    output_filename,
+                    threads=inflate_threads,
+                    backend=INFLATE_BACKENDS[inflate_backend],
+                )
+            else:
+                members_skipped = decompress_gzip(
+                    output_filename + ".gz",
+                    output_filename,
+                    skip_corrupt=True,
+                    backend=INFLATE_BACKENDS[inflate_backend],
+                )
+            if members_skipped:
+                logger.warning(
+                    f"Left out {members_skipped} damaged gzip members of {url_crawl}"
+                )
+        timer.lap("decompress")
+
+        if ranges is not None:
+            stats, members_skipped, bytes_decompressed = extract_segment_parts(
+                ranges,
+                output_filename,
+                csv_name,
+                url_crawl,
+                wet_path,
+                profiles,
+                options,
+                timer,
+                resume,
+            )
+            if members_skipped:
+                logger.warning(
+                    f"Left out {members_skipped} damaged gzip members of {url_crawl}"
+                )
+            # unless the parts left are to be resumed from it
+            if not stats["stopped"]:
+                os.remove(output_filename + ".gz")
+        else:
+            bytes_decompressed = os.path.getsize(output_filename)
+
+            # Extract texts to csv file
+            digests_name = (
+                csv_name.replace(".csv", ".digests")
+                if options.digest_store is not None
+                else None
+            )
+            index_name = csv_name.replace(".csv", ".index") if record_index else None
+            files = None
+            if row_queue is not None:
+                files = QueuedSegmentFiles(
+                    row_queue,
+                    csv_name,
+                    [profile.csv_path(csv_name) for profile in profiles],
+                    digests_name,
+                    index_name,
+                    append=resume is not None,
+                )
+            stats = extract_from_segment(
+                output_filename,
+                csv_name,
+                url_crawl,
+                profiles,
+                options,
+                digests_filename=digests_name,
+                index_filename=index_name,
+                segment_path=wet_path,
+                timer=timer,
+                files=files,
+                resume=resume,
+                should_stop=stop_requested,
+            )
+
+            # Remove .wet file, unless it is needed to resume
+            if not stats["stopped"]:
+                os.remove(output_filename)
+    finally:
+        # also when the segment fails, so no SIGPROF outlives it
+        if sampler is not None:
+            sampler.stop()
+
+    if sampler is not None:
+        output_dir, csv_basename = os.path.split(csv_name)
+        folded_name = os.path.join(
+            output_dir, "flamegraphs", csv_basename.replace(".csv", ".folded")
+        )
+        sampler.write_folded(folded_name)
+        logger.info(f"Wrote profile of {wet_path} to {folded_name}")
+
+    metrics = {
+        f"{stage}_seconds": timer.seconds.get(stage, 0.0)
+        for stage in ["decompress", "parse", "match", "write"]
+    }
+    metrics["bytes_decompressed"] = bytes_decompressed
+    # the parts of a stopped split segment are not joined yet
+    metrics["bytes_out"] = (
+        sum(os.path.getsize(profile.csv_path(csv_name)) for profile in profiles)
+        if row_queue is None and not (ranges is not None and stats["stopped"])
+        else None
+    )
+    metrics["records_seen"] = stats["records_seen"]
+    metrics["records"] = stats["records"]
+    metrics["records_filtered"] = stats["records"] - stats["records_matched"]
+    metrics["records_matched"] = stats["records_matched"]
+    metrics["records_failed"] = stats["records_failed"]
+    metrics["read_errors"] = stats["read_errors"]
+    metrics["members_skipped"] = members_skipped
+    metrics["peak_rss_mb"] = peak_rss_mb()
+    if ranges is not None:
+        metrics["parts"] = len(ranges)
+    if resume is not None and "parts" in resume:
+        metrics["resumed_parts"] = sum(part["done"] for part in resume["parts"])
+    elif resume is not None:
+        metrics["resumed_from"] = resume["offset"]
+    if stats["stopped"]:
+        metrics["stopped"] = True
+    return stats, metrics
+
+
+# profiles and options of a worker process, set once by init_worker so the
+# postcode lookups are not sent with every segment
+worker_state = {}
+
+
+def init_worker(profiles, options):
+    worker_state["profiles"] = profiles
+    worker_state["options"] = options
+
+
+def process_segment_in_worker(
+    output_filename, csv_name, url_crawl, wet_path, row_queue=None
+):
+    """process_segment in a worker process. Also returns the filter counts of the segment"""
+
+    profiles = worker_state["profiles"]
+    before = [profile.pipeline.counts() for profile in profiles]
+    stats, metrics = process_segment(
+        output_filename,
+        csv_name,
+        url_crawl,
+        wet_path,
+        profiles,
+        worker_state["options"],
+        row_queue=row_queue,
+    )
+    counts = [
+        subtract_counts(profile.pipeline.counts(), profile_before)
+        for profile, profile_before in zip(profiles, before)
+    ]
+    return stats, metrics, counts
+
+
+def extract_segment_part(
+    part,
+    start,
+    end,
+    output_filename,
+    csv_name,
+    url_crawl,
+    wet_path,
+):
+    """
+    Decompress and extract the records between offsets start and end of a
+    compressed segment in a worker process, to files of the part (see
+    part_filename). Returns the stats, stage seconds, damaged members left out,
+    bytes decompressed, domains and filter counts of the part.
+    Once a stop is requested, the part stops like a segment (see
+    extract_from_segment) and keeps its decompressed file and checkpoint, from
+    which the next run resumes it.
+    """
+
+    profiles = worker_state["profiles"]
+    options = worker_state["options"]
+    before = [profile.pipeline.counts() for profile in profiles]
+    timer = StageTimer()
+    segment_part = part_filename(output_filename, part)
+    csv_part = part_filename(csv_name, part)
+    resume = read_checkpoint(csv_part)
+    if resumable(segment_part, resume):
+        members_skipped = resume["members_skipped"]
+    else:
+        resume = None
+        with open(output_filename + ".gz", "rb") as f_in:
+            with open(segment_part, "wb") as f_out:
+                members_skipped = inflate_gzip_members(
+                    f_in,
+                    f_out,
+                    start,
+                    end,
+                    INFLATE_BACKENDS[options.inflate_backend],
+                )
+    timer.lap("decompress")
+    bytes_decompressed = os.path.getsize(segment_part)
+
+    domains = []
+    stats = extract_from_segment(
+        segment_part,
+        csv_part,
+        url_crawl,
+        profiles,
+        options,
+        digests_filename=(
+            csv_part.replace(".csv", ".digests")
+            if options.digest_store is not None
+            else None
+        ),
+        segment_path=wet_path,
+        timer=timer,
+        resume=resume,
+        should_stop=stop_requested,
+        domains_out=domains,
+    )
+    if stats["stopped"]:
+        write_checkpoint(
+            csv_part, dict(read_checkpoint(csv_part), members_skipped=members_skipped)
+        )
+    else:
+        os.remove(segment_part)
+        remove_checkpoint(csv_part)
+    counts = [
+        subtract_counts(profile.pipeline.counts(), profile_before)
+        for profile, profile_before in zip(profiles, before)
+    ]
+    return stats, timer.seconds, members_skipped, bytes_decompressed, domains, counts
+
+
+def part_filename(filename, part):
+    """File of a part of a split segment, out of the patterns of the segment files"""
+    return f"{filename}.part{part}"
+
+
+def extract_segment_parts(
+    ranges,
+    output_filename,
+    csv_name,
+    url_crawl,
+    wet_path,
+    profiles,
+    options,
+    timer,
+    resume=None,
+):
+    """
+    Extract the record ranges of a compressed segment (see split_gzip_members) on a
+    forked process each, with options (an ExtractOptions), then join the files of the parts in order, so the segment
+    files are those of one pass. Domains of every part are merged before their rows
+    are written. The stage seconds of the parts are added to timer. Returns the
+    stats, the damaged members left out and the bytes decompressed.
+    When a stop is requested, the parts stop at their next record and the files of
+    the parts are kept, with a checkpoint of csv_name holding the results of the
+    parts that finished. With resume (such a checkpoint), only the other parts are
+    extracted, each from its own checkpoint (see extract_segment_part).
+    """
+
+    # results of the parts finished by the run that was stopped
+    finished = {}
+    if resume is not None:
+        for part, part_resume in enumerate(resume["parts"]):
+            if part_resume["done"]:
+                finished[part] = (
+                    Counter(part_resume["stats"]),
+                    {},
+                    part_resume["members_skipped"],
+                    part_resume["bytes_decompressed"],
+                    domains_from_json(part_resume["domains"]),
+                    None,
+                )
+
+    with ProcessPoolExecutor(
+        max(len(ranges) - len(finished), 1),
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=init_worker,
+        initargs=(profiles, options),
+    ) as executor:
+        futures = {
+            part: executor.submit(
+                extract_segment_part,
+                part,
+                start,
+                end,
+                output_filename,
+                csv_name,
+                url_crawl,
+                wet_path,
+            )
+            for part, (start, end) in enumerate(ranges)
+            if part not in finished
+        }
+        results = [
+            finished[part] if part in finished else futures[part].result()
+            for part in range(len(ranges))
+        ]
+    timer.restart()
+
+    stats = Counter()
+    members_skipped = 0
+    bytes_decompressed = 0
+    domains = [{} for _ in profiles]
+    for part_stats, seconds, skipped, part_bytes, part_domains, counts in results:
+        stats.update(part_stats)
+        for stage, stage_seconds in seconds.items():
+            timer.seconds[stage] = timer.seconds.get(stage, 0.0) + stage_seconds
+        members_skipped += skipped
+        bytes_decompressed += part_bytes
+        merge_domains(domains, part_domains)
+        # counted by the run that extracted the part
+        if counts is not None:
+            for profile, profile_counts in zip(profiles, counts):
+                profile.pipeline.add_counts(profile_counts)
+
+    if stats["stopped"]:
+        write_checkpoint(
+            csv_name,
+            {
+                "segment": wet_path,
+                "parts": [
+                    {
+                        "start": start,
+                        "end": end,
+                        "done": not part_stats["stopped"],
+                        "stats": part_stats,
+                        "members_skipped": skipped,
+                        "bytes_decompressed": part_bytes,
+                        "domains": domains_to_json(part_domains),
+                    }
+                    for (start, end), (
+                        part_stats,
+                        _,
+                        skipped,
+                        part_bytes,
+                        part_domains,
+                        _,
+                    ) in zip(ranges, results)
+                ],
+            },
+        )
+        stats["stopped"] = 1
+        return stats, members_skipped, bytes_decompressed
+
+    csv_paths = [profile.csv_path(csv_name) for profile in profiles]
+    paths = list(csv_paths)
+    if options.digest_store is not None:
+        paths.append(csv_name.replace(".csv", ".digests"))
+    for path in paths:
+        with open(path, "wb") as f_out:
+            for part in range(len(ranges)):
+                with open(part_filename(path, part), "rb") as f_in:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(part_filename(path, part))
+    if options.aggregate_domains:
+        with SegmentFiles(csv_paths, append=True) as files:
+            write_domain_rows(files, domains, url_crawl, options.content_store)
+    timer.lap("write")
+    return stats, members_skipped, bytes_decompressed
+
+
+def write_progress(output_dir, wet_paths_filename, start):
+    """
+    Write progress.json, read by progress.py to know how many segments output_dir
+    has to process. Runs on the same directory (a second pass, a resumed run, or
+    --retry_quarantined) add their wet paths to those of the earlier runs, and
+    segments counts the distinct segments of all of them, as metrics.jsonl keeps
+    the segments of every run.
+    """
+
+    progress_filename = os.path.join(output_dir, "progress.json")
+    wet_paths_files = [wet_paths_filename]
+    started = start.isoformat()
+    if os.path.exists(progress_filename):
+        try:
+            with open(progress_filename, "r", encoding="utf-8") as f_in:
+                previous = json.load(f_in)
+        except (OSError, ValueError):
+            previous = {}
+        earlier = previous.get("wet_paths", [])
+        if isinstance(earlier, str):
+            earlier = [earlier]
+        wet_paths_files = [
+            filename
+            for filename in earlier
+            if filename != wet_paths_filename and os.path.exists(filename)
+        ] + [wet_paths_filename]
+        started = previous.get("started", started)
+
+    segments = set()
+    for filename in wet_paths_files:
+        with open(filename, "r", encoding="utf-8") as f_in:
+            segments.update(line.strip() for line in f_in if line.strip())
+    with open(progress_filename, "w", encoding="utf-8") as f_out:
+        json.dump(
+            {
+                "wet_paths": wet_paths_files,
+                "segments": len(segments),
+                "started": started,
+                "run_started": start.isoformat(),
+            },
+            f_out,
+        )
+
+
+def segment_metrics(wet_path, download_metrics, metrics):
+    """One line of the metrics file: the segment, then download and processing metrics"""
+    line = {"segment": wet_path, "finished": datetime.now().isoformat()}
+    line.update(download_metrics)
+    line.update(metrics)
+    return line
+
+
 def main(
     wet_paths_filename,
     server,
     crawl,
     output_dir,
-    BristolPostcodeLookup,
+    profiles,
+    options=None,
+    workers=1,
+    prefetch=0,
+    download_threads=2,
+    write_queue_size=64,
+    autotune=None,
+    segment_cache=None,
+    http_client=None,
+    disk_budget=None,
+    frame_root=None,
+    segment_attempts=3,
+    append=False,
+    requeue=False,
 ):
-    """Function to download wet files, and extract and process information"""
+    """
+    Function to download wet files, and extract and process information.
+    Every segment is extracted with options (an ExtractOptions, see process_segment
+    and extract_from_segment); with its text_backend, the paths are WARC files.
+    With more than one worker or some prefetch, segments go through a staged pipeline
+    (see staged.run_staged): download_threads threads download them, up to prefetch
+    wait for the workers processes extracting them, and one writer thread writes the
+    rows, with at most write_queue_size batches of rows waiting for it. The largest
+    depths of both queues during each segment are added to its metrics.
+    With autotune (a dict of ConcurrencyController arguments), the staged pipeline is
+    used, and its download threads and workers are adjusted while it runs.
+    With a segment_cache (a SegmentCache), segments are taken from it when cached and
+    cached when downloaded, and its usage and hit rate are logged.
+    Segments are downloaded with http_client (an HttpClient, by default one without
+    rate limit), and the bandwidth of each download thread is logged.
+    With a disk_budget (a DiskBudget), a segment is only downloaded once the budget
+    admits it, and released when its files are removed, so the downloaded and
+    decompressed segments of every job sharing the budget fit on the disk.
+    With a frame_root, the texts of each merged csv are then packed into a FrameStore
+    there, named after the crawl (and profile), and replaced by their hash in the csv.
+    A segment that fails to download or extract is tried again once the others are
+    done, and after segment_attempts attempts it is added to the quarantine file of
+    output_dir (see quarantine_segment) and the run goes on without it. A segment
+    whose worker process died is quarantined at once.
+    With append, the rows are added to the merged csvs of an earlier run instead of
+    replacing them, e.g. when retrying quarantined segments.
+    Once a stop is requested (see checkpoint.install_stop_handlers), no segment is
+    started, the segments being extracted are checkpointed (see process_segment) and
+    the run ends without merging; the next run resumes them. With requeue, the SLURM
+    job is then put back in the queue.
+    With options.split above 1, each segment is split into that many record ranges
+    extracted on as many processes (see process_segment), one segment at a time.
+    """
+
+    if options is None:
+        options = ExtractOptions()
+    record_index = options.record_index
+    if options.split > 1 and (workers > 1 or prefetch or autotune is not None):
+        # the workers of the staged pipeline are daemon processes, without children
+        raise ValueError("Split segments are extracted one at a time, without workers")
+    if options.split > 1 and record_index:
+        raise ValueError("The record index is written from whole compressed segments")
 
     start = datetime.now()
     datetime_str = str(start)
+    if http_client is None:
+        http_client = HttpClient()
 
     # Setup logging
     logger.setLevel(logging.DEBUG)
@@ -181,11 +1336,16 @@ def main(
     handler = logging.FileHandler(f"{log_dir}/{datetime_str}.log")
     logger.addHandler(handler)
 
+    logger.info(f"Filter profiles: {profiles}")
     logger.info("---Reading wet paths---")
     num_lines = count_lines(wet_paths_filename)
     logger.info(f"Reading {num_lines} wet files")
+    write_progress(output_dir, wet_paths_filename, start)
+
+    # (output_filename, csv_name, url_crawl, wet_path) of the segments left to do
+    segments = []
     with open(wet_paths_filename, "r", encoding="utf-8") as wet_paths:
-        for wet_path in tqdm(wet_paths):
+        for wet_path in wet_paths:
             wet_path = wet_path.strip()
             url_crawl = server + wet_path
 
@@ -195,26 +1355,236 @@ def main(
                 continue
             output_filename = os.path.join(output_dir, output_filename)
 
-            csv_name = output_filename.replace(".wet", ".csv")
-            if os.path.exists(csv_name):
+            csv_name = os.path.splitext(output_filename)[0] + ".csv"
+            # a segment with a checkpoint was stopped half-way
+            if all(
+                os.path.exists(p.csv_path(csv_name)) for p in profiles
+            ) and not os.path.exists(checkpoint_path(csv_name)):
                 continue
+            segments.append((output_filename, csv_name, url_crawl, wet_path))
+    logger.info(f"{len(segments)} segments left to process")
+
+    def fetch(segment):
+        """
+        Download a segment, unless it is resumed from the file of its checkpoint,
+        which then holds the disk budget for the size of that file
+        """
+        output_filename, csv_name, url_crawl, wet_path = segment
+        if resumable(output_filename, read_checkpoint(csv_name)):
+            download_metrics = {"bytes_in": 0, "resumed": True}
+            if disk_budget is not None:
+                # the segment, compressed for a split one, and the files of its parts
+                held = [output_filename, output_filename + ".gz"] + glob.glob(
+                    glob.escape(output_filename) + ".part*"
+                )
+                download_metrics["disk_wait_seconds"] = disk_budget.reserve(
+                    csv_name,
+                    sum(os.path.getsize(f) for f in held if os.path.exists(f)),
+                    on_disk=True,
+                )
+            return download_metrics
+        return download_segment(
+            url_crawl,
+            output_filename,
+            segment_cache,
+            wet_path,
+            http_client,
+            disk_budget,
+            csv_name,
+        )
+
+    stopped = []
 
-            # Download
-            urlretrieve(url_crawl, output_filename + ".gz")
+    def segment_finished(segment, download_metrics, metrics):
+        """
+        Remove the checkpoint of a finished segment, and give back its disk budget
+        once its files are removed. Returns False for a segment that was stopped.
+        """
+        if metrics.get("stopped"):
+            stopped.append(segment)
+            if disk_budget is not None:
+                disk_budget.release(segment[1])
+            return False
+        remove_checkpoint(segment[1])
+        if disk_budget is None:
+            return True
+        disk_budget.release(segment[1])
+        # the compressed segment is replaced by the decompressed one at the end of
+        # decompression, so both are on disk at once
+        disk_budget.observe(
+            download_metrics["bytes_in"],
+            metrics["bytes_decompressed"]
+            + (0 if record_index else download_metrics["bytes_in"]),
+        )
+        return True
 
-            # Decompress
-            decompress_gzip(output_filename + ".gz", output_filename)
+    stats = Counter()
+    metrics_filename = os.path.join(output_dir, "metrics.jsonl")
+    logger.info(f"Writing segment metrics to {metrics_filename}")
+    with MetricsWriter(metrics_filename) as metrics_writer:
 
-            # Extract texts to csv file
-            extract_from_segment(
-                output_filename, csv_name, url_crawl, BristolPostcodeLookup
+        def run_sequential(round_segments):
+            errors = []
+            for segment in tqdm(round_segments):
+                if stop_requested():
+                    break
+                output_filename, csv_name, url_crawl, wet_path = segment
+                try:
+                    # Download
+                    download_metrics = fetch(segment)
+                    segment_stats, metrics = process_segment(
+                        output_filename,
+                        csv_name,
+                        url_crawl,
+                        wet_path,
+                        profiles,
+                        options,
+                    )
+                except Exception:
+                    errors.append((csv_name, f"{wet_path}: {traceback.format_exc()}"))
+                    continue
+                if not segment_finished(segment, download_metrics, metrics):
+                    continue
+                stats.update(segment_stats)
+                metrics_writer.write(
+                    segment_metrics(wet_path, download_metrics, metrics)
+                )
+            return errors
+
+        def run_pipeline(round_segments):
+            logger.info(
+                f"Using {download_threads} download threads, {workers} workers and "
+                f"prefetching {prefetch} segments"
+            )
+            progress_bar = tqdm(total=len(round_segments))
+
+            def segment_done(segment, download_metrics, result, files):
+                segment_stats, metrics, counts = result
+                if not segment_finished(segment, download_metrics, metrics):
+                    return
+                metrics["bytes_out"] = files.bytes_out()
+                stats.update(segment_stats)
+                for profile, profile_counts in zip(profiles, counts):
+                    profile.pipeline.add_counts(profile_counts)
+                metrics_writer.write(
+                    segment_metrics(segment[3], download_metrics, metrics)
+                )
+                progress_bar.update(1)
+
+            def segment_crashed(segment, message):
+                # a segment that killed its worker (e.g. out of memory) would
+                # kill the next one as well, so it is not tried again
+                logger.error(f"Quarantining {segment[3]}: {message}")
+                discard_segment(segment, profiles)
+                if disk_budget is not None:
+                    disk_budget.release(segment[1])
+                quarantine_segment(output_dir, segment[3], attempt, message)
+                progress_bar.update(1)
+
+            errors = run_staged(
+                round_segments,
+                fetch,
+                process_segment_in_worker,
+                segment_done,
+                initializer=init_worker,
+                initargs=(profiles, options),
+                workers=workers,
+                download_threads=download_threads,
+                prefetch=prefetch,
+                write_queue_size=write_queue_size,
+                controller=(
+                    ConcurrencyController(logger, **autotune)
+                    if autotune is not None
+                    else None
+                ),
+                should_stop=stop_requested,
+                on_crash=segment_crashed,
+            )
+            progress_bar.close()
+            return errors
+
+        sequential = workers <= 1 and prefetch == 0 and autotune is None
+        run_round = run_sequential if sequential else run_pipeline
+        by_key = {segment[1]: segment for segment in segments}
+        # failed segments are tried again after the others, so a bad segment does
+        # not hold the rest back, and set aside after segment_attempts attempts
+        pending = segments
+        for attempt in range(1, max(segment_attempts, 1) + 1):
+            errors = dict(run_round(pending))
+            if not errors or stop_requested():
+                break
+            pending = [by_key[key] for key in errors]
+            for key, message in errors.items():
+                logger.error(f"Attempt {attempt} of {by_key[key][3]} failed: {message}")
+                discard_segment(by_key[key], profiles)
+                if disk_budget is not None:
+                    disk_budget.release(key)
+            if attempt < segment_attempts:
+                logger.info(f"Trying {len(pending)} failed segments again")
+        else:
+            for segment in pending:
+                quarantine_segment(
+                    output_dir, segment[3], segment_attempts, errors[segment[1]]
+                )
+            logger.warning(
+                f"{len(pending)} segments failed {segment_attempts} times and were "
+                f"quarantined in {os.path.join(output_dir, QUARANTINE_FILENAME)}, "
+                "run again with --retry_quarantined to process them alone"
             )
 
-            # Remove .wet file
-            os.remove(output_filename)
+    if stop_requested():
+        http_client.close()
+        logger.warning(
+            f"Stopped by a signal with {len(stopped)} segments in progress: running "
+            "again resumes those with a checkpoint and processes the segments left"
+        )
+        if requeue:
+            requeue_job(logger)
+        return
+
     logger.info("Finished downloading and extracting wet files")
+    for thread, thread_stats in sorted(http_client.worker_stats().items()):
+        logger.info(
+            f"Downloads of {thread}: {thread_stats['downloads']} segments, "
+            f"{thread_stats['bytes'] / 1e6:.1f} MB at {thread_stats['bandwidth'] / 1e6:.2f} MB/s, "
+            f"{thread_stats['retries']} retries, "
+            f"{thread_stats['throttled_seconds']:.1f} s throttled"
+        )
+    http_client.close()
+    if disk_budget is not None:
+        logger.info(
+            f"Disk budget: {disk_budget.in_use() / 1e9:.2f} of "
+            f"{disk_budget.max_bytes / 1e9:.2f} GB in use by the jobs of the node"
+        )
+    if segment_cache is not None:
+        logger.info(f"Segment cache: {segment_cache.summary()}")
+    logger.info(f"{stats['records']} records read")
+    for profile in profiles:
+        logger.info(f"Filters of profile {profile.name}:")
+        for line in profile.pipeline.summary():
+            logger.info(f"    {line}")
+    if options.digest_store is not None:
+        hit_rate = stats["digest_hits"] / max(stats["digest_lookups"], 1)
+        logger.info(
+            f"Digest store hits for crawl {crawl}: {stats['digest_hits']} of "
+            f"{stats['digest_lookups']} records ({hit_rate:.1%})"
+        )
     logger.info("Merging csvs")
-    merge_csvs(crawl, output_dir)
+    content_column = "content" if options.content_store is None else "content_hash"
+    for profile in profiles:
+        merge_csvs(
+            crawl,
+            profile.output_dir(output_dir),
+            content_column=content_column,
+            append=append,
+        )
+        if frame_root is not None:
+            name = crawl if profile.name is None else f"{profile.name}_{crawl}"
+            merged_csv = os.path.join(profile.output_dir(output_dir), f"df{crawl}.csv")
+            logger.info(
+                f"Packing the texts of {merged_csv} into {frame_root}{name}.zst"
+            )
+            pack_csv(merged_csv, frame_root, name)
 
     end = datetime.now()
     run_time = end - start
@@ -224,6 +1594,7 @@ def main(
 
 if __name__ == "__main__":
     args = parse_args()
+    install_stop_handlers()
 
     wet_paths_filename = args.wet_file
     num_chunks = args.num_chunks
@@ -231,13 +1602,119 @@ if __name__ == "__main__":
     crawl = args.crawl
     postcode_list = args.postcode_list
     output_dir = args.outputs_dir
-
-    BristolPostcodeLookup = pd.read_csv(postcode_list)
-
-    num_lines = count_lines(wet_paths_filename)
-    if num_lines % num_chunks != 0:
+    if args.pack_content is not None and args.content_store is not None:
         raise ValueError(
-            "The number of lines in the wet file should be divisible by the number of chunks"
+            "With --content_store the csvs hold no text to pack with --pack_content"
         )
+    content_store = (
+        ContentStore(args.content_store) if args.content_store is not None else None
+    )
+    digest_store = None
+    if args.digest_store is not None:
+        if os.path.exists(os.path.join(args.digest_store, "seen.bloom")):
+            digest_store = DigestStore.load(args.digest_store)
+        else:
+            # nothing known yet: only write the .digests files for later runs
+            digest_store = DigestStore.empty(capacity=1)
 
-    main(wet_paths_filename, server, crawl, output_dir, BristolPostcodeLookup)
+    if args.profiles is not None:
+        profiles = load_profiles(args.profiles)
+    else:
+        profiles = [
+            FilterProfile.from_csv(
+                None,
+                postcode_list,
+                index_path=args.postcode_index,
+                postcode_prefix=args.postcode_prefix or None,
+            )
+        ]
+
+    if args.retry_quarantined:
+        if args.pack_content is not None:
+            raise ValueError(
+                "--pack_content cannot add to the packed texts of an earlier run, "
+                "pack them again once the quarantined segments are done"
+            )
+        wet_paths_filename = quarantined_wet_paths(output_dir)
+        if wet_paths_filename is None:
+            print(f"No quarantined segments in {output_dir}")
+            raise SystemExit(0)
+    else:
+        num_lines = count_lines(wet_paths_filename)
+        if num_lines % num_chunks != 0:
+            raise ValueError(
+                "The number of lines in the wet file should be divisible by the number of chunks"
+            )
+
+    main(
+        wet_paths_filename,
+        server,
+        crawl,
+        output_dir,
+        profiles,
+        ExtractOptions(
+            content_store=content_store,
+            aggregate_domains=args.aggregate_domains,
+            digest_store=digest_store,
+            record_index=args.record_index,
+            text_backend=(
+                TEXT_BACKENDS[args.text_backend]
+                if args.input_format == "warc"
+                else None
+            ),
+            slow_record_seconds=args.slow_record_seconds or None,
+            profile_fraction=args.profile_fraction if args.profile else 0.0,
+            profile_interval=args.profile_interval,
+            max_text_bytes=args.max_text_bytes,
+            window_size=args.window_size,
+            tolerant_postcodes=args.tolerant_postcodes,
+            split=args.split_segments,
+            inflate_threads=args.inflate_threads,
+            inflate_backend=args.inflate_backend,
+        ),
+        workers=args.workers,
+        prefetch=args.prefetch,
+        download_threads=args.download_threads,
+        write_queue_size=args.write_queue,
+        http_client=HttpClient(
+            node_limiter(
+                args.rate_limiter_file,
+                args.node_bandwidth,
+                args.node_requests_per_second,
+            ),
+            retries=args.download_retries,
+        ),
+        segment_cache=(
+            SegmentCache(
+                args.segment_cache,
+                int(args.segment_cache_gb * 1e9),
+                args.segment_cache_verify,
+            )
+            if args.segment_cache is not None
+            else None
+        ),
+        disk_budget=(
+            DiskBudget(
+                int(args.disk_budget_gb * 1e9),
+                args.disk_budget_file,
+                directory=output_dir,
+                min_free_bytes=int(args.min_free_gb * 1e9),
+            )
+            if args.disk_budget_gb is not None
+            else None
+        ),
+        autotune=(
+            {
+                "max_workers": args.max_workers,
+                "max_download_threads": args.max_download_threads,
+                "max_memory_mb": args.max_memory_mb,
+                "interval": args.autotune_interval,
+            }
+            if args.autotune
+            else None
+        ),
+        frame_root=args.pack_content,
+        segment_attempts=args.segment_attempts,
+        append=args.retry_quarantined,
+        requeue=args.requeue,
+    )
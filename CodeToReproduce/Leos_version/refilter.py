@@ -0,0 +1,281 @@
+"""Re-run the extraction on the records of a record index, fetching them with HTTP range requests"""
+
+import argparse
+import csv
+import glob
+import logging
+import os
+
+from collections import Counter, defaultdict
+from datetime import datetime
+from urllib.request import Request, urlopen
+
+from tqdm import tqdm
+
+from content_store import ContentStore
+from extract_options import ExtractOptions
+from helper_functions import construct_output_filename
+from profiles import FilterProfile, load_profiles
+from read_wet import TEXT_BACKENDS, extract_from_segment, merge_csvs
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="Re-filter the records of a record index with a new postcode list"
+    )
+    parser.add_argument(
+        "--index",
+        type=str,
+        default="outputs/*.index",
+        help="glob pattern of the .index files written by read_wet.py --record_index",
+    )
+    parser.add_argument(
+        "--outputs_dir",
+        type=str,
+        default="refiltered/",
+        help="outputs directory where the fetched records will be processed",
+    )
+    parser.add_argument(
+        "--server",
+        type=str,
+        default="https://data.commoncrawl.org/",
+        help="server from where we fetch the records",
+    )
+    parser.add_argument(
+        "--crawl",
+        type=str,
+        default="202350",
+        help="Crawl number - it normally follows the structure year + two digits (e.g. 202350)",
+    )
+    parser.add_argument(
+        "--postcode_list",
+        type=str,
+        default="BristolPostcodeLookup.csv",
+        help="File with postcodes list",
+    )
+    parser.add_argument(
+        "--postcode_prefix",
+        type=str,
+        default="BS",
+        help="Only keep postcodes of the postcode list starting with this prefix (empty string for any)",
+    )
+    parser.add_argument(
+        "--profiles",
+        type=str,
+        default=None,
+        help="json file with a list of filter profiles (see profiles.py). Replaces --postcode_list and --postcode_prefix",
+    )
+    parser.add_argument(
+        "--content_store",
+        type=str,
+        default=None,
+        help="Directory of the content-addressed text store. If given, csvs hold a content hash instead of the page text",
+    )
+    parser.add_argument(
+        "--aggregate_domains",
+        action="store_true",
+        help="Write one row per domain (parent_url) and segment, with the union of its postcodes and only the landing-page text",
+    )
+    parser.add_argument(
+        "--input_format",
+        type=str,
+        choices=["wet", "warc"],
+        default="wet",
+        help="wet for indexes of WET files. warc for indexes of WARC files, whose html is extracted with --text_backend",
+    )
+    parser.add_argument(
+        "--text_backend",
+        type=str,
+        choices=sorted(TEXT_BACKENDS),
+        default="html2text",
+        help="text extraction from html for --input_format warc",
+    )
+    pars_args = parser.parse_args()
+    print("the inputs are:")
+    for arg in vars(pars_args):
+        print(f"{arg} is {getattr(pars_args, arg)}")
+    return pars_args
+
+
+def read_index(index_pattern):
+    """Dictionary segment path -> list of (offset, length) of its indexed records"""
+
+    index_files = sorted(glob.glob(index_pattern))
+    if not index_files:
+        raise FileNotFoundError(f"No files matched pattern: {index_pattern}")
+
+    ranges = defaultdict(list)
+    for index_file in index_files:
+        with open(index_file, "r", newline="") as f_in:
+            for segment_path, offset, length, *_ in csv.reader(f_in):
+                ranges[segment_path].append((int(offset), int(length)))
+    return ranges
+
+
+def coalesce_ranges(ranges):
+    """Merge adjacent or overlapping (offset, length) ranges into as few as possible"""
+
+    coalesced = []
+    for offset, length in sorted(ranges):
+        if coalesced and offset <= coalesced[-1][0] + coalesced[-1][1]:
+            start, previous_length = coalesced[-1]
+            coalesced[-1] = (start, max(previous_length, offset + length - start))
+        else:
+            coalesced.append((offset, length))
+    return coalesced
+
+
+def fetch_range(url, offset, length):
+    """Bytes [offset, offset + length) of url"""
+
+    request = Request(url, headers={"Range": f"bytes={offset}-{offset + length - 1}"})
+    with urlopen(request) as response:
+        if response.status != 206:
+            raise ValueError(f"{url} does not support range requests")
+        return response.read()
+
+
+def remote_size(url):
+    """Size in bytes of the file at url"""
+
+    with urlopen(Request(url, method="HEAD")) as response:
+        return int(response.headers["Content-Length"])
+
+
+def refilter_segment(
+    segment_path,
+    ranges,
+    server,
+    crawl,
+    output_dir,
+    profiles,
+    options=None,
+):
+    """
+    Fetch the indexed records of one segment and run the extraction on them, with
+    options (an ExtractOptions, see extract_from_segment).
+    Each record is a gzip member, so the fetched ranges are concatenated into a
+    smaller but valid .warc.wet.gz (or .warc.gz, extracted with the text_backend of
+    options). Returns the number of bytes fetched.
+    """
+
+    url_crawl = server + segment_path
+    output_filename = construct_output_filename(segment_path, crawl)
+    if output_filename is None:
+        return 0
+    output_filename = os.path.join(output_dir, output_filename)
+    csv_name = os.path.splitext(output_filename)[0] + ".csv"
+    output_filename += ".gz"
+    if all(os.path.exists(p.csv_path(csv_name)) for p in profiles):
+        return 0
+
+    fetched = 0
+    with open(output_filename, "wb") as f_out:
+        for offset, length in coalesce_ranges(ranges):
+            data = fetch_range(url_crawl, offset, length)
+            f_out.write(data)
+            fetched += len(data)
+
+    extract_from_segment(
+        output_filename,
+        csv_name,
+        url_crawl,
+        profiles,
+        options,
+    )
+    os.remove(output_filename)
+    return fetched
+
+
+def main(
+    index_pattern,
+    server,
+    crawl,
+    output_dir,
+    profiles,
+    options=None,
+):
+    """
+    Function to fetch the indexed records, and extract and process information with
+    options (an ExtractOptions)
+    """
+
+    if options is None:
+        options = ExtractOptions()
+
+    start = datetime.now()
+    datetime_str = str(start)
+
+    # Setup logging
+    logger.setLevel(logging.DEBUG)
+    log_dir = f"{output_dir}/logs"
+    os.makedirs(log_dir, exist_ok=True)
+    handler = logging.FileHandler(f"{log_dir}/{datetime_str}.log")
+    logger.addHandler(handler)
+
+    ranges = read_index(index_pattern)
+    logger.info(f"Refiltering {len(ranges)} segments")
+    transferred = Counter()
+    for segment_path, segment_ranges in tqdm(ranges.items()):
+        fetched = refilter_segment(
+            segment_path,
+            segment_ranges,
+            server,
+            crawl,
+            output_dir,
+            profiles,
+            options,
+        )
+        if fetched:
+            transferred["fetched"] += fetched
+            transferred["segments"] += remote_size(server + segment_path)
+    logger.info(
+        f"Fetched {transferred['fetched']} bytes of {transferred['segments']} "
+        f"({transferred['fetched'] / max(transferred['segments'], 1):.2%} of a full download)"
+    )
+
+    logger.info("Merging csvs")
+    content_column = "content" if options.content_store is None else "content_hash"
+    for profile in profiles:
+        merge_csvs(crawl, profile.output_dir(output_dir), content_column=content_column)
+
+    end = datetime.now()
+    run_time = end - start
+    logger.info("--End of Script-------")
+    logger.info(f"running time: {run_time}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    content_store = (
+        ContentStore(args.content_store) if args.content_store is not None else None
+    )
+    if args.profiles is not None:
+        profiles = load_profiles(args.profiles)
+    else:
+        profiles = [
+            FilterProfile.from_csv(
+                None, args.postcode_list, postcode_prefix=args.postcode_prefix or None
+            )
+        ]
+
+    main(
+        args.index,
+        args.server,
+        args.crawl,
+        args.outputs_dir,
+        profiles,
+        ExtractOptions(
+            content_store=content_store,
+            aggregate_domains=args.aggregate_domains,
+            text_backend=(
+                TEXT_BACKENDS[args.text_backend]
+                if args.input_format == "warc"
+                else None
+            ),
+        ),
+    )
@@ -0,0 +1,254 @@
+"""Local cache of downloaded segments, shared by the runs and jobs of a node, with a size cap"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime
+
+COUNTERS = ["hits", "misses", "corrupt", "evictions", "bytes_saved"]
+
+
+class SegmentCache:
+    """
+    Segments keyed by their wet.paths entry, in ``{root}/{key[:2]}/{key}.gz`` with
+    a ``{key}.json`` sidecar holding the entry, size and sha256 of the file (key is
+    the sha256 of the entry). The mtime of a segment is its last use, and once the
+    segments take more than max_bytes the least recently used are removed.
+    A segment is checked against its sidecar (size and sha256, or size only with
+    verify="size") before it is used, and a corrupt one is removed.
+    Changes happen under an flock of ``{root}/.lock`` and files are written under a
+    temporary name then renamed, so several jobs can share the cache. Hits, misses,
+    corrupt segments, evictions and bytes not downloaded are counted in this object
+    and, for every run, in ``{root}/stats.json``.
+    """
+
+    def __init__(self, root, max_bytes, verify="sha256"):
+        if verify not in ("sha256", "size"):
+            raise ValueError(f"verify should be sha256 or size, not {verify}")
+        self.root = root
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        # download threads share the object
+        self._counts_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(wet_path):
+        return hashlib.sha256(wet_path.strip().encode("utf-8")).hexdigest()
+
+    def path(self, wet_path, extension="gz"):
+        """Path of the cached segment of wet_path (or of its sidecar)"""
+        key = self.key(wet_path)
+        return os.path.join(self.root, key[:2], f"{key}.{extension}")
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.root, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _count(self, **increments):
+        """Add increments to the counters of this object and of stats.json"""
+
+        with self._counts_lock:
+            for name, increment in increments.items():
+                self.counts[name] += increment
+        with self._locked():
+            totals = self.read_stats()
+            for name, increment in increments.items():
+                totals[name] = totals.get(name, 0) + increment
+            tmp_path = os.path.join(self.root, f"stats.json.{os.getpid()}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f_out:
+                json.dump(totals, f_out)
+            os.replace(tmp_path, os.path.join(self.root, "stats.json"))
+
+    def read_stats(self):
+        """Counters of every run that used the cache"""
+        try:
+            with open(
+                os.path.join(self.root, "stats.json"), "r", encoding="utf-8"
+            ) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict.fromkeys(COUNTERS, 0)
+
+    @staticmethod
+    def _digest(filename):
+        sha256 = hashlib.sha256()
+        with open(filename, "rb") as f_in:
+            for block in iter(lambda: f_in.read(1024 * 1024), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    def _remove(self, wet_path):
+        for extension in ["gz", "json"]:
+            try:
+                os.remove(self.path(wet_path, extension))
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, wet_path, filename):
+        """
+        Put the cached segment of wet_path at filename (a hard link, or a copy across
+        filesystems) and return True, or return False if it is not cached or corrupt
+        """
+
+        segment_path = self.path(wet_path)
+        with self._locked():
+            try:
+                with open(self.path(wet_path, "json"), "r", encoding="utf-8") as f_in:
+                    entry = json.load(f_in)
+                # the mtime is the last use, for eviction
+                os.utime(segment_path)
+                # linked (or copied across filesystems) under the lock, so an
+                # eviction cannot remove it meanwhile
+                os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+                if os.path.exists(filename):
+                    os.remove(filename)
+                try:
+                    os.link(segment_path, filename)
+                except OSError:
+                    shutil.copyfile(segment_path, filename)
+            except (OSError, ValueError):
+                entry = None
+        if entry is None:
+            self._count(misses=1)
+            return False
+
+        size = os.path.getsize(filename)
+        if size != entry["size"] or (
+            self.verify == "sha256" and self._digest(filename) != entry["sha256"]
+        ):
+            os.remove(filename)
+            with self._locked():
+                self._remove(wet_path)
+            self._count(misses=1, corrupt=1)
+            return False
+        self._count(hits=1, bytes_saved=size)
+        return True
+
+    def put(self, wet_path, filename):
+        """Cache the downloaded segment of wet_path at filename, then evict if needed"""
+
+        size = os.path.getsize(filename)
+        if size > self.max_bytes:
+            return
+        segment_path = self.path(wet_path)
+        directory = os.path.dirname(segment_path)
+        os.makedirs(directory, exist_ok=True)
+        # linked (or copied across filesystems) under a temporary name, outside the lock
+        tmp_path = f"{segment_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            try:
+                os.link(filename, tmp_path)
+            except OSError:
+                shutil.copyfile(filename, tmp_path)
+            entry = {
+                "wet_path": wet_path.strip(),
+                "size": size,
+                "sha256": self._digest(tmp_path),
+                "added": datetime.now().isoformat(),
+            }
+            with self._locked():
+                os.replace(tmp_path, segment_path)
+                with open(self.path(wet_path, "json"), "w", encoding="utf-8") as f:
+                    json.dump(entry, f)
+                evicted = self._evict()
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if evicted:
+            self._count(evictions=evicted)
+
+    def entries(self):
+        """(last use, size, segment path) of every cached segment"""
+
+        entries = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".gz"):
+                    try:
+                        stat = os.stat(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append(
+                        (stat.st_mtime, stat.st_size, os.path.join(directory, name))
+                    )
+        return entries
+
+    def usage(self):
+        """Number of cached segments and their bytes"""
+        entries = self.entries()
+        return len(entries), sum(size for _, size, _ in entries)
+
+    def _evict(self):
+        """Remove the least recently used segments until under max_bytes (under lock)"""
+
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, segment_path in entries:
+            if total <= self.max_bytes:
+                break
+            for filename in [segment_path, segment_path[: -len("gz")] + "json"]:
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            evicted += 1
+        return evicted
+
+    def evict(self):
+        """Apply max_bytes now, e.g. after lowering it. Returns the segments removed"""
+        with self._locked():
+            evicted = self._evict()
+        if evicted:
+            self._count(evictions=evicted)
+        return evicted
+
+    def summary(self, counts=None):
+        """One line of usage and hit rate, of counts (by default those of this object)"""
+
+        counts = self.counts if counts is None else counts
+        num_segments, num_bytes = self.usage()
+        lookups = counts.get("hits", 0) + counts.get("misses", 0)
+        hit_rate = counts.get("hits", 0) / max(lookups, 1)
+        return (
+            f"{num_segments} segments, {num_bytes / 1e9:.2f} of {self.max_bytes / 1e9:.2f} GB; "
+            f"{counts.get('hits', 0)} hits of {lookups} lookups ({hit_rate:.1%}), "
+            f"{counts.get('bytes_saved', 0) / 1e9:.2f} GB not downloaded, "
+            f"{counts.get('corrupt', 0)} corrupt, {counts.get('evictions', 0)} evicted"
+        )
+
+
+def parse_args():
+    """Parsing arguments function"""
+    parser = argparse.ArgumentParser(
+        description="Report the usage and hit rate of a segment cache, or apply its size cap"
+    )
+    parser.add_argument("command", choices=["stats", "evict"])
+    parser.add_argument("--root", type=str, required=True, help="cache directory")
+    parser.add_argument(
+        "--max_gb", type=float, default=500, help="size cap of the cache in GB"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    cache = SegmentCache(args.root, int(args.max_gb * 1e9))
+    if args.command == "evict":
+        print(f"Evicted {cache.evict()} segments")
+    print(cache.summary(cache.read_stats()))
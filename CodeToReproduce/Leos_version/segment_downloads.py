@@ -0,0 +1,79 @@
+"""Downloading a segment, from a segment cache, within a disk budget and through an HttpClient"""
+
+import os
+import threading
+
+from urllib.request import urlretrieve
+
+from telemetry import StageTimer
+
+
+def download_segment(
+    url_crawl,
+    output_filename,
+    segment_cache=None,
+    wet_path=None,
+    http_client=None,
+    disk_budget=None,
+    key=None,
+):
+    """
+    Download a segment to output_filename.gz. Returns the download metrics.
+    With a disk_budget (a DiskBudget), the download waits until the budget admits
+    the segment under key, then fits the reservation to the size downloaded; the
+    caller releases it once the segment files are removed. The seconds waited are
+    added to the metrics.
+    With a segment_cache (a SegmentCache), the segment is taken from the cache if
+    it is there, and cached after its download otherwise.
+    With an http_client (an HttpClient), the download reuses its connections and
+    follows its rate limit and retries, and its retries and time throttled are
+    added to the metrics.
+    """
+
+    metrics = {}
+    if disk_budget is not None:
+        metrics["disk_wait_seconds"] = disk_budget.reserve(key)
+    try:
+        metrics.update(
+            fetch_segment(
+                url_crawl, output_filename, segment_cache, wet_path, http_client
+            )
+        )
+    except BaseException:
+        if disk_budget is not None:
+            disk_budget.release(key)
+        raise
+    if disk_budget is not None:
+        disk_budget.fit(key, metrics["bytes_in"])
+    return metrics
+
+
+def fetch_segment(url_crawl, output_filename, segment_cache, wet_path, http_client):
+    """Download a segment to output_filename.gz, or take it from segment_cache"""
+
+    timer = StageTimer()
+    filename_gz = output_filename + ".gz"
+    metrics = {}
+    cache_hit = None
+    if segment_cache is not None:
+        cache_hit = segment_cache.fetch(wet_path, filename_gz)
+    if not cache_hit:
+        # may be a link to a cached segment left by an interrupted run (with or
+        # without --segment_cache), which the download would overwrite in place
+        if os.path.exists(filename_gz):
+            os.remove(filename_gz)
+        if http_client is not None:
+            client_metrics = http_client.download(url_crawl, filename_gz)
+            metrics["retries"] = client_metrics["retries"]
+            metrics["throttled_seconds"] = client_metrics["throttled_seconds"]
+            metrics["download_thread"] = threading.current_thread().name
+        else:
+            urlretrieve(url_crawl, filename_gz)
+        if segment_cache is not None:
+            segment_cache.put(wet_path, filename_gz)
+    timer.lap("download")
+    metrics["download_seconds"] = timer.seconds["download"]
+    metrics["bytes_in"] = os.path.getsize(filename_gz)
+    if cache_hit is not None:
+        metrics["cache_hit"] = cache_hit
+    return metrics
@@ -0,0 +1,97 @@
+"""Output files of a segment, written directly or sent through a queue to a writer"""
+
+import csv
+import os
+
+
+class SegmentFiles:
+    """
+    The csv of every profile for one segment, and the optional digests and index
+    sidecars. write(kind, row) writes a row to the csv of profile number kind, or
+    to the "digests" or "index" sidecar. With append, rows are added to existing
+    files, e.g. of a segment resumed from a checkpoint.
+    """
+
+    def __init__(
+        self, csv_paths, digests_filename=None, index_filename=None, append=False
+    ):
+        self.append = append
+        self.paths = dict(enumerate(csv_paths))
+        if digests_filename is not None:
+            self.paths["digests"] = digests_filename
+        if index_filename is not None:
+            self.paths["index"] = index_filename
+        self.csv_paths = list(csv_paths)
+        self._files = {}
+        self._writers = {}
+
+    def __enter__(self):
+        for kind, path in self.paths.items():
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._files[kind] = open(path, "a" if self.append else "w", newline="")
+            self._writers[kind] = csv.writer(self._files[kind])
+        return self
+
+    def write(self, kind, row):
+        self._writers[kind].writerow(row)
+
+    def write_rows(self, rows):
+        """Write (kind, row) pairs"""
+        for kind, row in rows:
+            self._writers[kind].writerow(row)
+
+    def __exit__(self, *exc_info):
+        for f_out in self._files.values():
+            f_out.close()
+
+    def bytes_out(self):
+        """Bytes written to the profile csvs"""
+        return sum(os.path.getsize(path) for path in self.csv_paths)
+
+    def remove(self):
+        """Remove every file, e.g. of a segment that failed half-way"""
+        for path in self.paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class QueuedSegmentFiles:
+    """
+    Same interface as SegmentFiles, but rows are sent in batches of batch_size to
+    queue, as ("open", key, files arguments), ("rows", key, [(kind, row), ...]),
+    for a writer owning the actual files (see staged.SegmentWriter). A bounded queue
+    blocks write when the writer falls behind.
+    """
+
+    def __init__(
+        self,
+        queue,
+        key,
+        csv_paths,
+        digests_filename=None,
+        index_filename=None,
+        append=False,
+        batch_size=256,
+    ):
+        self.queue = queue
+        self.key = key
+        self.arguments = (list(csv_paths), digests_filename, index_filename, append)
+        self.batch_size = batch_size
+        self._batch = []
+
+    def __enter__(self):
+        self.queue.put(("open", self.key, self.arguments))
+        return self
+
+    def write(self, kind, row):
+        self._batch.append((kind, row))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self.queue.put(("rows", self.key, self._batch))
+            self._batch = []
+
+    def __exit__(self, *exc_info):
+        self.flush()
@@ -0,0 +1,644 @@
+"""
+Staged extraction: download threads, extraction processes and a single writer,
+connected by bounded queues so a slow stage holds back the ones before it
+"""
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from segment_files import SegmentFiles
+from telemetry import rss_mb
+
+
+def queue_depth(q):
+    """Items waiting in q, None where the platform cannot tell (macOS)"""
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None
+
+
+def available_cpus():
+    """CPUs this process may run on (e.g. those given to a SLURM job)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def put_while_alive(q, item, processes, timeout=1.0):
+    """q.put(item), waiting while the queue is full, unless every process died"""
+    while True:
+        try:
+            q.put(item, timeout=timeout)
+            return
+        except queue.Full:
+            if not any(process.is_alive() for process in processes):
+                raise RuntimeError("Every extraction process exited")
+
+
+def extraction_loop(segment_queue, row_queue, starts, process, initializer, initargs):
+    """
+    Main loop of an extraction process: process(*segment, row_queue=row_queue) for
+    every (segment, download_metrics) of segment_queue until a None. The pid of the
+    process and each segment it starts go to starts (a SimpleQueue, written at once
+    rather than by a feeder thread, so it is not lost if the process is killed).
+    """
+
+    initializer(*initargs)
+    while True:
+        item = segment_queue.get()
+        if item is None:
+            break
+        segment, download_metrics = item
+        # segments are keyed by their csv name
+        key = segment[1]
+        # so the writer knows which segment is lost if this process dies
+        starts.put((os.getpid(), segment))
+        try:
+            result = process(*segment, row_queue=row_queue)
+            row_queue.put(("done", key, (segment, download_metrics, result)))
+        except Exception:
+            row_queue.put(("error", key, (segment, traceback.format_exc())))
+    row_queue.put(("exit", None, None))
+
+
+class AdjustableLimit:
+    """A semaphore whose number of slots can be changed while it is in use"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def set(self, limit):
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    def __enter__(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+
+class SegmentWriter:
+    """
+    The writer stage. Owns the output files of the segments being extracted: opens
+    them, writes the row batches sent by QueuedSegmentFiles, and closes them when
+    their segment is done, calling on_done(segment, download_metrics, result, files).
+    Files of a segment that failed are removed, so a later run does it again, and
+    its (key, message) is added to errors.
+    When an extraction process dies (e.g. killed for running out of memory), the
+    segment it last started (from starts, see extraction_loop) fails as soon as its
+    sentinel is ready, unless the messages already queued finish it; with on_crash,
+    on_crash(segment, message) is called for it instead of adding it to errors.
+    The depth of every queue in queues is sampled at each message, and the largest
+    depths since the previous segment are given to on_done in download_metrics,
+    with the items of status() if given.
+    Runs until closed is set and every process in processes (which may grow
+    meanwhile) has exited.
+    """
+
+    def __init__(
+        self,
+        row_queue,
+        processes,
+        on_done,
+        queues,
+        status=None,
+        starts=None,
+        on_crash=None,
+    ):
+        self.row_queue = row_queue
+        self.starts = starts
+        self.processes = processes
+        self.on_done = on_done
+        self.queues = queues
+        self.status = status
+        self.on_crash = on_crash
+        self.closed = threading.Event()
+        self.errors = []
+        self.segments_done = 0
+        self.bytes_done = 0
+        self._files = {}
+        self._max_depths = {}
+        # pid -> segments started by each extraction process, not known to be
+        # finished (the messages of a killed process may be lost)
+        self._extracting = {}
+        # keys of the segments done or failed
+        self._finished = set()
+        # processes that exited, gracefully or not
+        self._exits = 0
+        self._dead = set()
+
+    def _sample(self):
+        for name, q in self.queues.items():
+            depth = queue_depth(q)
+            if depth is not None:
+                self._max_depths[name] = max(self._max_depths.get(name, 0), depth)
+
+    def _discard(self, key):
+        """Forget a segment, removing its files"""
+        self._finished.add(key)
+        files = self._files.pop(key, None)
+        if files is not None:
+            files.__exit__(None, None, None)
+            files.remove()
+
+    def _fail(self, key, message):
+        self._discard(key)
+        self.errors.append((key, message))
+
+    def _check_processes(self):
+        """Fail the segments of the extraction processes that died since last time"""
+
+        sentinels = {
+            process.sentinel: process
+            for process in self.processes
+            if process.pid not in self._dead
+        }
+        ready = multiprocessing.connection.wait(list(sentinels), timeout=0)
+        if not ready:
+            return
+        # what the dead processes sent before dying, e.g. that their segment is done
+        for _ in range(queue_depth(self.row_queue) or 0):
+            try:
+                self._handle(*self.row_queue.get_nowait())
+            except queue.Empty:
+                break
+        self._read_starts()
+        for sentinel in ready:
+            process = sentinels[sentinel]
+            process.join()
+            self._dead.add(process.pid)
+            if process.exitcode == 0:
+                # asked to exit, its exit message is on its way
+                continue
+            self._exits += 1
+            started = [
+                segment
+                for segment in self._extracting.pop(process.pid, [])
+                if segment[1] not in self._finished
+            ]
+            if not started:
+                # died between segments
+                continue
+            message = (
+                f"extraction process {process.pid} died (exit code {process.exitcode})"
+            )
+            # earlier segments whose last messages were lost with the process
+            for segment in started[:-1]:
+                self._fail(segment[1], f"{segment[3]}: {message} before writing it")
+            segment = started[-1]
+            if self.on_crash is None:
+                self._fail(segment[1], f"{segment[3]}: {message}")
+            else:
+                self._discard(segment[1])
+                self.on_crash(segment, f"{segment[3]}: {message}")
+
+    def _read_starts(self):
+        """Note the segments the extraction processes started"""
+        while self.starts is not None and not self.starts.empty():
+            pid, segment = self.starts.get()
+            self._extracting[pid] = [
+                started
+                for started in self._extracting.get(pid, [])
+                if started[1] not in self._finished
+            ] + [segment]
+
+    def run(self):
+        while not (self.closed.is_set() and self._exits >= len(self.processes)):
+            try:
+                item = self.row_queue.get(timeout=1.0)
+            except queue.Empty:
+                self._read_starts()
+                self._check_processes()
+                if not any(process.is_alive() for process in self.processes):
+                    for key in list(self._files):
+                        self._fail(key, f"{key}: extraction process exited")
+                    return
+                continue
+            self._handle(*item)
+            self._read_starts()
+            self._check_processes()
+
+    def _handle(self, kind, key, payload):
+        self._sample()
+        try:
+            if kind == "open":
+                files = SegmentFiles(*payload)
+                self._files[key] = files.__enter__()
+            elif kind == "rows":
+                if key in self._files:
+                    self._files[key].write_rows(payload)
+            elif kind == "done":
+                self._finished.add(key)
+                if key not in self._files:
+                    return
+                files = self._files.pop(key)
+                files.__exit__(None, None, None)
+                segment, download_metrics, result = payload
+                download_metrics = dict(
+                    download_metrics, queue_depth_max=self._max_depths
+                )
+                if self.status is not None:
+                    download_metrics.update(self.status())
+                self._max_depths = {}
+                self.segments_done += 1
+                self.bytes_done += download_metrics.get("bytes_in", 0)
+                self.on_done(segment, download_metrics, result, files)
+            elif kind == "error":
+                segment, message = payload
+                self._fail(key, f"{segment[3]}: {message}")
+            elif kind == "exit":
+                self._exits += 1
+        except Exception:
+            # keep draining the queue, or the extraction processes would block
+            self._fail(key, f"{key}: {traceback.format_exc()}")
+
+
+class StagedPipeline:
+    """
+    The stages of run_staged, with a number of download threads and extraction
+    processes that can be changed while it runs (see ConcurrencyController)
+    """
+
+    def __init__(
+        self,
+        download,
+        process,
+        on_done,
+        initializer,
+        initargs=(),
+        prefetch=1,
+        write_queue_size=64,
+        on_crash=None,
+    ):
+        self.download = download
+        self.process = process
+        self.initializer = initializer
+        self.initargs = initargs
+        # fork, so profiles and stores are inherited instead of pickled
+        self.context = multiprocessing.get_context("fork")
+        self.capacities = {
+            "downloaded": max(prefetch, 1),
+            "rows": max(write_queue_size, 1),
+        }
+        self.segment_queue = self.context.Queue(self.capacities["downloaded"])
+        self.row_queue = self.context.Queue(self.capacities["rows"])
+        self.starts = self.context.SimpleQueue()
+        self.processes = []
+        # processes started and not asked to exit
+        self.workers = 0
+        self.downloads = AdjustableLimit(1)
+        self.writer = SegmentWriter(
+            self.row_queue,
+            self.processes,
+            on_done,
+            {"downloaded": self.segment_queue, "rows": self.row_queue},
+            status=lambda: {
+                "workers": self.workers,
+                "download_threads": self.downloads.limit,
+            },
+            starts=self.starts,
+            on_crash=on_crash,
+        )
+
+    def add_worker(self):
+        process = self.context.Process(
+            target=extraction_loop,
+            args=(
+                self.segment_queue,
+                self.row_queue,
+                self.starts,
+                self.process,
+                self.initializer,
+                self.initargs,
+            ),
+            daemon=True,
+        )
+        process.start()
+        self.processes.append(process)
+        self.workers += 1
+
+    def remove_worker(self):
+        """Ask one process to exit, once it gets past the segments already queued"""
+        self.workers -= 1
+        put_while_alive(self.segment_queue, None, self.processes)
+
+    def worker_pids(self):
+        return [process.pid for process in self.processes if process.is_alive()]
+
+    def run(
+        self,
+        segments,
+        workers=1,
+        download_threads=2,
+        max_download_threads=None,
+        controller=None,
+        should_stop=None,
+    ):
+        """
+        Process segments, returning the (key, error message) of those that failed.
+        Once should_stop() is true, the segments not downloaded yet are left out.
+        """
+
+        self.downloads.set(download_threads)
+        for _ in range(workers):
+            self.add_worker()
+        writer_thread = threading.Thread(target=self.writer.run, daemon=True)
+        writer_thread.start()
+        if controller is not None:
+            controller.start(self)
+
+        def download_stage(segment):
+            # held until the segment is queued, so finished downloads waiting for
+            # room in the queue count as well
+            with self.downloads:
+                if should_stop is not None and should_stop():
+                    return
+                try:
+                    download_metrics = self.download(segment)
+                except Exception:
+                    # the other segments go on, this one is reported with the
+                    # extraction errors
+                    self.writer.errors.append(
+                        (segment[1], f"{segment[3]}: {traceback.format_exc()}")
+                    )
+                    return
+                put_while_alive(
+                    self.segment_queue, (segment, download_metrics), self.processes
+                )
+
+        try:
+            threads = max(max_download_threads or download_threads, download_threads)
+            with ThreadPoolExecutor(
+                threads, thread_name_prefix="download"
+            ) as downloads:
+                # list() raises the first error of the pipeline itself, e.g. every
+                # extraction process exited, once every download is over
+                list(downloads.map(download_stage, segments))
+        finally:
+            if controller is not None:
+                controller.stop()
+            for _ in range(self.workers):
+                self.remove_worker()
+            self.writer.closed.set()
+            writer_thread.join()
+            for process in self.processes:
+                process.join()
+        return self.writer.errors
+
+
+class ConcurrencyController:
+    """
+    Adjusts the download threads and extraction processes of a StagedPipeline while
+    it runs. The fill of its queues is sampled every second, and once interval
+    seconds have passed and at least min_segments segments were written, one
+    decision is made:
+    - above max_memory_mb (main process and workers), a worker is removed,
+    - a mostly full downloaded queue means the workers are behind: a worker is added
+      if max_workers, the load of the available CPUs and max_memory_mb allow it,
+      otherwise a download thread, which would only wait, is removed,
+    - a mostly full rows queue means the writer is behind, where more workers do
+      not help, and nothing changes,
+    - a mostly empty downloaded queue means downloads are behind: a download thread
+      (one more connection) is added, up to max_download_threads.
+    An adjustment after which fewer bytes are processed per second (by more than
+    tolerance) is undone, and not tried again for cooldown decisions.
+    Every adjustment is logged to logger.
+    """
+
+    def __init__(
+        self,
+        logger,
+        min_workers=1,
+        max_workers=None,
+        max_download_threads=8,
+        max_memory_mb=None,
+        interval=60.0,
+        min_segments=2,
+        tolerance=0.1,
+        cooldown=5,
+    ):
+        self.logger = logger
+        self.min_workers = min_workers
+        self.max_workers = max_workers or available_cpus()
+        self.max_download_threads = max_download_threads
+        self.max_memory_mb = max_memory_mb
+        self.interval = interval
+        self.min_segments = min_segments
+        self.tolerance = tolerance
+        self.cooldown = cooldown
+        self.pipeline = None
+        self._stop = threading.Event()
+        self._thread = None
+        # adjustment made by the previous decision, judged by the next one
+        self._last_change = None
+        self._last_throughput = None
+        # (kind, delta) -> decisions left before it may be tried again
+        self._blocked = {}
+
+    def start(self, pipeline):
+        self.pipeline = pipeline
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def memory_mb(self):
+        """Resident memory of the main process and the workers, None if unknown"""
+        sizes = [rss_mb(pid) for pid in [os.getpid()] + self.pipeline.worker_pids()]
+        return None if None in sizes else sum(sizes)
+
+    def _run(self):
+        pipeline = self.pipeline
+        if queue_depth(pipeline.segment_queue) is None:
+            self.logger.warning(
+                "Queue depths are not available here, concurrency is not adjusted"
+            )
+            return
+        queues = {"downloaded": pipeline.segment_queue, "rows": pipeline.row_queue}
+        samples = []
+        started = perf_counter()
+        segments_start = pipeline.writer.segments_done
+        bytes_start = pipeline.writer.bytes_done
+        while not self._stop.wait(1.0):
+            samples.append(
+                {
+                    name: (queue_depth(q) or 0) / pipeline.capacities[name]
+                    for name, q in queues.items()
+                }
+            )
+            elapsed = perf_counter() - started
+            if (
+                elapsed < self.interval
+                or pipeline.writer.segments_done - segments_start < self.min_segments
+            ):
+                continue
+            fill = {
+                name: sum(sample[name] for sample in samples) / len(samples)
+                for name in queues
+            }
+            self.decide((pipeline.writer.bytes_done - bytes_start) / elapsed, fill)
+            samples = []
+            started = perf_counter()
+            segments_start = pipeline.writer.segments_done
+            bytes_start = pipeline.writer.bytes_done
+
+    def _adjust(self, kind, delta, reason, state):
+        pipeline = self.pipeline
+        if kind == "workers":
+            before = pipeline.workers
+            if delta > 0:
+                pipeline.add_worker()
+            else:
+                pipeline.remove_worker()
+            after = pipeline.workers
+        else:
+            before = pipeline.downloads.limit
+            pipeline.downloads.set(before + delta)
+            after = pipeline.downloads.limit
+        self.logger.info(f"Concurrency: {kind} {before} -> {after}, {reason} ({state})")
+
+    def _allowed(self, kind, delta):
+        return self._blocked.get((kind, delta), 0) == 0
+
+    def decide(self, throughput, fill):
+        """
+        At most one adjustment, from the bytes processed per second and the average
+        fill of the queues since the previous decision
+        """
+
+        pipeline = self.pipeline
+        memory = self.memory_mb()
+        state = (
+            f"{throughput / 1024**2:.2f} MB/s, downloaded queue {fill['downloaded']:.0%} "
+            f"full, rows queue {fill['rows']:.0%} full"
+            + (f", {memory:.0f} MB" if memory is not None else "")
+        )
+        self._blocked = {
+            move: left - 1 for move, left in self._blocked.items() if left > 1
+        }
+
+        last_change, last_throughput = self._last_change, self._last_throughput
+        self._last_change, self._last_throughput = None, throughput
+        if (
+            last_change is not None
+            and throughput < (1 - self.tolerance) * last_throughput
+        ):
+            kind, delta = last_change
+            self._blocked[last_change] = self.cooldown
+            self._adjust(kind, -delta, "undoing the last change, it was slower", state)
+            return
+
+        if (
+            self.max_memory_mb is not None
+            and memory is not None
+            and memory > self.max_memory_mb
+        ):
+            if pipeline.workers > self.min_workers:
+                # forced by the limit, so never undone
+                self._adjust("workers", -1, "over the memory limit", state)
+            return
+
+        change = None
+        if fill["downloaded"] >= 0.75:
+            if fill["rows"] >= 0.75:
+                return
+            per_worker = (memory or 0) / max(len(pipeline.worker_pids()), 1)
+            fits_memory = (
+                self.max_memory_mb is None
+                or memory is None
+                or memory + per_worker <= self.max_memory_mb
+            )
+            if (
+                pipeline.workers < self.max_workers
+                and os.getloadavg()[0] + 1 <= available_cpus()
+                and fits_memory
+                and self._allowed("workers", 1)
+            ):
+                change = ("workers", 1, "the workers are behind")
+            elif pipeline.downloads.limit > 1 and self._allowed("downloads", -1):
+                change = ("downloads", -1, "the workers are behind")
+        elif fill["downloaded"] <= 0.25:
+            if pipeline.downloads.limit < self.max_download_threads and self._allowed(
+                "downloads", 1
+            ):
+                change = ("downloads", 1, "the downloads are behind")
+        if change is not None:
+            kind, delta, reason = change
+            self._adjust(kind, delta, reason, state)
+            self._last_change = (kind, delta)
+
+
+def run_staged(
+    segments,
+    download,
+    process,
+    on_done,
+    initializer,
+    initargs=(),
+    workers=1,
+    download_threads=2,
+    prefetch=1,
+    write_queue_size=64,
+    controller=None,
+    should_stop=None,
+    on_crash=None,
+):
+    """
+    Run segments through the stages:
+    - download_threads threads call download(segment), which returns download metrics,
+    - up to prefetch downloaded segments wait in a queue for the extraction processes,
+    - workers processes (forked, after initializer(*initargs)) call
+      process(*segment, row_queue=row_queue), sending their rows to row_queue with
+      QueuedSegmentFiles, and return a result,
+    - a writer thread writes the rows (at most write_queue_size batches wait for it)
+      and calls on_done(segment, download_metrics, result, files) for every segment.
+    With a controller (a ConcurrencyController), the download threads and workers
+    are adjusted while the segments are processed, within its limits.
+    Once should_stop() is true, no other segment is downloaded.
+    Returns the (key, error message) of the segments that failed to download or
+    extract, key being the csv name of the segment (segment[1]). With on_crash, a
+    segment whose extraction process died is given to on_crash(segment, message)
+    as soon as the writer sees it, instead of being returned (see SegmentWriter).
+    """
+
+    pipeline = StagedPipeline(
+        download,
+        process,
+        on_done,
+        initializer,
+        initargs,
+        prefetch,
+        write_queue_size,
+        on_crash,
+    )
+    return pipeline.run(
+        segments,
+        workers=workers,
+        download_threads=download_threads,
+        max_download_threads=(
+            controller.max_download_threads if controller is not None else None
+        ),
+        controller=controller,
+        should_stop=should_stop,
+    )
@@ -0,0 +1,68 @@
+"""Per-stage timing and peak memory of each segment, written as json lines"""
+
+import json
+import resource
+
+from time import perf_counter
+
+
+class StageTimer:
+    """
+    Seconds spent per stage. lap(stage) charges the time since the previous lap
+    to stage, so a loop going through several stages pays one perf_counter call
+    per stage boundary, which is cheap enough for the record loop.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.last = perf_counter()
+
+    def lap(self, stage):
+        now = perf_counter()
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def move(self, seconds, from_stage, to_stage):
+        """Charge seconds already counted in from_stage to to_stage instead"""
+        if seconds:
+            self.seconds[from_stage] = self.seconds.get(from_stage, 0.0) - seconds
+            self.seconds[to_stage] = self.seconds.get(to_stage, 0.0) + seconds
+
+    def restart(self):
+        """Start the next lap now, without charging the time since the last one"""
+        self.last = perf_counter()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MetricsWriter:
+    """Appends one json object per line to filename, flushed after each line"""
+
+    def __init__(self, filename):
+        self.file = open(filename, "a", encoding="utf-8")
+
+    def write(self, metrics):
+        self.file.write(json.dumps(metrics) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def rss_mb(pid):
+    """Current resident set size of process pid in MB, None where /proc cannot tell"""
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f_in:
+            pages = int(f_in.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() / 1024**2
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import each other as top-level modules, as run from this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,40 @@
+"""Checkpoints written, read back and removed next to the csv of a segment"""
+
+import os
+
+from checkpoint import (
+    checkpoint_path,
+    read_checkpoint,
+    remove_checkpoint,
+    write_checkpoint,
+)
+
+
+def test_round_trip(tmp_path):
+    csv_name = os.path.join(tmp_path, "crawldata202350segment00000.csv")
+    checkpoint = {
+        "segment": "CC-MAIN-2023-50/segments/0/wet/CC-MAIN-0-00000.warc.wet.gz",
+        "offset": 12345,
+        "stats": {"records_seen": 10, "records_matched": 2},
+        "domains": [{"example.co.uk": ["https://example.co.uk/", "text", ["BS1 1AA"]]}],
+    }
+    assert read_checkpoint(csv_name) is None
+
+    write_checkpoint(csv_name, checkpoint)
+    assert os.listdir(tmp_path) == [os.path.basename(checkpoint_path(csv_name))]
+    read = read_checkpoint(csv_name)
+    assert "stopped" in read
+    del read["stopped"]
+    assert read == checkpoint
+
+    remove_checkpoint(csv_name)
+    assert read_checkpoint(csv_name) is None
+    # already gone
+    remove_checkpoint(csv_name)
+
+
+def test_damaged_checkpoint_is_not_read(tmp_path):
+    csv_name = os.path.join(tmp_path, "crawldata202350segment00000.csv")
+    with open(checkpoint_path(csv_name), "w", encoding="utf-8") as f_out:
+        f_out.write('{"offset": 123')
+    assert read_checkpoint(csv_name) is None
@@ -0,0 +1,78 @@
+"""DiskBudget reservations and releases in the shared ledger, and free space"""
+
+import os
+from collections import namedtuple
+
+import pytest
+
+import disk_budget
+from disk_budget import DiskBudget
+
+DiskUsage = namedtuple("DiskUsage", "total used free")
+
+
+class Waited(Exception):
+    pass
+
+
+def wait(seconds):
+    raise Waited
+
+
+def budget(tmp_path, max_bytes=1000, min_free_bytes=0):
+    return DiskBudget(
+        max_bytes,
+        path=os.path.join(tmp_path, "ledger.json"),
+        directory=str(tmp_path),
+        min_free_bytes=min_free_bytes,
+        initial_ratio=2.0,
+    )
+
+
+def test_reserve_and_release(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_budget.time, "sleep", wait)
+    first = budget(tmp_path)
+    second = budget(tmp_path)
+    first.reserve("a", 600)
+    second.reserve("b", 300)
+    assert first.in_use() == 900
+    with pytest.raises(Waited):
+        second.reserve("c", 200)
+
+    second.fit("b", 50)
+    assert first.in_use() == 700
+    second.reserve("c", 200)
+
+    first.release("a")
+    second.release("b")
+    second.release("c")
+    assert first.in_use() == 0
+
+
+def test_oversized_reservation_is_admitted_alone(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_budget.time, "sleep", wait)
+    first = budget(tmp_path)
+    first.reserve("a", 5000)
+    assert first.in_use() == 5000
+    with pytest.raises(Waited):
+        first.reserve("b", 1)
+
+
+def test_free_space_left_by_reservations_not_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_budget.time, "sleep", wait)
+    monkeypatch.setattr(
+        disk_budget.shutil, "disk_usage", lambda path: DiskUsage(10000, 9000, 1000)
+    )
+    first = budget(tmp_path, max_bytes=10000, min_free_bytes=100)
+    first.reserve("a", 600)
+    # 1000 free, of which 600 are still to be written by a
+    with pytest.raises(Waited):
+        first.reserve("b", 400)
+    # already on disk, so only the budget is checked
+    first.reserve("b", 400, on_disk=True)
+
+    # the 600 bytes of a written, and counted by the free space
+    first.resize("a", 600, written=600)
+    first.reserve("c", 500)
+    with pytest.raises(Waited):
+        first.reserve("d", 401)
@@ -0,0 +1,74 @@
+"""Multi-member gzip segments split in ranges and inflated, with damaged members"""
+
+import gzip
+import io
+import os
+import random
+
+from helper_functions import inflate_gzip_members, split_gzip_members
+
+
+def records(count):
+    rng = random.Random(count)
+    return [
+        f"WARC/1.0\r\nWARC-Record-ID: {i}\r\n\r\n".encode()
+        + rng.randbytes(3000).hex().encode()
+        for i in range(count)
+    ]
+
+
+def write_segment(filename, members):
+    """Write the members, one gzip member each. Returns the offset of each member"""
+    offsets = []
+    with open(filename, "wb") as f_out:
+        for member in members:
+            offsets.append(f_out.tell())
+            f_out.write(gzip.compress(member))
+    return offsets
+
+
+def inflate(filename, start=0, end=None):
+    f_out = io.BytesIO()
+    with open(filename, "rb") as f_in:
+        skipped = inflate_gzip_members(f_in, f_out, start, end)
+    return f_out.getvalue(), skipped
+
+
+def test_ranges_start_on_members_and_inflate_to_the_segment(tmp_path):
+    filename = os.path.join(tmp_path, "segment.warc.wet.gz")
+    members = records(40)
+    offsets = write_segment(filename, members)
+
+    for parts in [1, 2, 3, 7, 40, 100]:
+        ranges = split_gzip_members(filename, parts)
+        assert 1 < len(ranges) <= parts or parts == 1
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == os.path.getsize(filename)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            assert end == start
+            assert start in offsets
+        inflated = [inflate(filename, start, end) for start, end in ranges]
+        assert b"".join(data for data, _ in inflated) == b"".join(members)
+        assert all(skipped == 0 for _, skipped in inflated)
+
+
+def test_damaged_members_are_left_out(tmp_path):
+    filename = os.path.join(tmp_path, "segment.warc.wet.gz")
+    members = records(10)
+    offsets = write_segment(filename, members)
+    with open(filename, "r+b") as f:
+        # deflate data of member 3 (past its header)
+        f.seek(offsets[3] + 100)
+        f.write(b"\xff" * 50)
+        # and a truncated last member
+        f.truncate(offsets[9] + 200)
+
+    data, skipped = inflate(filename)
+    assert skipped == 2
+    assert data == b"".join(members[:3] + members[4:9])
+
+    # the same, one range at a time
+    ranges = split_gzip_members(filename, 4)
+    inflated = [inflate(filename, start, end) for start, end in ranges]
+    assert b"".join(data for data, _ in inflated) == data
+    assert sum(skipped for _, skipped in inflated) == 2
@@ -0,0 +1,112 @@
+"""HttpClient downloads from local_server.py, with stale and interrupted connections"""
+
+import http.client
+import os
+import time
+
+import pytest
+
+from http_client import HttpClient, content_range_start, node_limiter
+from local_server import RangeRequestHandler, start_server
+
+SIZE = 1024 * 1024
+
+
+@pytest.fixture
+def served(tmp_path):
+    """Server of a file of SIZE bytes, its url and its content"""
+    content = os.urandom(SIZE)
+    with open(os.path.join(tmp_path, "segment.gz"), "wb") as f_out:
+        f_out.write(content)
+    server, base_url = start_server(str(tmp_path))
+    yield server, base_url + "segment.gz", content
+    server.shutdown()
+    server.server_close()
+
+
+def download(client, url, tmp_path):
+    filename = os.path.join(tmp_path, "downloaded")
+    metrics = client.download(url, filename)
+    with open(filename, "rb") as f_in:
+        return metrics, f_in.read()
+
+
+def test_content_range_start():
+    assert content_range_start("bytes 100-199/200") == 100
+    assert content_range_start("bytes */200") is None
+    assert content_range_start(None) is None
+
+
+def test_no_limiter_without_limits(tmp_path):
+    path = os.path.join(tmp_path, "limiter")
+    assert node_limiter(path) is None
+    assert not os.path.exists(path)
+    limiter = node_limiter(path, requests_per_second=10)
+    assert limiter.acquire(requests=1) == 0
+    assert os.path.exists(path)
+
+
+def test_unsatisfiable_range_closes_the_connection(served):
+    server, url, _ = served
+    connection = http.client.HTTPConnection(url.split("/")[2])
+    connection.request("GET", "/segment.gz", headers={"Range": f"bytes={SIZE}-"})
+    response = connection.getresponse()
+    assert response.status == 416
+    assert response.headers["Content-Length"] == "0"
+    assert response.headers["Content-Range"] == f"bytes */{SIZE}"
+    assert response.will_close
+    connection.close()
+
+
+def test_stale_pooled_connection_is_not_a_retry(served, tmp_path, monkeypatch):
+    server, url, content = served
+    # the server drops connections idle for longer than this
+    monkeypatch.setattr(RangeRequestHandler, "timeout", 0.2)
+    client = HttpClient(backoff=10.0)
+    download(client, url, tmp_path)
+    time.sleep(0.5)
+
+    start = time.monotonic()
+    metrics, downloaded = download(client, url, tmp_path)
+    assert downloaded == content
+    assert metrics["retries"] == 0
+    assert time.monotonic() - start < 5.0
+    client.close()
+
+
+def interrupt_first_response(monkeypatch, answered_start=None):
+    """
+    Cut the first response half-way, and answer later range requests from
+    answered_start instead of the byte asked for (if not None)
+    """
+
+    copyfile = RangeRequestHandler.copyfile
+    send_head = RangeRequestHandler.send_head
+    state = {"interrupted": False}
+
+    def interrupted_copyfile(self, source, outputfile):
+        if state["interrupted"]:
+            return copyfile(self, source, outputfile)
+        state["interrupted"] = True
+        outputfile.write(source.read(SIZE // 2))
+        self.close_connection = True
+
+    def wrong_send_head(self):
+        if answered_start is not None and "Range" in self.headers:
+            del self.headers["Range"]
+            self.headers["Range"] = f"bytes={answered_start}-"
+        return send_head(self)
+
+    monkeypatch.setattr(RangeRequestHandler, "copyfile", interrupted_copyfile)
+    monkeypatch.setattr(RangeRequestHandler, "send_head", wrong_send_head)
+
+
+@pytest.mark.parametrize("answered_start", [None, 0, SIZE // 4])
+def test_interrupted_download_resumes(served, tmp_path, monkeypatch, answered_start):
+    server, url, content = served
+    interrupt_first_response(monkeypatch, answered_start)
+    client = HttpClient(backoff=0.01)
+    metrics, downloaded = download(client, url, tmp_path)
+    assert downloaded == content
+    assert metrics["retries"] == 1
+    client.close()
@@ -0,0 +1,60 @@
+"""Postcodes found by the strict and tolerant scanners, and in windows of a body"""
+
+import random
+
+from helper_functions import (
+    postcode_finder,
+    postcode_finder_windows,
+    postcode_scanner,
+    tolerant_postcode_matches,
+)
+
+WORDS = ["rue", "Ørsted", "café", "€5", "\xa0", "the", "12", "1 2", "x"]
+SEPARATORS = [" ", " ", "\n", "-", ",", ""]
+
+
+def random_postcode(rng):
+    area = "".join(rng.choice("ABCEGHKLMNPSTWY") for _ in range(rng.randint(1, 2)))
+    outward = area + str(rng.randint(1, 99))
+    inward = str(rng.randint(0, 9)) + "".join(rng.choice("ABDEHJLNPUWZ") for _ in "12")
+    postcode = outward + rng.choice([" ", " ", "", "  ", "\xa0"]) + inward
+    return postcode.lower() if rng.random() < 0.2 else postcode
+
+
+def random_text(seed, length=3000):
+    rng = random.Random(seed)
+    return "".join(
+        (random_postcode(rng) if rng.random() < 0.3 else rng.choice(WORDS))
+        + rng.choice(SEPARATORS)
+        for _ in range(length)
+    )
+
+
+def windows(text, size):
+    body = text.encode("utf-8")
+    return [body[start : start + size] for start in range(0, len(body), size)]
+
+
+def test_windows_find_the_postcodes_of_the_whole_text():
+    for seed in range(3):
+        text = random_text(seed)
+        for size in [7, 10, 64, 1000, 100000]:
+            assert sorted(postcode_finder_windows(windows(text, size))) == sorted(
+                postcode_finder(text)
+            )
+            assert sorted(
+                postcode_finder_windows(
+                    windows(text, size), matches=tolerant_postcode_matches
+                )
+            ) == sorted(postcode_scanner(text))
+
+
+def test_tolerant_scanner_finds_the_strict_matches():
+    for seed in range(3):
+        text = random_text(seed)
+        strict = set(postcode_finder(text))
+        tolerant = set(postcode_scanner(text))
+        assert strict < tolerant
+    assert sorted(postcode_scanner("bs1 1aa, BS11AA and Bs1  1aA")) == ["BS1 1AA"]
+    # not at the start of a word
+    assert postcode_scanner("xBS1 1AA 2BS1 1AA") == []
@@ -0,0 +1,95 @@
+"""
+refilter.py fetching the indexed records of a segment with range requests finds
+what read_wet.py finds in the whole segment
+"""
+
+import ast
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import generate_lookup, generate_segment
+from local_server import start_server
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEGMENT = "CC-MAIN-20231201000000-20231201030000-00000"
+
+
+def run_script(script, *args):
+    subprocess.run(
+        [sys.executable, os.path.join(SCRIPT_DIR, script), *args],
+        cwd=SCRIPT_DIR,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def read_output(filename):
+    """Rows of a merged csv by url, postcodes sorted as their order is a set's"""
+
+    df = pd.read_csv(filename)
+    df["postcodes"] = df["postcodes"].map(lambda p: sorted(ast.literal_eval(p)))
+    return df.sort_values("url").reset_index(drop=True)
+
+
+@pytest.fixture
+def server(tmp_path):
+    server, base_url = start_server(str(tmp_path))
+    yield base_url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize(
+    "input_format, extension", [("wet", ".warc.wet.gz"), ("warc", ".warc.gz")]
+)
+def test_refilter_matches_full_segment(tmp_path, server, input_format, extension):
+    lookup = os.path.join(tmp_path, "lookup.csv")
+    postcodes = generate_lookup(lookup, 2000, "BS")
+    segment_path = (
+        f"crawl-data/CC-MAIN-2023-50/segments/0/{input_format}/{SEGMENT}{extension}"
+    )
+    os.makedirs(os.path.dirname(os.path.join(tmp_path, segment_path)))
+    generate_segment(
+        os.path.join(tmp_path, segment_path),
+        fmt=input_format,
+        num_records=500,
+        couk_share=0.3,
+        postcode_density=2,
+        page_size=2000,
+        lookup_postcodes=postcodes,
+    )
+    wet_paths = os.path.join(tmp_path, "segment.paths")
+    with open(wet_paths, "w", encoding="utf-8") as f_out:
+        f_out.write(segment_path + "\n")
+    full_dir = os.path.join(tmp_path, "full", "")
+    refiltered_dir = os.path.join(tmp_path, "refiltered", "")
+    common = ["--server", server, "--crawl", "202350", "--postcode_list", lookup]
+    common += ["--input_format", input_format]
+
+    run_script(
+        "read_wet.py",
+        "--wet_file",
+        wet_paths,
+        "--outputs_dir",
+        full_dir,
+        "--record_index",
+        *common,
+    )
+    run_script(
+        "refilter.py",
+        "--index",
+        os.path.join(full_dir, "*.index"),
+        "--outputs_dir",
+        refiltered_dir,
+        *common,
+    )
+
+    full = read_output(os.path.join(full_dir, "df202350.csv"))
+    refiltered = read_output(os.path.join(refiltered_dir, "df202350.csv"))
+    assert len(full) > 0
+    pd.testing.assert_frame_equal(full, refiltered)
@@ -0,0 +1,72 @@
+"""SegmentCache hits, eviction, and downloads next to links into the cache"""
+
+import os
+
+from segment_downloads import fetch_segment
+from segment_cache import SegmentCache
+
+WET_PATH = "crawl-data/CC-MAIN-2023-50/segments/0/wet/CC-MAIN-0-00000.warc.wet.gz"
+
+
+def write(filename, data):
+    with open(filename, "wb") as f_out:
+        f_out.write(data)
+    return filename
+
+
+def read(filename):
+    with open(filename, "rb") as f_in:
+        return f_in.read()
+
+
+def test_hit_and_miss(tmp_path):
+    cache = SegmentCache(os.path.join(tmp_path, "cache"), 1000)
+    target = os.path.join(tmp_path, "segment.gz")
+    assert not cache.fetch(WET_PATH, target)
+    cache.put(WET_PATH, write(os.path.join(tmp_path, "downloaded.gz"), b"x" * 100))
+
+    assert cache.fetch(WET_PATH, target)
+    assert read(target) == b"x" * 100
+    assert cache.counts["hits"] == 1
+    assert cache.counts["misses"] == 1
+    assert cache.counts["bytes_saved"] == 100
+
+
+def test_corrupt_entry_is_removed(tmp_path):
+    cache = SegmentCache(os.path.join(tmp_path, "cache"), 1000)
+    cache.put(WET_PATH, write(os.path.join(tmp_path, "downloaded.gz"), b"x" * 100))
+    write(cache.path(WET_PATH), b"y" * 100)
+
+    assert not cache.fetch(WET_PATH, os.path.join(tmp_path, "segment.gz"))
+    assert cache.counts["corrupt"] == 1
+    assert not os.path.exists(cache.path(WET_PATH))
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = SegmentCache(os.path.join(tmp_path, "cache"), 250)
+    paths = [WET_PATH.replace("00000", f"{i:05d}") for i in range(3)]
+    for i, wet_path in enumerate(paths[:2]):
+        cache.put(wet_path, write(os.path.join(tmp_path, f"{i}.gz"), b"x" * 100))
+        # mtimes one second apart, the order of last use
+        os.utime(cache.path(wet_path), (i, i))
+    cache.fetch(paths[0], os.path.join(tmp_path, "used.gz"))
+
+    cache.put(paths[2], write(os.path.join(tmp_path, "2.gz"), b"x" * 100))
+    assert os.path.exists(cache.path(paths[0]))
+    assert not os.path.exists(cache.path(paths[1]))
+    assert os.path.exists(cache.path(paths[2]))
+    assert cache.counts["evictions"] == 1
+    assert cache.usage() == (2, 200)
+
+
+def test_download_does_not_overwrite_a_leftover_link(tmp_path):
+    cache = SegmentCache(os.path.join(tmp_path, "cache"), 1000)
+    cache.put(WET_PATH, write(os.path.join(tmp_path, "cached.gz"), b"cached"))
+    output_filename = os.path.join(tmp_path, "out", "segment.wet")
+    # an interrupted run with the cache left a link to the cached segment
+    assert cache.fetch(WET_PATH, output_filename + ".gz")
+
+    source = write(os.path.join(tmp_path, "remote.gz"), b"downloaded again")
+    fetch_segment("file://" + source, output_filename, None, WET_PATH, None)
+    assert read(output_filename + ".gz") == b"downloaded again"
+    assert read(cache.path(WET_PATH)) == b"cached"
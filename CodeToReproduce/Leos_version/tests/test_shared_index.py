@@ -0,0 +1,51 @@
+"""
+Forked workers looking up postcodes in a PostcodeIndex share its table instead of
+copying it
+"""
+
+import gc
+import os
+import random
+
+import pytest
+
+from benchmarks.bench_shared_index import lookup_postcodes, run_mode
+from postcode_index import PostcodeIndex
+
+pytestmark = pytest.mark.skipif(
+    not os.path.exists("/proc/self/smaps_rollup"),
+    reason="reads the memory of workers from /proc/self/smaps_rollup",
+)
+
+WORKERS = 3
+PARAMS = {"lookups": 20000, "seed": 0}
+
+
+def copied_mb(kind, size, workdir):
+    """Private memory the lookups cost each of WORKERS workers, and the table size"""
+
+    postcodes = lookup_postcodes(size, PARAMS["seed"])
+    hits = "\n".join(
+        random.Random(PARAMS["seed"]).sample(postcodes, PARAMS["lookups"] // 2)
+    )
+    if kind == "index":
+        holder = PostcodeIndex.from_postcodes(postcodes)
+        start = "fork"
+    else:
+        holder = PostcodeIndex.build(postcodes, os.path.join(workdir, "lookup.pci"))
+        start = "pickled"
+    del postcodes
+    gc.collect()
+    result = run_mode(holder, start, hits, WORKERS, PARAMS)
+    assert result["found"] >= PARAMS["lookups"] // 2
+    return result["worker_copied_mb"], len(holder._map) / 1024**2
+
+
+@pytest.mark.parametrize("kind", ["index", "index_file"])
+def test_workers_do_not_copy_the_index(kind, tmp_path):
+    # the interpreter's own pages a worker writes to (the garbage collection
+    # touches every object) cost the same whatever the size of the lookup
+    baseline, _ = copied_mb(kind, PARAMS["lookups"], tmp_path)
+    copied, table_mb = copied_mb(kind, 20 * PARAMS["lookups"], tmp_path)
+    assert table_mb > 2
+    assert copied - baseline < table_mb / 4
@@ -0,0 +1,52 @@
+"""run_staged with an extraction process that dies while extracting a segment"""
+
+import os
+import signal
+import time
+
+from segment_files import QueuedSegmentFiles
+from staged import run_staged
+
+
+def segments(tmp_path, count):
+    return [
+        (None, os.path.join(tmp_path, f"segment{i}.csv"), None, f"segment{i}.wet.gz")
+        for i in range(count)
+    ]
+
+
+def download(segment):
+    return {"bytes_in": 0}
+
+
+def process(output_filename, csv_name, url_crawl, wet_path, row_queue=None):
+    with QueuedSegmentFiles(row_queue, csv_name, [csv_name], batch_size=1) as files:
+        files.write(0, [wet_path])
+        if wet_path == "segment2.wet.gz":
+            # once the messages are sent, e.g. killed for running out of memory
+            time.sleep(0.5)
+            os.kill(os.getpid(), signal.SIGKILL)
+    return wet_path
+
+
+def test_segment_of_a_dead_process_is_given_to_on_crash(tmp_path):
+    done = []
+    crashed = []
+    errors = run_staged(
+        segments(tmp_path, 6),
+        download,
+        process,
+        lambda segment, download_metrics, result, files: done.append(result),
+        initializer=lambda: None,
+        workers=2,
+        on_crash=lambda segment, message: crashed.append((segment[3], message)),
+    )
+
+    assert errors == []
+    assert sorted(done) == [f"segment{i}.wet.gz" for i in [0, 1, 3, 4, 5]]
+    assert len(crashed) == 1
+    wet_path, message = crashed[0]
+    assert wet_path == "segment2.wet.gz"
+    assert "died (exit code -9)" in message
+    assert not os.path.exists(os.path.join(tmp_path, "segment2.csv"))
+    assert os.path.exists(os.path.join(tmp_path, "segment3.csv"))
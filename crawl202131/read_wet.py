@@ -1,5 +1,6 @@
 import glob, os
 from warcio.archiveiterator import ArchiveIterator
+from warcio.exceptions import ArchiveLoadFailed
 import re # regular expressions
 import csv
 import pandas as pd
@@ -12,6 +13,7 @@ from scipy.io import mmwrite
 from scipy.sparse import csr_matrix
 import string
 import sys
+import zlib
 
 def postcode_finder(text):
     postcodes = re.findall(r'\b[A-Z]{1,2}[0-9][A-Z0-9]? [0-9][ABD-HJLNP-UW-Z]{2}\b', text)
@@ -50,20 +52,28 @@ for file_path in glob.glob(dir_path + "/*.wet"):
 
         # open the file, naming the reader "stream"
         with open(file_path, 'rb') as stream:
-            # loop over each record within "stream" using the ArchiveIterator from warcio
-            for record in ArchiveIterator(stream):
-                # Check if the current record has the type "response" - conversion as wet file
-                if record.rec_type == 'conversion':
-                    # lookup the uri (web address) of the record
-                    uri = record.rec_headers.get_header('WARC-Target-URI')
-                    language = record.rec_headers.get_header('WARC-Identified-Content-Language')
+            try:
+                # loop over each record within "stream" using the ArchiveIterator from warcio
+                for record in ArchiveIterator(stream):
+                    try:
+                        # Check if the current record has the type "response" - conversion as wet file
+                        if record.rec_type == 'conversion':
+                            # lookup the uri (web address) of the record
+                            uri = record.rec_headers.get_header('WARC-Target-URI')
+                            language = record.rec_headers.get_header('WARC-Identified-Content-Language')
 
-                    # check if the web address contains ".co.uk/" and the language is English
-                    if ('.co.uk/' in uri) & (language == 'eng'):
-                        website = extract_website(uri)
-                        text = record.content_stream().read().decode('utf-8', 'ignore') # ignores symbols not in utf-8 
-                        postcodes = UK_postcode_finder(text) # do postcode search for all UK postcodes
-                        text = text.lower() # all into lowercase
+                            # check if the web address contains ".co.uk/" and the language is English
+                            if ('.co.uk/' in uri) & (language == 'eng'):
+                                website = extract_website(uri)
+                                text = record.content_stream().read().decode('utf-8', 'ignore') # ignores symbols not in utf-8 
+                                postcodes = UK_postcode_finder(text) # do postcode search for all UK postcodes
+                                text = text.lower() # all into lowercase
 
-                        if postcodes is not None:  # Check if there are any postcodes found
-                            csv_writer.writerow([ uri,website,postcodes,cclocation,text]) ##cclocation
+                                if postcodes is not None:  # Check if there are any postcodes found
+                                    csv_writer.writerow([ uri,website,postcodes,cclocation,text]) ##cclocation
+                    except Exception as error:
+                        # a damaged record is skipped, the rest of the segment is still read
+                        print(f"Skipping record {record.rec_headers.get_header('WARC-Target-URI')} of {cclocation}: {error!r}", file=sys.stderr)
+            except (ArchiveLoadFailed, EOFError, zlib.error) as error:
+                # the segment cannot be read further (e.g. truncated), keep the records read so far
+                print(f"Stopped reading {cclocation}: {error!r}", file=sys.stderr)